@@ -1,6 +1,8 @@
 from django.contrib import admin
 
-from .models import Paragraph, Word
+from .models import Corpus, Paragraph, Word, IndexGeneration
 
+admin.site.register(Corpus)
 admin.site.register(Paragraph)
 admin.site.register(Word)
+admin.site.register(IndexGeneration)
@@ -1,8 +1,52 @@
 # Classes needed to build Abstract Syntax Tree (AST)
 # Objects of these classes will correspond to nodes in the resulting AST
 # based on http://jayconrod.com/posts/39/a-simple-interpreter-from-scratch-in-python-part-3
+# eval() takes an InvertedIndex (see index.py) and returns a bitmap of matching paragraphs
+# cost() of leaf nodes estimates the number of matching paragraphs, it's used by the query planner (see planner.py)
+# canonical() returns a hashable canonical form of the expression: equivalent expressions that differ
+# only in the order of operands or grouping of the same operator have the same canonical form
+# positions() of words, phrases and NEAR expressions returns dict mapping paragraph ids to token positions
+# of their occurrences, they are combined with a positional merge (see merge_positions())
 
-from .models import Word, Paragraph
+from array import array
+from itertools import chain
+
+from django.conf import settings
+
+from .indexing import paragraph_tokens
+
+
+class QueryError(Exception):
+    """
+    Raised when a parsed query can't be evaluated
+    """
+
+
+def merge_positions(left, right, lo, hi):
+    """
+    Positional merge-intersection
+
+    left, right: dicts mapping paragraph ids to sorted arrays of token positions
+    return: dict mapping paragraph ids to positions `p` from `left` such that `right` has a position `q`
+            in the same paragraph with lo <= q - p <= hi
+    """
+    res = {}
+    for paragraph_id in left.keys() & right.keys():
+        right_positions = right[paragraph_id]
+        n = len(right_positions)
+        j = 0
+        matched = array('I')
+        # both lists are sorted, so the pointer into the right list only moves forward
+        for p in left[paragraph_id]:
+            while j < n and right_positions[j] < p + lo:
+                j += 1
+            if j == n:
+                break
+            if right_positions[j] <= p + hi:
+                matched.append(p)
+        if matched:
+            res[paragraph_id] = matched
+    return res
 
 
 class WordExpression:
@@ -13,13 +57,140 @@ class WordExpression:
     def __repr__(self):
         return 'WordExpression({})'.format(self.i.__repr__())
 
-    def eval(self):
-        try:
-            obj = Word.objects.get(word=self.i.lower())
-            par_list = obj.paragraphs.all().iterator()
-        except Word.DoesNotExist:
-            return set([])
-        return set(par_list)
+    def eval(self, index):
+        return index.bitmap(self.i.lower())
+
+    def positions(self, index):
+        return index.positions(self.i.lower())
+
+    def cost(self, index):
+        # document frequency of the word
+        return index.df(self.i.lower())
+
+    def canonical(self):
+        return ('WORD', self.i.lower())
+
+
+class PrefixWordExpression:
+    """
+    Wildcard Expression, i.e. `вронск*` - any word starting with `вронск`
+    Expands to at most ANNA_WILDCARD_MAX_TERMS words from the sorted term dictionary, raises QueryError otherwise
+    """
+    def __init__(self, i):
+        self.i = i
+        self.prefix = i.rstrip('*').lower()
+
+    def __repr__(self):
+        return 'PrefixWordExpression({})'.format(self.i.__repr__())
+
+    def words(self, index):
+        words = index.words_with_prefix(self.prefix)
+        max_terms = getattr(settings, 'ANNA_WILDCARD_MAX_TERMS', 1000)
+        if len(words) > max_terms:
+            raise QueryError('{i} matches more than {n} words'.format(i=self.i, n=max_terms))
+        return words
+
+    def eval(self, index):
+        # union of postings of all matching words in one pass
+        return index.to_bitmap(chain.from_iterable(index.postings(word) for word in self.words(index)))
+
+    def positions(self, index):
+        res = {}
+        for word in self.words(index):
+            for paragraph_id, positions in index.positions(word).items():
+                if paragraph_id in res:
+                    res[paragraph_id] = array('I', sorted(res[paragraph_id] + positions))
+                else:
+                    res[paragraph_id] = positions
+        return res
+
+    def cost(self, index):
+        return min(sum(index.df(word) for word in index.words_with_prefix(self.prefix)),
+                   len(index.paragraph_ids))
+
+    def canonical(self):
+        return ('PREFIX', self.prefix)
+
+
+class PhraseExpression:
+    """Phrase Expression, i.e. `"w1 w2"` - words that follow each other"""
+    def __init__(self, i):
+        self.i = i
+        self.words = paragraph_tokens(i)
+
+    def __repr__(self):
+        return 'PhraseExpression({})'.format(self.i.__repr__())
+
+    def eval(self, index):
+        return index.to_bitmap(self.positions(index))
+
+    def positions(self, index):
+        # positions of phrase occurrences are positions of their first words
+        if not self.words:
+            return {}
+        res = index.positions(self.words[0])
+        for offset, word in enumerate(self.words[1:], 1):
+            if not res:
+                break
+            res = merge_positions(res, index.positions(word), offset, offset)
+        return res
+
+    def cost(self, index):
+        # document frequency of the rarest word
+        return min((index.df(word) for word in self.words), default=0)
+
+    def canonical(self):
+        if len(self.words) == 1:
+            return ('WORD', self.words[0])
+        return ('PHRASE', tuple(self.words))
+
+
+class NearWordExpression:
+    """
+    Proximity Expression, i.e. `w1 NEAR/3 w2` - words at most 3 positions apart, in any order
+    Operands are words, phrases or other NEAR expressions, distance to a phrase is measured from its first word
+    """
+    def __init__(self, distance, left, right):
+        self.distance = distance
+        self.left = left
+        self.right = right
+
+    def __repr__(self):
+        return 'NearWordExpression({distance}, {left}, {right})'.format(distance=self.distance, left=self.left, right=self.right)
+
+    def eval(self, index):
+        return index.to_bitmap(self.positions(index))
+
+    def positions(self, index):
+        # positions of left operand occurrences that have right operand occurrences nearby
+        left_positions = self.left.positions(index)
+        if not left_positions:
+            return {}
+        return merge_positions(left_positions, self.right.positions(index), -self.distance, self.distance)
+
+    def cost(self, index):
+        return min(self.left.cost(index), self.right.cost(index))
+
+    def canonical(self):
+        return ('NEAR', self.distance, self.left.canonical(), self.right.canonical())
+
+
+class CorpusExpression:
+    """Corpus filter, i.e. `corpus:anna-karenina` - all paragraphs of the corpus"""
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'CorpusExpression({})'.format(self.name.__repr__())
+
+    def eval(self, index):
+        return index.corpus_bitmap(self.name)
+
+    def cost(self, index):
+        return len(index.corpora.get(self.name, ()))
+
+    def canonical(self):
+        return ('CORPUS', self.name)
 
 
 class BinopWordExpression:
@@ -32,9 +203,9 @@ class BinopWordExpression:
     def __repr__(self):
         return 'BinopWordExpression({operator}, {left}, {right})'.format(operator=self.op, left=self.left, right=self.right)
 
-    def eval(self):
-        left_value = self.left.eval()
-        right_value = self.right.eval()
+    def eval(self, index):
+        left_value = self.left.eval(index)
+        right_value = self.right.eval(index)
         if self.op == 'AND':
             value = left_value & right_value
         elif self.op == 'OR':
@@ -43,6 +214,19 @@ class BinopWordExpression:
             raise RuntimeError('Unknown operator: ' + self.op)
         return value
 
+    def canonical(self):
+        # flatten chains of the same operator, drop duplicates and sort the operands
+        operands = set()
+        for exp in (self.left, self.right):
+            form = exp.canonical()
+            if form[0] == self.op:
+                operands.update(form[1])
+            else:
+                operands.add(form)
+        if len(operands) == 1:
+            return operands.pop()
+        return (self.op, tuple(sorted(operands)))
+
 
 class NotWordExpression:
     """Represents NOT expression"""
@@ -52,7 +236,13 @@ class NotWordExpression:
     def __repr__(self):
         return 'NotWordExpression({})'.format(self.exp)
 
-    def eval(self):
-        all_par = set(Paragraph.objects.all())
-        exp_par = self.exp.eval()
-        return all_par - exp_par
+    def eval(self, index):
+        # complement against the bitmap of all paragraphs
+        return index.universe & ~self.exp.eval(index)
+
+    def canonical(self):
+        form = self.exp.canonical()
+        # double negation
+        if form[0] == 'NOT':
+            return form[1]
+        return ('NOT', form)
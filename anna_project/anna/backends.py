@@ -0,0 +1,381 @@
+# Search backends
+# A backend takes a parsed query (see ast.py) and returns matching paragraphs, their ids and counts.
+# Views use the backend selected by ANNA_SEARCH_BACKEND setting - a dotted path to one of the classes below:
+#   IndexBackend - in-memory inverted index of every process (see index.py), supports ranking
+#   SQLBackend   - the whole query is compiled into SQL and evaluated by the database (see sql.py)
+#   FTS5Backend  - SQLite FTS5 full-text table, queries are translated into FTS5 MATCH expressions
+#   ShardedBackend - an index per corpus, searched in parallel by a pool of worker processes (see shards.py)
+# benchmark.py runs all of them against the same query corpus.
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+from . import metrics
+from . import search
+from . import shards
+from . import sql
+from .batch import BatchEvaluator
+from .ast import (QueryError, WordExpression, PrefixWordExpression, PhraseExpression, NearWordExpression,
+                  BinopWordExpression, NotWordExpression)
+from .index import get_index
+from .indexing import current_generation, paragraph_tokens, uses_relation_table
+from .models import Word, Paragraph
+from .ranking import query_words
+from .sql import UnsupportedQuery
+
+
+class SearchBackend:
+    """
+    Base class of search backends
+    """
+    name = None
+
+    def __repr__(self):
+        return '{}()'.format(type(self).__name__)
+
+    def results(self, ast, prefetch=(0, 0), ranked=False):
+        """
+        Returns lazy sequence of Paragraph objects matching the AST, suitable for Paginator
+
+        prefetch: tuple (start, stop) - slice that is going to be requested, backends may fetch it along with the count
+        ranked: order paragraphs by relevance instead of ids
+        """
+        raise NotImplementedError
+
+    def count(self, ast):
+        """
+        Returns number of paragraphs matching the AST
+        """
+        raise NotImplementedError
+
+    def page(self, ast, start, stop):
+        """
+        Returns tuple (number of paragraphs matching the AST, list of ids of matching paragraphs from `start` to `stop`)
+        """
+        res = self.results(ast, (start, stop))
+        return len(res), [paragraph.id for paragraph in res[start:stop]]
+
+    def batch(self, asts, limit=None):
+        """
+        Evaluates a batch of ASTs
+
+        limit: max number of ids returned per AST, all of them if None
+        return: tuple (results, evaluated)
+            results: list of tuples (count, list of ids) in the order of ASTs, QueryError of ASTs that failed instead
+            evaluated: number of distinct subexpressions evaluated, None if the backend evaluates every AST
+                       on its own as here
+        """
+        results = []
+        for ast in asts:
+            try:
+                results.append(self.page(ast, 0, self.count(ast) if limit is None else limit))
+            except QueryError as e:
+                results.append(e)
+        return results, None
+
+    def stream(self, ast):
+        """
+        Returns paragraphs matching the AST to be streamed in the order of ids: an object with
+        stream(after, limit) and has_after(paragraph_id) methods, see search.SearchResults
+
+        Raises NotImplementedError if the backend can't continue results after a given id
+        """
+        raise NotImplementedError('Streaming is not supported by {} search'.format(self.name))
+
+    def query_words(self, ast):
+        """
+        Returns set of words of the query to highlight in snippets
+        """
+        raise NotImplementedError
+
+
+class IndexBackend(SearchBackend):
+    """
+    Evaluates queries against the in-memory inverted index of the process
+    """
+    name = 'index'
+
+    def _index(self):
+        with metrics.stage('index'):
+            return get_index()
+
+    def results(self, ast, prefetch=(0, 0), ranked=False):
+        return search.search(ast, self._index(), ranked=ranked)
+
+    def count(self, ast):
+        return search.count(ast, self._index())
+
+    def page(self, ast, start, stop):
+        res = search.search(ast, self._index())
+        return len(res), list(res.ids(start, stop))
+
+    def batch(self, asts, limit=None):
+        # subexpressions shared by ASTs are evaluated once, see batch.py
+        index = self._index()
+        evaluator = BatchEvaluator(index)
+        results = []
+        for ast in asts:
+            try:
+                res = search.SearchResults(evaluator.evaluate(ast), index)
+            except QueryError as e:
+                results.append(e)
+                continue
+            results.append((len(res), list(res.ids(0, limit))))
+        return results, evaluator.evaluated
+
+    def stream(self, ast):
+        return search.search(ast, self._index())
+
+    def query_words(self, ast):
+        return query_words(ast, self._index())
+
+
+class _WordTable:
+    """
+    Term dictionary read from the Word table, used to expand wildcards without an index
+    """
+    def words_with_prefix(self, prefix):
+        # one word past the limit is enough for PrefixWordExpression.words() to raise QueryError
+        max_terms = getattr(settings, 'ANNA_WILDCARD_MAX_TERMS', 1000)
+        # words of different corpora are separate rows
+        return list(Word.objects.filter(word__startswith=prefix).order_by('word')
+                    .values_list('word', flat=True).distinct()[:max_terms + 1])
+
+
+def check_wildcards(ast):
+    """
+    Raises QueryError for wildcards of the AST matching more than ANNA_WILDCARD_MAX_TERMS words, like the index does,
+    for backends that match prefixes in the database and never expand them
+    """
+    if isinstance(ast, PrefixWordExpression):
+        ast.words(_WordTable())
+    for child in ('left', 'right', 'exp'):
+        if hasattr(ast, child):
+            check_wildcards(getattr(ast, child))
+
+
+class SQLBackend(SearchBackend):
+    """
+    Compiles queries into a single SQL statement over the Word-Paragraph relation table, see sql.py
+    Phrases, NEAR and ranking are not supported.
+    """
+    name = 'sql'
+    # words are looked up in the relation table, which is filled only in 'table' storage mode
+    needs_relation_table = True
+
+    def __init__(self):
+        if self.needs_relation_table and not uses_relation_table():
+            raise ImproperlyConfigured('SQLBackend needs the relation table, set ANNA_POSTINGS_STORAGE to "table"')
+
+    def condition(self, ast):
+        """
+        Returns tuple (sql, params) - condition on paragraph `p` that holds for paragraphs matching the AST
+        """
+        check_wildcards(ast)
+        return sql.compile_condition(ast)
+
+    def results(self, ast, prefetch=(0, 0), ranked=False):
+        if ranked:
+            raise UnsupportedQuery('Ranking is not supported by {} search'.format(self.name))
+        condition, params = self.condition(ast)
+        return sql.SQLResults(condition, params, prefetch)
+
+    def count(self, ast):
+        return sql.count_matches(*self.condition(ast))
+
+    def stream(self, ast):
+        return sql.SQLResults(*self.condition(ast))
+
+    def query_words(self, ast):
+        return query_words(ast, _WordTable())
+
+
+def _fts_string(s):
+    return '"{}"'.format(s.replace('"', '""'))
+
+
+def _fts_word(word):
+    """
+    Returns FTS5 string of a query word, or of a prefix of one
+
+    FTS5 would split a string like `анна.` into words of its own and match `анна`, while the index and SQL
+    backends look it up as a whole and find nothing, so only words the tokenizer of the index keeps whole
+    are accepted.
+    """
+    if paragraph_tokens(word) != [word]:
+        raise UnsupportedQuery('"{}" is not a single word, it is not supported by fts5 search'.format(word))
+    return _fts_string(word)
+
+
+def _fts_near(ast):
+    """
+    Returns FTS5 NEAR expression of `a NEAR/k b`, raises UnsupportedQuery if FTS5 would answer it differently
+
+    The index matches tokens at most k positions apart in any order, FTS5 NEAR(a b, k - 1) matches two distinct
+    tokens with at most k - 1 tokens between them, so they agree for k >= 1 when no token can match both operands.
+    Operands of the index that match the same token (`анна NEAR/1 анна`, `анн* NEAR/1 анна`) are at distance 0,
+    distance to a phrase is measured from its first word, FTS5 has neither.
+    """
+    terms = []
+    for operand in (ast.left, ast.right):
+        if isinstance(operand, WordExpression):
+            terms.append((operand.i.lower(), False))
+        elif isinstance(operand, PhraseExpression) and len(operand.words) == 1:
+            terms.append((operand.words[0], False))
+        elif isinstance(operand, PrefixWordExpression):
+            terms.append((operand.prefix, True))
+        else:
+            raise UnsupportedQuery('Only words and wildcards can be operands of NEAR in fts5 search')
+    (left, left_prefix), (right, right_prefix) = terms
+    if ast.distance < 1:
+        raise UnsupportedQuery('NEAR/0 is not supported by fts5 search')
+    if left == right or left_prefix and right.startswith(left) or right_prefix and left.startswith(right):
+        raise UnsupportedQuery('NEAR of operands matching the same word is not supported by fts5 search')
+    operands = [_fts_word(term) + ' *' if prefix else _fts_word(term) for term, prefix in terms]
+    return 'NEAR({} {}, {})'.format(operands[0], operands[1], ast.distance - 1)
+
+
+def fts_query(ast):
+    """
+    Translates AST into an FTS5 MATCH expression
+
+    FTS5 has no unary NOT, only `a NOT b`, so negations are pushed up the tree instead:
+    the result is a tuple (positive, expression), paragraphs match the AST if they match the expression
+    and `positive` is True, or don't match it and `positive` is False.
+    NEAR/k becomes FTS5 NEAR with at most k - 1 tokens between its operands, see _fts_near().
+    """
+    if isinstance(ast, WordExpression):
+        return True, _fts_word(ast.i.lower())
+    if isinstance(ast, PrefixWordExpression):
+        return True, _fts_word(ast.prefix) + ' *'
+    if isinstance(ast, PhraseExpression):
+        return True, _fts_string(' '.join(ast.words))
+    if isinstance(ast, NearWordExpression):
+        return True, _fts_near(ast)
+    if isinstance(ast, NotWordExpression):
+        positive, exp = fts_query(ast.exp)
+        return not positive, exp
+    if isinstance(ast, BinopWordExpression):
+        left_positive, left = fts_query(ast.left)
+        right_positive, right = fts_query(ast.right)
+        if left_positive != right_positive:
+            positive, negative = (left, right) if left_positive else (right, left)
+            if ast.op == 'AND':
+                # a AND NOT b
+                return True, '({} NOT {})'.format(positive, negative)
+            # a OR NOT b = NOT ( b AND NOT a )
+            return False, '({} NOT {})'.format(negative, positive)
+        # both negative: NOT a AND NOT b = NOT ( a OR b ), NOT a OR NOT b = NOT ( a AND b )
+        op = ast.op if left_positive else {'AND': 'OR', 'OR': 'AND'}[ast.op]
+        return left_positive, '({} {} {})'.format(left, op, right)
+    raise UnsupportedQuery('{} is not supported by fts5 search'.format(ast))
+
+
+class FTS5Backend(SQLBackend):
+    """
+    Evaluates queries with SQLite FTS5 full-text table over Paragraph table, works only with SQLite
+
+    The FTS table is contentless, it's filled with paragraphs already split into words by the tokenizer of the index
+    (see indexing.py) and joined with spaces, so FTS5 sees exactly the same words, i.e. `по-моему` is a single one.
+    The table is created on first use and refilled when the index generation changes, which is checked
+    at most once in ANNA_INDEX_CHECK_INTERVAL seconds.
+    """
+    name = 'fts5'
+    needs_relation_table = False
+
+    table = 'anna_paragraph_fts'
+    state_table = 'anna_paragraph_fts_state'
+    # split on spaces only: words of the index are letters, digits, `_` and `-`
+    tokenize = "unicode61 remove_diacritics 0 tokenchars '-_'"
+
+    def __init__(self):
+        super().__init__()
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def ensure_table(self):
+        """
+        Creates the FTS table or rebuilds it if it's older than the index generation
+        """
+        interval = getattr(settings, 'ANNA_INDEX_CHECK_INTERVAL', 5)
+        if time.time() - self._checked < interval:
+            return
+        if connection.vendor != 'sqlite':
+            raise ImproperlyConfigured('FTS5Backend works only with SQLite')
+        with self._lock, connection.cursor() as cursor:
+            generation = current_generation()
+            qn = connection.ops.quote_name
+            cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(tokens, content=\'\', '
+                           'tokenize="{tokenize}")'.format(table=qn(self.table), tokenize=self.tokenize))
+            cursor.execute('CREATE TABLE IF NOT EXISTS {} (generation INTEGER NOT NULL)'.format(qn(self.state_table)))
+            cursor.execute('SELECT generation FROM {}'.format(qn(self.state_table)))
+            row = cursor.fetchone()
+            if row is None or row[0] != generation:
+                with transaction.atomic():
+                    cursor.execute("INSERT INTO {table}({table}) VALUES ('delete-all')".format(table=qn(self.table)))
+                    rows = ((paragraph_id, ' '.join(paragraph_tokens(text)))
+                            for paragraph_id, text in Paragraph.objects.filter(retired__isnull=True)
+                            .values_list('id', 'text').iterator())
+                    cursor.executemany('INSERT INTO {} (rowid, tokens) VALUES (%s, %s)'.format(qn(self.table)), rows)
+                    cursor.execute('DELETE FROM {}'.format(qn(self.state_table)))
+                    cursor.execute('INSERT INTO {} (generation) VALUES (%s)'.format(qn(self.state_table)), [generation])
+            self._checked = time.time()
+
+    def condition(self, ast):
+        self.ensure_table()
+        check_wildcards(ast)
+        positive, exp = fts_query(ast)
+        condition = 'p.id {} (SELECT rowid FROM {table} WHERE {table} MATCH %s)'.format(
+            'IN' if positive else 'NOT IN', table=connection.ops.quote_name(self.table))
+        return condition, [exp]
+
+
+class ShardedBackend(SearchBackend):
+    """
+    Evaluates queries against an index per corpus in ANNA_SHARD_WORKERS worker processes, see shards.py
+    """
+    name = 'sharded'
+
+    def __init__(self):
+        self.pool = shards.ShardPool(getattr(settings, 'ANNA_SHARD_WORKERS', 4))
+
+    def __repr__(self):
+        return 'ShardedBackend({})'.format(self.pool)
+
+    def results(self, ast, prefetch=(0, 0), ranked=False):
+        return shards.ShardedResults(self.pool, ast, prefetch, ranked)
+
+    def count(self, ast):
+        return self.pool.count(ast)
+
+    def page(self, ast, start, stop):
+        res = shards.ShardedResults(self.pool, ast, (start, stop))
+        return len(res), res.ids(start, stop)
+
+    def query_words(self, ast):
+        return query_words(ast, _WordTable())
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(path=None):
+    """
+    Returns instance of the backend class at dotted `path`, ANNA_SEARCH_BACKEND by default
+    Instances are created once per process.
+    """
+    if path is None:
+        path = getattr(settings, 'ANNA_SEARCH_BACKEND', 'anna.backends.IndexBackend')
+    backend = _backends.get(path)
+    if backend is None:
+        with _backends_lock:
+            backend = _backends.get(path)
+            if backend is None:
+                backend = _backends[path] = import_string(path)()
+    return backend
@@ -0,0 +1,113 @@
+# Evaluation of batches of queries with shared subexpressions
+# Queries of a batch are evaluated over their canonical forms (see ast.py), which are hash-consed:
+# equal subtrees of different queries have equal forms, so every distinct subexpression is evaluated once.
+# AND operands are intersected in a fixed order, rarest first, and every prefix of the chain is memoized too,
+# so `a AND b AND c` and `a AND b AND d` share the intersection of `a` and `b`.
+
+from .ast import BinopWordExpression, NotWordExpression
+from .cache import result_cache
+
+
+class BatchEvaluator:
+    """
+    Evaluates ASTs against `index`, remembering values of all subexpressions
+
+    Values of AND / OR / NOT are computed from canonical forms of their operands, leaves (words, wildcards,
+    phrases, NEAR) are evaluated by their AST nodes
+    """
+    def __init__(self, index):
+        self.index = index
+        self.values = {}
+        self.evaluated = 0
+        self._leaves = {}
+        self._costs = {}
+        # values of prefixes of AND chains, see _eval_and()
+        self._prefixes = {}
+
+    def __repr__(self):
+        return 'BatchEvaluator({n} subexpressions)'.format(n=len(self.values))
+
+    def evaluate(self, ast):
+        """
+        Returns bitmap of paragraphs matching the AST, top-level results go through the result cache
+        """
+        self._add_leaves(ast)
+        form = ast.canonical()
+        bitmap = result_cache.get(form, self.index.generation)
+        if bitmap is None:
+            bitmap = self._eval(form)
+            result_cache.put(form, self.index.generation, bitmap)
+        return bitmap
+
+    def _add_leaves(self, ast):
+        if isinstance(ast, BinopWordExpression):
+            self._add_leaves(ast.left)
+            self._add_leaves(ast.right)
+        elif isinstance(ast, NotWordExpression):
+            self._add_leaves(ast.exp)
+        else:
+            self._leaves.setdefault(ast.canonical(), ast)
+
+    def _cost(self, form):
+        """
+        Returns estimated number of paragraphs matching canonical form
+        """
+        cost = self._costs.get(form)
+        if cost is None:
+            n = len(self.index.paragraph_ids)
+            if form[0] == 'AND':
+                cost = min([self._cost(op) for op in form[1] if op[0] != 'NOT'], default=n)
+            elif form[0] == 'OR':
+                cost = min(sum(self._cost(op) for op in form[1]), n)
+            elif form[0] == 'NOT':
+                cost = n - self._cost(form[1])
+            else:
+                cost = self._leaves[form].cost(self.index)
+            self._costs[form] = cost
+        return cost
+
+    def _eval(self, form):
+        value = self.values.get(form)
+        if value is None:
+            if form[0] == 'AND':
+                value = self._eval_and(form[1])
+            elif form[0] == 'OR':
+                value = 0
+                for op in form[1]:
+                    value |= self._eval(op)
+            elif form[0] == 'NOT':
+                value = self.index.universe & ~self._eval(form[1])
+            else:
+                value = self._leaves[form].eval(self.index)
+            self.values[form] = value
+            self.evaluated += 1
+        return value
+
+    def _eval_and(self, operands):
+        # positives rarest first, negatives are subtracted after them; ties are broken by the form,
+        # so all queries of the batch put common operands in the same order
+        positives = sorted((op for op in operands if op[0] != 'NOT'), key=lambda op: (self._cost(op), op))
+        negatives = sorted((op[1] for op in operands if op[0] == 'NOT'), key=lambda op: (-self._cost(op), op))
+        chain = [(op, False) for op in positives] + [(op, True) for op in negatives]
+
+        value = self.index.universe
+        start = 0
+        for n in range(len(chain), 0, -1):
+            # longest already evaluated prefix of the chain
+            prefix_value = self._prefixes.get(tuple(chain[:n]))
+            if prefix_value is not None:
+                value, start = prefix_value, n
+                break
+        for i in range(start, len(chain)):
+            op, negated = chain[i]
+            # once the intersection is empty, the rest of operands are not evaluated
+            if value:
+                if negated:
+                    value &= ~self._eval(op)
+                elif i == 0:
+                    value = self._eval(op)
+                else:
+                    value &= self._eval(op)
+            self._prefixes[tuple(chain[:i + 1])] = value
+        return value
+
@@ -0,0 +1,68 @@
+# Cache of evaluated queries
+# Keys are canonical forms of ASTs (see ast.py), so `a AND b`, `b AND a` and `( a ) AND b` share one entry
+
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of query results
+
+    maxsize: max number of cached results, the least recently used one is evicted when it's exceeded
+    Cached results belong to an index generation, it's a part of the key: right after a new index is swapped in
+    (see IndexManager) requests still using the old one share the cache with new requests without evicting
+    their results, results of the old generation are evicted as they stop being used
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'ResultCache({size}/{maxsize}, hits={hits}, misses={misses})'.format(
+            size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, generation):
+        """
+        Returns cached result for `key` or None
+        """
+        with self._lock:
+            value = self._data.get((generation, key))
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end((generation, key))
+            return value
+
+    def put(self, key, generation, value):
+        """
+        Stores result for `key`, evicts the least recently used result if the cache is full
+        """
+        with self._lock:
+            self._data[generation, key] = value
+            self._data.move_to_end((generation, key))
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        Returns dict with cache counters
+        """
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+# results are bitmaps of matched paragraphs
+result_cache = ResultCache(getattr(settings, 'ANNA_RESULT_CACHE_SIZE', 1000))
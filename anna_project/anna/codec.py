@@ -0,0 +1,151 @@
+# Compact binary encoding of postings
+# Non-negative ints are stored as varints: 7 bits per byte, high bit set on all bytes but the last one.
+# Sorted sequences are delta encoded first, so small gaps between ids/positions take a single byte.
+
+from array import array
+
+
+def encode_varint(n, out):
+    """
+    Appends varint encoding of non-negative int `n` to bytearray `out`
+    """
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def decode_varints(data, count=None, pos=0):
+    """
+    Decodes varints from bytes-like `data` starting at `pos`
+
+    count: max number of ints to decode, all of them if None
+    return: tuple (list of ints, position after the last decoded byte)
+    """
+    res = []
+    n = shift = 0
+    end = len(data)
+    while pos < end and (count is None or len(res) < count):
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            res.append(n)
+            n = shift = 0
+    return res, pos
+
+
+def encode_sorted(numbers, out=None):
+    """
+    Delta + varint encodes a sorted sequence of non-negative ints, returns bytearray
+    """
+    out = bytearray() if out is None else out
+    prev = 0
+    for n in numbers:
+        encode_varint(n - prev, out)
+        prev = n
+    return out
+
+
+def decode_sorted(data, typecode='I'):
+    """
+    Decodes a sequence encoded by encode_sorted(), returns array
+    """
+    deltas, _ = decode_varints(data)
+    res = array(typecode)
+    prev = 0
+    for delta in deltas:
+        prev += delta
+        res.append(prev)
+    return res
+
+
+def encode_positional_postings(entries):
+    """
+    Encodes positional postings of a word
+
+    entries: iterable of tuples (paragraph_id, positions) sorted by paragraph id, positions are sorted
+             token positions of the word in the paragraph
+    return: bytes - for every entry: paragraph id delta, number of positions, delta encoded positions
+    """
+    out = bytearray()
+    prev_id = 0
+    for paragraph_id, positions in entries:
+        encode_varint(paragraph_id - prev_id, out)
+        encode_varint(len(positions), out)
+        encode_sorted(positions, out)
+        prev_id = paragraph_id
+    return bytes(out)
+
+
+def decode_positional_postings(data):
+    """
+    Decodes positional postings encoded by encode_positional_postings()
+
+    return: list of tuples (paragraph_id, positions array)
+    """
+    numbers, _ = decode_varints(data)
+    res = []
+    paragraph_id = 0
+    i = 0
+    while i < len(numbers):
+        paragraph_id += numbers[i]
+        count = numbers[i + 1]
+        i += 2
+        positions = array('I')
+        pos = 0
+        for delta in numbers[i:i + count]:
+            pos += delta
+            positions.append(pos)
+        i += count
+        res.append((paragraph_id, positions))
+    return res
+
+
+def rebase_positional_postings(data, prev_id):
+    """
+    Re-encodes positional postings `data` to follow postings whose last paragraph id is `prev_id`,
+    so both can be concatenated; only the first paragraph id delta is re-encoded
+
+    prev_id: must be smaller than the first paragraph id of `data`
+    return: bytes
+    """
+    if not data:
+        return b''
+    (first_id,), pos = decode_varints(data, 1)
+    out = bytearray()
+    encode_varint(first_id - prev_id, out)
+    out += data[pos:]
+    return bytes(out)
+
+
+def encode_spans(spans):
+    """
+    Encodes sorted non-overlapping spans, i.e. char offsets of tokens in a paragraph
+
+    spans: iterable of tuples (start, end)
+    return: bytes - for every span: distance from the end of the previous span, length of the span
+    """
+    out = bytearray()
+    prev_end = 0
+    for start, end in spans:
+        encode_varint(start - prev_end, out)
+        encode_varint(end - start, out)
+        prev_end = end
+    return bytes(out)
+
+
+def decode_spans(data):
+    """
+    Decodes spans encoded by encode_spans(), returns list of tuples (start, end)
+    """
+    numbers, _ = decode_varints(data)
+    spans = []
+    end = 0
+    for i in range(0, len(numbers) - 1, 2):
+        start = end + numbers[i]
+        end = start + numbers[i + 1]
+        spans.append((start, end))
+    return spans
@@ -15,6 +15,16 @@ class Result:
         return 'Result({val}, {pos})'.format(val=self.value, pos=self.pos)
 
 
+class TokenList(list):
+    """
+    List of tokens with a memo table for packrat parsing (see Memo)
+    memo: dict mapping (parser, pos) to the result of applying the parser at that position
+    """
+    def __init__(self, tokens):
+        super().__init__(tokens)
+        self.memo = {}
+
+
 class Parser:
     """
     Every parser will be a subclass of Parser and will override __call__()
@@ -123,23 +133,19 @@ class Exp(Parser):
     def __init__(self, parser, separator):
         self.parser = parser
         self.separator = separator
+        # applies `separator` first, followed by `parser`
+        self.next_parser = separator + parser
 
     def __call__(self, tokens, pos):
         # result stores what's been parsed so far
         result = self.parser(tokens, pos)
 
-        def process_next(parsed):
-            (sepfunc, right) = parsed
-            return sepfunc(result.value, right)
-
-        # applies `separator` first, followed by `parser`
-        next_parser = self.separator + self.parser ^ process_next
-
-        next_result = result
-        while next_result:
-            next_result = next_parser(tokens, result.pos)
-            if next_result:
-                result = next_result
+        while result:
+            next_result = self.next_parser(tokens, result.pos)
+            if not next_result:
+                break
+            (sepfunc, right) = next_result.value
+            result = Result(sepfunc(result.value, right), next_result.pos)
         return result
 
 
@@ -156,8 +162,8 @@ class Process(Parser):
     def __call__(self, tokens, pos):
         result = self.parser(tokens, pos)
         if result:
-            result.value = self.function(result.value)
-            return result
+            # new Result, the original one may be memoized
+            return Result(self.function(result.value), result.pos)
 
 
 class Lazy(Parser):
@@ -174,3 +180,23 @@ class Lazy(Parser):
         if not self.parser:
             self.parser = self.parser_func()
         return self.parser(tokens, pos)
+
+
+class Memo(Parser):
+    """
+    Packrat memoization
+    Remembers the result of applying the wrapped parser at every position of a TokenList,
+    so backtracking in Alternate doesn't parse the same span of tokens twice.
+    Plain lists of tokens are parsed without memoization.
+    """
+    def __init__(self, parser):
+        self.parser = parser
+
+    def __call__(self, tokens, pos):
+        memo = getattr(tokens, 'memo', None)
+        if memo is None:
+            return self.parser(tokens, pos)
+        key = (self, pos)
+        if key not in memo:
+            memo[key] = self.parser(tokens, pos)
+        return memo[key]
@@ -0,0 +1,438 @@
+# In-memory inverted index used to evaluate search queries
+# Loaded from the database once per worker process, so evaluating a query doesn't hit the DB at all
+# The index covers all corpora or a single one - a shard (see shards.py).
+# An index is a snapshot of one generation of the tables: when they change, a new index is loaded
+# in the background and swapped in, requests in progress finish with the index they started with.
+#
+# Sets of paragraphs are represented as bitmaps - plain python ints, where bit `i` is set
+# if the i-th paragraph of the index (its rank in the sorted ids) is in the set. AND, OR and NOT are then just
+# `&`, `|` and a complement against the universe bitmap, all done in C over machine words.
+# Ids are packed into ranks, so bitmaps stay proportional to the number of indexed paragraphs however sparse
+# the ids are: ids are never reused (see indexing.allocate_ids()), repopulated corpora get ids after all others.
+
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from itertools import chain
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from .codec import decode_positional_postings, decode_sorted, encode_positional_postings, rebase_positional_postings
+from .models import Corpus, Word, Paragraph
+from .indexing import current_generation
+
+
+logger = logging.getLogger(__name__)
+
+# typecode for arrays of paragraph ids - unsigned int, 4 bytes
+ID_TYPECODE = 'I'
+
+# _BITS[b] - positions of set bits in byte b, used to turn bitmaps back into ids
+_BITS = tuple(tuple(bit for bit in range(8) if b >> bit & 1) for b in range(256))
+
+
+def popcount(bitmap):
+    """
+    Returns number of set bits in a bitmap, i.e. number of paragraphs in it
+    """
+    return bin(bitmap).count('1')
+
+
+def id_runs(paragraph_ids):
+    """
+    Splits sorted paragraph ids into runs of consecutive ids, used to map ids to their ranks
+
+    return: tuple (array of first ids of the runs, array of ranks of first ids of the runs followed by
+            the number of ids), run `i` maps ids from starts[i] to ranks[i]..ranks[i + 1] - 1
+    """
+    starts = array(ID_TYPECODE)
+    ranks = array(ID_TYPECODE)
+    prev = None
+    for rank, paragraph_id in enumerate(paragraph_ids):
+        if prev is None or paragraph_id != prev + 1:
+            starts.append(paragraph_id)
+            ranks.append(rank)
+        prev = paragraph_id
+    ranks.append(len(paragraph_ids))
+    return starts, ranks
+
+
+def merge_corpus_postings(parts):
+    """
+    Merges postings of a word from several corpora
+
+    parts: list of tuples (sorted array of paragraph ids, encoded positional postings), one per corpus
+    return: tuple (sorted array of paragraph ids, encoded positional postings)
+    Corpora populated from files occupy separate ranges of ids, then positional postings are just concatenated,
+    otherwise they are decoded and merged
+    """
+    parts = sorted(parts, key=lambda part: part[0][0])
+    postings = array(ID_TYPECODE)
+    if all(prev[0][-1] < part[0][0] for prev, part in zip(parts, parts[1:])):
+        positions = bytearray()
+        for part_postings, part_positions in parts:
+            positions += rebase_positional_postings(part_positions, postings[-1] if postings else 0)
+            postings.extend(part_postings)
+        return postings, bytes(positions)
+    entries = sorted(chain.from_iterable(decode_positional_postings(part_positions) for _, part_positions in parts),
+                     key=lambda entry: entry[0])
+    postings.extend(paragraph_id for paragraph_id, _ in entries)
+    return postings, encode_positional_postings(entries)
+
+
+class InvertedIndex:
+    """
+    Inverted index over paragraphs
+
+    postings: dict, maps a (lowercased) word to a sorted array of ids of paragraphs containing that word
+    paragraph_ids: sorted array of ids of all paragraphs
+    generation: index generation (see IndexGeneration model) the index was built from
+    positions: dict, maps a word to its encoded positional postings (see codec.py), decoded on demand
+    lengths: array of numbers of tokens in paragraphs, in the order of paragraph_ids
+    corpora: dict, maps a corpus name to a sorted array of ids of its paragraphs
+    Bit `i` of bitmaps of the index is paragraph_ids[i], see to_bitmap().
+    """
+    def __init__(self, postings, paragraph_ids, generation=0, positions=None, lengths=None, corpora=None):
+        self._postings = postings
+        self.paragraph_ids = paragraph_ids
+        self.generation = generation
+        self._positions = positions or {}
+        self.corpora = corpora or {}
+        # sorted term dictionary for prefix range scans
+        self.words = sorted(postings)
+
+        # bit numbers are ranks of paragraphs
+        self.width = len(paragraph_ids)
+        self._run_starts, self._run_ranks = id_runs(paragraph_ids)
+        self.universe = (1 << self.width) - 1
+
+        # paragraph lengths are indexed by rank
+        self._lengths = array(ID_TYPECODE, lengths or bytes(self.width * array(ID_TYPECODE).itemsize))
+        self.avg_length = sum(self._lengths) / len(paragraph_ids) if paragraph_ids else 0
+
+        # bitmaps of frequent words and of corpora are cached, for them a bitmap is smaller than the postings array
+        self._bitmaps = {}
+        self._dense_df = max(self.width // (8 * array(ID_TYPECODE).itemsize), 1)
+
+    def __repr__(self):
+        return 'InvertedIndex({terms} terms, {pars} paragraphs, generation {gen})'.format(
+            terms=len(self._postings), pars=len(self.paragraph_ids), gen=self.generation)
+
+    def __len__(self):
+        return len(self._postings)
+
+    def __contains__(self, word):
+        return word in self._postings
+
+    def postings(self, word):
+        """
+        Returns sorted array of ids of paragraphs containing `word`, empty array if there are none
+        """
+        return self._postings.get(word, array(ID_TYPECODE))
+
+    def df(self, word):
+        """
+        Returns document frequency of `word`, i.e. number of paragraphs containing it
+        """
+        return len(self.postings(word))
+
+    def rank(self, paragraph_id):
+        """
+        Returns number of the bit of a paragraph in bitmaps, i.e. number of paragraphs with smaller ids
+        """
+        return bisect_left(self.paragraph_ids, paragraph_id)
+
+    def length(self, paragraph_id):
+        """
+        Returns number of tokens in a paragraph
+        """
+        return self._lengths[self.rank(paragraph_id)]
+
+    def words_with_prefix(self, prefix):
+        """
+        Returns sorted list of words starting with `prefix`, found with a range scan of the sorted term dictionary
+        """
+        lo = bisect_left(self.words, prefix)
+        hi = bisect_left(self.words, prefix + '\U0010ffff', lo)
+        return self.words[lo:hi]
+
+    def bitmap(self, word):
+        """
+        Returns bitmap of paragraphs containing `word`
+        """
+        bitmap = self._bitmaps.get(word)
+        if bitmap is None:
+            postings = self.postings(word)
+            bitmap = self.to_bitmap(postings)
+            if len(postings) >= self._dense_df:
+                self._bitmaps[word] = bitmap
+        return bitmap
+
+    def corpus_bitmap(self, name):
+        """
+        Returns bitmap of paragraphs of the corpus with `name`
+        """
+        key = ('corpus', name)
+        bitmap = self._bitmaps.get(key)
+        if bitmap is None:
+            bitmap = self._bitmaps[key] = self.to_bitmap(self.corpora.get(name, ()))
+        return bitmap
+
+    def ids(self, bitmap, start=0, stop=None, after=None):
+        """
+        Returns sorted array of paragraph ids from a bitmap
+
+        start, stop: if given, only ids from this slice of the sorted ids are extracted,
+                     so memory needed doesn't depend on the number of paragraphs in the bitmap
+        after: if given, only ids greater than `after` are considered, `start` and `stop` count from the first of them;
+               bytes of the bitmap before `after` are not scanned at all
+        """
+        res = array(ID_TYPECODE)
+        if stop is not None and stop <= start:
+            return res
+        skipped = 0
+        if after is not None:
+            # drop bits up to `after`, keeping the rest aligned to whole bytes
+            n_bits = bisect_right(self.paragraph_ids, after)
+            skipped = n_bits >> 3
+            bitmap = bitmap >> n_bits << (n_bits & 7)
+        data = bitmap.to_bytes((bitmap.bit_length() + 7) >> 3, 'little')
+        paragraph_ids = self.paragraph_ids
+        n = 0
+        for byte_no, byte in enumerate(data, skipped):
+            if byte:
+                bits = _BITS[byte]
+                if n + len(bits) > start:
+                    offset = byte_no << 3
+                    res.extend(paragraph_ids[offset + bit] for bit in bits[max(start - n, 0):])
+                n += len(bits)
+                if stop is not None and n >= stop:
+                    del res[stop - start:]
+                    break
+        return res
+
+    def positions(self, word):
+        """
+        Returns dict mapping ids of paragraphs containing `word` to sorted arrays of its token positions there
+        """
+        return dict(decode_positional_postings(self.encoded_positions(word)))
+
+    def encoded_positions(self, word):
+        """
+        Returns positional postings of `word` as stored in Word.positions, empty bytes if there are none
+        """
+        return self._positions.get(word, b'')
+
+    def to_bitmap(self, ids):
+        """
+        Builds a bitmap from an iterable of paragraph ids, ids that are not in the index are skipped
+
+        An id is mapped to its rank by the run of consecutive ids it's in (see id_runs()), sorted ids mostly
+        fall into the run of the previous one, so runs are looked up only when one ends.
+        """
+        buf = bytearray((self.width + 7) >> 3)
+        starts, ranks = self._run_starts, self._run_ranks
+        # ids from `lo` to `hi` - 1 are in the current run, rank of an id there is id - shift
+        lo = hi = shift = 0
+        for i in ids:
+            if not lo <= i < hi:
+                run = bisect_right(starts, i) - 1
+                if run < 0:
+                    continue
+                lo = starts[run]
+                hi = lo + ranks[run + 1] - ranks[run]
+                shift = lo - ranks[run]
+                if i >= hi:
+                    continue
+            i -= shift
+            buf[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(buf, 'little')
+
+    @classmethod
+    def from_db(cls, corpus_id=None):
+        """
+        Builds the index from Word and Paragraph tables
+
+        Postings are decoded from Word.postings blobs, one row per word and corpus, no Paragraph objects are created
+        corpus_id: if given, the index of this corpus only is built, rows of other corpora are not read
+        """
+        # generation is read first: if tables change while we read them, the index
+        # is just considered stale and gets rebuilt one more time
+        generation = current_generation()
+        words = Word.objects.all()
+        paragraphs = Paragraph.objects.filter(retired__isnull=True)
+        corpora = Corpus.objects.all()
+        if corpus_id is not None:
+            words = words.filter(corpus_id=corpus_id)
+            paragraphs = paragraphs.filter(corpus_id=corpus_id)
+            corpora = corpora.filter(id=corpus_id)
+
+        postings = {}
+        positions = {}
+        # words of several corpora: word -> list of (postings, positions) of every corpus
+        parts = {}
+        for word, word_postings, word_positions in words.values_list('word', 'postings', 'positions').iterator():
+            if not word_postings:
+                continue
+            part = (decode_sorted(bytes(word_postings), ID_TYPECODE), bytes(word_positions))
+            if word in postings:
+                parts.setdefault(word, [(postings[word], positions[word])]).append(part)
+            else:
+                postings[word], positions[word] = part
+        for word, word_parts in parts.items():
+            postings[word], positions[word] = merge_corpus_postings(word_parts)
+
+        names = dict(corpora.values_list('id', 'name'))
+        paragraph_ids = array(ID_TYPECODE)
+        lengths = array(ID_TYPECODE)
+        corpus_ids = {name: array(ID_TYPECODE) for name in names.values()}
+        rows = paragraphs.order_by('id').values_list('id', 'length', 'corpus_id')
+        for paragraph_id, length, paragraph_corpus_id in rows.iterator():
+            paragraph_ids.append(paragraph_id)
+            lengths.append(length)
+            corpus_ids[names[paragraph_corpus_id]].append(paragraph_id)
+        return cls(postings, paragraph_ids, generation, positions, lengths, corpus_ids)
+
+
+def load_index():
+    """
+    Loads the index of the current generation
+
+    Index file at ANNA_INDEX_FILE is mapped if it's up to date, otherwise the index is built from the DB,
+    i.e. after incremental updates until populate.py writes the file again
+    """
+    path = getattr(settings, 'ANNA_INDEX_FILE', None)
+    if path and os.path.exists(path):
+        # imported here, indexfile depends on this module
+        from .indexfile import MappedIndex, IndexFileError
+        try:
+            index = MappedIndex(path)
+        except IndexFileError:
+            # i.e. a file of an older format, it's replaced on the next populate
+            index = None
+        if index is not None and index.generation == current_generation():
+            return index
+    return InvertedIndex.from_db()
+
+
+class IndexManager:
+    """
+    Holds the current index snapshot of the process and swaps in a newer one when it's loaded
+
+    A snapshot is any object with a `generation` attribute returned by `loader()`, i.e. an index, it's never
+    changed after loading. The first snapshot is loaded on the first get(), later ones are loaded by a background
+    thread started by refresh(), while requests are still served from the current snapshot; when loading finishes,
+    the snapshot is replaced with a single assignment. Requests that got the old snapshot keep using it,
+    it's freed when the last of them is done.
+
+    A thread can pin a snapshot with pinned(): the snapshot returned by the first get() in the block is returned
+    to that thread until the block ends, so all stages of a request see the same generation. Nothing is loaded
+    by pinning alone, so requests that don't use the index don't load it.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.swaps = 0
+        self._snapshot = None
+        self._loading = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __repr__(self):
+        return 'IndexManager({snapshot}, {swaps} swaps)'.format(snapshot=self._snapshot, swaps=self.swaps)
+
+    @property
+    def loaded(self):
+        """
+        True if the first snapshot was loaded
+        """
+        return self._snapshot is not None
+
+    def get(self):
+        """
+        Returns snapshot pinned by the current thread or the current snapshot, the first one is loaded right away
+        """
+        snapshot = getattr(self._local, 'snapshot', None)
+        if snapshot is not None:
+            return snapshot
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self.loader()
+                snapshot = self._snapshot
+        if getattr(self._local, 'pinning', False):
+            self._local.snapshot = snapshot
+        return snapshot
+
+    def refresh(self, generation):
+        """
+        Starts loading a new snapshot in the background if the current one is not of `generation`,
+        does nothing if one is already being loaded
+        """
+        with self._lock:
+            if self._snapshot is None or self._loading or self._snapshot.generation == generation:
+                return
+            self._loading = True
+        threading.Thread(target=self._load, name='anna-index-loader', daemon=True).start()
+
+    def _load(self):
+        try:
+            self.swap(self.loader())
+        except Exception:
+            logger.exception('Loading of the index failed, the current one is kept')
+        finally:
+            self._loading = False
+            # the thread's own DB connections
+            connections.close_all()
+
+    def swap(self, snapshot):
+        """
+        Makes `snapshot` the current one
+        """
+        with self._lock:
+            self._snapshot = snapshot
+            self.swaps += 1
+
+    @contextmanager
+    def pinned(self):
+        """
+        Pins the snapshot first got by the current thread in the enclosed code to the thread until the block ends
+        Blocks can be nested, an inner block keeps the snapshot pinned by the outer one.
+        """
+        previous = getattr(self._local, 'pinning', False), getattr(self._local, 'snapshot', None)
+        self._local.pinning = True
+        try:
+            yield
+        finally:
+            self._local.pinning, self._local.snapshot = previous
+
+
+index_manager = IndexManager(load_index)
+
+_index_checked = 0
+_check_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Returns the index snapshot of the current thread or process (see IndexManager), loads it on first call
+
+    Index generation in the DB is checked at most once in ANNA_INDEX_CHECK_INTERVAL seconds, a new index
+    is loaded in the background if the tables were changed since the current one was built
+    """
+    global _index_checked
+    interval = getattr(settings, 'ANNA_INDEX_CHECK_INTERVAL', 5)
+    # requests never wait for each other: if another thread is checking, the current snapshot is returned
+    if time.time() - _index_checked >= interval and _check_lock.acquire(blocking=False):
+        try:
+            if time.time() - _index_checked >= interval:
+                index_manager.refresh(current_generation())
+                _index_checked = time.time()
+        finally:
+            _check_lock.release()
+    return index_manager.get()
@@ -0,0 +1,217 @@
+# Binary on-disk format of the inverted index, written by populate.py and mmap-ed by search processes
+# Processes map the same file, so its pages are loaded once and shared through the OS page cache.
+# Nothing is decoded on open: postings of a word are decoded when a query touches it.
+#
+# Layout: header, then sections, each aligned to 8 bytes:
+#   paragraph_ids     - uint32 ids of all paragraphs, sorted
+#   lengths           - uint32 numbers of tokens in paragraphs, in the order of paragraph_ids
+#   run_starts        - uint32 first ids of runs of consecutive paragraph ids (see index.id_runs())
+#   run_ranks         - uint32 ranks of first ids of the runs, followed by the number of paragraphs
+#   term_offsets      - uint64 offsets of terms in `terms`, n_terms + 1 of them
+#   terms             - utf-8 encoded words, sorted
+#   dfs               - uint32 document frequencies of terms
+#   postings_offsets  - uint64 offsets of postings of terms in `postings`, n_terms + 1 of them
+#   postings          - delta + varint encoded paragraph ids of every term (see codec.encode_sorted())
+#   positions_offsets - uint64 offsets of positional postings of terms in `positions`, n_terms + 1 of them
+#   positions         - positional postings of every term (see codec.encode_positional_postings())
+#   corpus_names      - utf-8 encoded names of corpora, separated by newlines
+#   corpus_offsets    - uint64 offsets of ids of paragraphs of every corpus in `corpus_ids`, n_corpora + 1 of them
+#   corpus_ids        - uint32 ids of paragraphs of every corpus, sorted
+# Fixed width ints are in native byte order, the file is only meant to be read on the machine that wrote it.
+
+from array import array
+from bisect import bisect_left
+from collections.abc import Sequence
+import mmap
+import os
+import struct
+import sys
+
+from .codec import encode_sorted, decode_sorted
+from .index import ID_TYPECODE, InvertedIndex, id_runs
+
+
+MAGIC = b'ANNAIDX3'
+
+SECTIONS = ('paragraph_ids', 'lengths', 'run_starts', 'run_ranks', 'term_offsets', 'terms', 'dfs',
+            'postings_offsets', 'postings', 'positions_offsets', 'positions',
+            'corpus_names', 'corpus_offsets', 'corpus_ids')
+
+# magic, byte order, generation, number of terms, number of paragraphs, total number of tokens,
+# then (offset, size) of every section
+HEADER = struct.Struct('<8s8sQQQQ' + 'QQ' * len(SECTIONS))
+
+OFFSET_TYPECODE = 'Q'
+
+
+class IndexFileError(Exception):
+    """
+    Raised when an index file is corrupt or was written on a machine with a different byte order
+    """
+    pass
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def write_index_file(path, index):
+    """
+    Writes `index` (an InvertedIndex) to a binary index file at `path`
+
+    The file is written next to `path` and renamed over it, so processes that have the old file mapped
+    keep reading it until they reopen the index
+    """
+    words = index.words
+    lengths = array(ID_TYPECODE, (index.length(paragraph_id) for paragraph_id in index.paragraph_ids))
+    run_starts, run_ranks = id_runs(index.paragraph_ids)
+
+    terms = bytearray()
+    term_offsets = array(OFFSET_TYPECODE, [0])
+    dfs = array(ID_TYPECODE)
+    postings = bytearray()
+    postings_offsets = array(OFFSET_TYPECODE, [0])
+    positions = bytearray()
+    positions_offsets = array(OFFSET_TYPECODE, [0])
+    for word in words:
+        terms += word.encode('utf-8')
+        term_offsets.append(len(terms))
+        word_postings = index.postings(word)
+        dfs.append(len(word_postings))
+        encode_sorted(word_postings, postings)
+        postings_offsets.append(len(postings))
+        positions += index.encoded_positions(word)
+        positions_offsets.append(len(positions))
+
+    corpus_names = sorted(index.corpora)
+    corpus_offsets = array(OFFSET_TYPECODE, [0])
+    corpus_ids = array(ID_TYPECODE)
+    for name in corpus_names:
+        corpus_ids.extend(index.corpora[name])
+        corpus_offsets.append(len(corpus_ids))
+
+    sections = [array(ID_TYPECODE, index.paragraph_ids).tobytes(), lengths.tobytes(),
+                run_starts.tobytes(), run_ranks.tobytes(),
+                term_offsets.tobytes(), bytes(terms), dfs.tobytes(),
+                postings_offsets.tobytes(), bytes(postings), positions_offsets.tobytes(), bytes(positions),
+                '\n'.join(corpus_names).encode('utf-8'), corpus_offsets.tobytes(), corpus_ids.tobytes()]
+
+    layout = []
+    offset = _align(HEADER.size)
+    for data in sections:
+        layout.extend((offset, len(data)))
+        offset = _align(offset + len(data))
+    header = HEADER.pack(MAGIC, sys.byteorder.encode('ascii'), index.generation, len(words),
+                         len(index.paragraph_ids), sum(lengths), *layout)
+
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        for data, data_offset in zip(sections, layout[::2]):
+            f.write(bytes(data_offset - f.tell()))
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+class _Terms(Sequence):
+    """
+    Sorted term dictionary of an index file, terms are decoded on access so it can be bisected without loading
+    """
+    def __init__(self, offsets, data):
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return str(self._data[self._offsets[i]:self._offsets[i + 1]], 'utf-8')
+
+
+class MappedIndex(InvertedIndex):
+    """
+    Inverted index backed by a memory-mapped index file, has the same interface as InvertedIndex
+
+    path: path to a file written by write_index_file()
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            # the mapping stays valid after the file is closed or replaced
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+        if len(buf) < HEADER.size:
+            raise IndexFileError('{} is not an index file'.format(path))
+        magic, byteorder, generation, n_terms, n_paragraphs, total_length, *layout = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise IndexFileError('{} is not an index file'.format(path))
+        if byteorder.rstrip(b'\0') != sys.byteorder.encode('ascii'):
+            raise IndexFileError('{} was written on a machine with a different byte order'.format(path))
+        if any(offset + size > len(buf) for offset, size in zip(layout[::2], layout[1::2])):
+            raise IndexFileError('{} is truncated'.format(path))
+        section = {name: buf[offset:offset + size]
+                   for name, offset, size in zip(SECTIONS, layout[::2], layout[1::2])}
+
+        self.path = path
+        self.generation = generation
+        self.paragraph_ids = section['paragraph_ids'].cast(ID_TYPECODE)
+        self.words = _Terms(section['term_offsets'].cast(OFFSET_TYPECODE), section['terms'])
+        self._dfs = section['dfs'].cast(ID_TYPECODE)
+        self._postings_offsets = section['postings_offsets'].cast(OFFSET_TYPECODE)
+        self._postings_data = section['postings']
+        self._positions_offsets = section['positions_offsets'].cast(OFFSET_TYPECODE)
+        self._positions_data = section['positions']
+        corpus_offsets = section['corpus_offsets'].cast(OFFSET_TYPECODE)
+        corpus_ids = section['corpus_ids'].cast(ID_TYPECODE)
+        corpus_names = str(section['corpus_names'], 'utf-8').split('\n') if len(corpus_offsets) > 1 else []
+        self.corpora = {name: corpus_ids[corpus_offsets[i]:corpus_offsets[i + 1]]
+                        for i, name in enumerate(corpus_names)}
+
+        self.width = n_paragraphs
+        self._run_starts = section['run_starts'].cast(ID_TYPECODE)
+        self._run_ranks = section['run_ranks'].cast(ID_TYPECODE)
+        self.universe = (1 << self.width) - 1
+        self._lengths = section['lengths'].cast(ID_TYPECODE)
+        self.avg_length = total_length / n_paragraphs if n_paragraphs else 0
+
+        self._bitmaps = {}
+        self._dense_df = max(self.width // (8 * array(ID_TYPECODE).itemsize), 1)
+
+    def __repr__(self):
+        return 'MappedIndex({path}, {terms} terms, {pars} paragraphs, generation {gen})'.format(
+            path=self.path, terms=len(self.words), pars=len(self.paragraph_ids), gen=self.generation)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return self._find(word) is not None
+
+    def _find(self, word):
+        """
+        Returns number of `word` in the term dictionary, None if it's not there
+        """
+        i = bisect_left(self.words, word)
+        if i < len(self.words) and self.words[i] == word:
+            return i
+        return None
+
+    def postings(self, word):
+        i = self._find(word)
+        if i is None:
+            return array(ID_TYPECODE)
+        return decode_sorted(self._postings_data[self._postings_offsets[i]:self._postings_offsets[i + 1]],
+                             ID_TYPECODE)
+
+    def df(self, word):
+        i = self._find(word)
+        return 0 if i is None else self._dfs[i]
+
+    def encoded_positions(self, word):
+        i = self._find(word)
+        if i is None:
+            return b''
+        return self._positions_data[self._positions_offsets[i]:self._positions_offsets[i + 1]]
@@ -0,0 +1,298 @@
+# Functions that change the contents of Word and Paragraph tables
+# Paragraphs can be added, updated and deleted one by one, only postings of affected words are touched.
+# Every paragraph belongs to a corpus, words are looked up and created among the words of its corpus only.
+# Removed paragraphs are retired rather than deleted: processes keep serving requests from their old index
+# until a new one is loaded, and those requests still fetch the old paragraphs by id. Retired rows are deleted
+# once they are older than ANNA_RETIRED_TTL seconds.
+# Every change increments the index generation, so processes holding an in-memory index know it's stale.
+#
+# Postings of a word are always stored in Word.postings and Word.df, the Word-Paragraph relation table
+# is filled only in 'table' storage mode (see ANNA_POSTINGS_STORAGE setting), i.e. for SQL search.
+
+import re
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .codec import encode_positional_postings, decode_positional_postings, encode_sorted, encode_spans
+from .models import Corpus, Word, Paragraph, IndexGeneration
+
+
+# regex to get words from the string
+reg_obj = re.compile(r'\w+\-\w+|\w+')
+
+# corpus of paragraphs added without naming one
+DEFAULT_CORPUS = 'default'
+
+
+def paragraph_tokens(text):
+    """
+    Returns list of lowercased words of a paragraph, token position of a word is its index in the list
+    """
+    return [w.lower() for w in reg_obj.findall(text)]
+
+
+def paragraph_scan(text):
+    """
+    Tokenizes a paragraph once for everything the index stores about it
+
+    return: tuple (positions, spans)
+        positions: OrderedDict mapping every word of a paragraph to the list of its token positions,
+                   words are in the order of their first occurrence
+        spans: list of tuples (start, end) - char offsets of words, in the order of token positions
+    """
+    positions = OrderedDict()
+    spans = []
+    for pos, match in enumerate(reg_obj.finditer(text)):
+        word = match.group().lower()
+        if word in positions:
+            positions[word].append(pos)
+        else:
+            positions[word] = [pos]
+        spans.append(match.span())
+    return positions, spans
+
+
+def paragraph_positions(text):
+    """
+    Returns OrderedDict mapping every word of a paragraph to the list of its token positions,
+    words are in the order of their first occurrence
+    """
+    return paragraph_scan(text)[0]
+
+
+def paragraph_offsets(text):
+    """
+    Returns list of tuples (start, end) - char offsets of words of a paragraph, in the order of token positions
+    """
+    return [m.span() for m in reg_obj.finditer(text)]
+
+
+def paragraph_words(text):
+    """
+    Returns list of unique lowercased words of a paragraph, in the order of their first occurrence
+    """
+    return list(paragraph_positions(text))
+
+
+def uses_relation_table():
+    """
+    Returns True if postings are also stored as rows of the Word-Paragraph relation table
+    """
+    storage = getattr(settings, 'ANNA_POSTINGS_STORAGE', 'table')
+    if storage not in ('table', 'blob'):
+        raise ValueError('Unknown ANNA_POSTINGS_STORAGE: {}'.format(storage))
+    return storage == 'table'
+
+
+def current_generation():
+    """
+    Returns current index generation, 0 if the index was never populated
+    """
+    return IndexGeneration.objects.values_list('generation', flat=True).first() or 0
+
+
+def bump_generation():
+    """
+    Increments index generation, should be called within the transaction that changes the tables
+    """
+    if not IndexGeneration.objects.filter(pk=1).update(generation=F('generation') + 1):
+        IndexGeneration.objects.create(pk=1, generation=1)
+
+
+def get_corpus_id(name=DEFAULT_CORPUS):
+    """
+    Returns id of the corpus with `name`, the corpus is created if it doesn't exist
+    """
+    return Corpus.objects.get_or_create(name=name)[0].id
+
+
+# fields of IndexGeneration with ids of the next rows of a model
+ID_COUNTERS = {Paragraph: 'next_paragraph_id', Word: 'next_word_id'}
+
+
+def allocate_ids(model, n):
+    """
+    Reserves `n` consecutive ids for new rows of `model` (Paragraph or Word), returns the first of them
+
+    Ids are taken from a counter of the IndexGeneration row, which stays locked until the transaction ends,
+    so concurrent writers get disjoint ranges; should be called within the transaction that inserts the rows.
+    Ids are never reused, even if the rows are deleted. Counters start after ids of rows that existed before them
+    (see migration 0011), so tables are not scanned here.
+    """
+    field = ID_COUNTERS[model]
+    with transaction.atomic():
+        counters = IndexGeneration.objects.select_for_update().filter(pk=1).first()
+        if counters is None:
+            counters = IndexGeneration.objects.create(pk=1)
+        first_id = getattr(counters, field)
+        setattr(counters, field, first_id + n)
+        counters.save(update_fields=[field])
+    return first_id
+
+
+def retire_paragraphs(paragraphs):
+    """
+    Marks paragraphs of `paragraphs` queryset as retired, they are not part of the index anymore
+    """
+    paragraphs.filter(retired__isnull=True).update(retired=timezone.now())
+
+
+def purge_retired():
+    """
+    Deletes paragraphs retired more than ANNA_RETIRED_TTL seconds ago, no index in use refers to them anymore
+    """
+    ttl = getattr(settings, 'ANNA_RETIRED_TTL', 600)
+    Paragraph.objects.filter(retired__lt=timezone.now() - timedelta(seconds=ttl)).delete()
+
+
+def get_or_create_words(words, corpus_id):
+    """
+    Returns dict mapping each of `words` to its id in Word table among words of a corpus, missing words are created
+    """
+    word_ids = dict(Word.objects.filter(corpus_id=corpus_id, word__in=words).values_list('word', 'id'))
+    missing = [word for word in words if word not in word_ids]
+    if missing:
+        first_id = allocate_ids(Word, len(missing))
+        Word.objects.bulk_create([Word(id=first_id + n, corpus_id=corpus_id, word=word)
+                                  for n, word in enumerate(missing)])
+        word_ids.update((word, first_id + n) for n, word in enumerate(missing))
+    return word_ids
+
+
+def update_postings(changes):
+    """
+    Updates postings, document frequencies and positional postings of words, postings of other words are not read
+
+    changes: dict mapping word id to a dict {paragraph_id: positions},
+             positions is a list of token positions of the word in the paragraph or None to remove the paragraph
+    """
+    for word_id, blob in Word.objects.filter(id__in=list(changes)).values_list('id', 'positions'):
+        # paragraph ids of positional postings are the postings of the word
+        entries = dict(decode_positional_postings(bytes(blob)))
+        for paragraph_id, positions in changes[word_id].items():
+            if positions is None:
+                entries.pop(paragraph_id, None)
+            else:
+                entries[paragraph_id] = positions
+        entries = sorted(entries.items())
+        Word.objects.filter(id=word_id).update(positions=encode_positional_postings(entries),
+                                               postings=bytes(encode_sorted(p_id for p_id, _ in entries)),
+                                               df=len(entries))
+
+
+def words_of_paragraphs(texts, corpus_id):
+    """
+    Returns dict mapping words of paragraphs with `texts` to their ids in Word table among words of a corpus
+    """
+    words = list(OrderedDict.fromkeys(word for text in texts for word in paragraph_tokens(text)))
+    return dict(Word.objects.filter(corpus_id=corpus_id, word__in=words).values_list('word', 'id'))
+
+
+def delete_orphan_words(word_ids):
+    """
+    Deletes words from `word_ids` that are not contained in any paragraph anymore
+    """
+    Word.objects.filter(id__in=word_ids, df=0).delete()
+
+
+@transaction.atomic
+def add_paragraphs(texts, corpus_id=None):
+    """
+    Adds paragraphs to the index
+
+    texts: list of paragraph texts
+    corpus_id: id of the corpus of the paragraphs, DEFAULT_CORPUS if None
+    return: list of ids of created paragraphs
+    """
+    if not texts:
+        return []
+    if corpus_id is None:
+        corpus_id = get_corpus_id()
+    through = Word.paragraphs.through
+    first_id = allocate_ids(Paragraph, len(texts))
+    paragraphs = []
+    rows = []
+    for n, text in enumerate(texts):
+        words, spans = paragraph_scan(text)
+        paragraphs.append((first_id + n, text, words))
+        rows.append(Paragraph(id=first_id + n, corpus_id=corpus_id, text=text, length=len(spans),
+                              offsets=encode_spans(spans)))
+    Paragraph.objects.bulk_create(rows)
+
+    word_ids = get_or_create_words(list(OrderedDict.fromkeys(w for _, _, words in paragraphs for w in words)),
+                                   corpus_id)
+    if uses_relation_table():
+        through.objects.bulk_create([through(word_id=word_ids[word], paragraph_id=p_id)
+                                     for p_id, _, words in paragraphs for word in words])
+    changes = defaultdict(dict)
+    for p_id, _, words in paragraphs:
+        for word, positions in words.items():
+            changes[word_ids[word]][p_id] = positions
+    update_postings(changes)
+    bump_generation()
+    return [p_id for p_id, _, _ in paragraphs]
+
+
+@transaction.atomic
+def update_paragraph(paragraph_id, text):
+    """
+    Replaces text of a paragraph, only postings of words added to or removed from the paragraph are changed
+
+    Raises Paragraph.DoesNotExist if there's no paragraph with `paragraph_id` or it's retired
+    """
+    through = Word.paragraphs.through
+    paragraph = Paragraph.objects.get(id=paragraph_id, retired__isnull=True)
+    # words of the old text are found by tokenizing it, so the relation table is not needed
+    old_words = words_of_paragraphs([paragraph.text], paragraph.corpus_id)
+    new_words, spans = paragraph_scan(text)
+
+    removed = [word_id for word, word_id in old_words.items() if word not in new_words]
+    added = [word for word in new_words if word not in old_words]
+    word_ids = dict(old_words)
+    if added:
+        word_ids.update(get_or_create_words(added, paragraph.corpus_id))
+    if uses_relation_table():
+        if added:
+            through.objects.bulk_create([through(word_id=word_ids[word], paragraph_id=paragraph_id) for word in added])
+        if removed:
+            through.objects.filter(paragraph_id=paragraph_id, word_id__in=removed).delete()
+
+    # positions of words that stay in the paragraph may change too
+    changes = {word_id: {paragraph_id: None} for word_id in removed}
+    changes.update((word_ids[word], {paragraph_id: positions}) for word, positions in new_words.items())
+    update_postings(changes)
+    delete_orphan_words(removed)
+
+    paragraph.text = text
+    paragraph.length = len(spans)
+    paragraph.offsets = encode_spans(spans)
+    paragraph.save(update_fields=['text', 'length', 'offsets'])
+    bump_generation()
+
+
+@transaction.atomic
+def delete_paragraphs(paragraph_ids):
+    """
+    Deletes paragraphs from the index, words left without paragraphs are deleted as well
+
+    Paragraphs themselves are retired, see retire_paragraphs()
+    """
+    if not paragraph_ids:
+        return
+    purge_retired()
+    through = Word.paragraphs.through
+    changes = defaultdict(dict)
+    paragraphs = Paragraph.objects.filter(id__in=paragraph_ids, retired__isnull=True)
+    for p_id, text, corpus_id in paragraphs.values_list('id', 'text', 'corpus_id'):
+        for word_id in words_of_paragraphs([text], corpus_id).values():
+            changes[word_id][p_id] = None
+    through.objects.filter(paragraph_id__in=paragraph_ids).delete()
+    retire_paragraphs(paragraphs)
+    update_postings(changes)
+    delete_orphan_words(list(changes))
+    bump_generation()
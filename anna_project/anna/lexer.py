@@ -1,60 +1,94 @@
 # heavily based on http://jayconrod.com/posts/37/a-simple-interpreter-from-scratch-in-python-part-1
 
-import sys
 import re
+from functools import lru_cache
 
 RESERVED = 'RESERVED'
 WORD     = 'WORD'
+PHRASE   = 'PHRASE'
+PREFIX   = 'PREFIX'
+NEAR     = 'NEAR'
+CORPUS   = 'CORPUS'
 
 # list of tuples of regexes and corresponding tags for lex function
 token_exprs = [
     (r'[\s]+',          None),     # ignore whitespace
     (r'\(',             RESERVED), # we need brackets for precedence
     (r'\)',             RESERVED), # we need brackets for precedence
+    (r'"[^"]*"',        PHRASE),   # quoted phrase, words must follow each other
+    (r'NEAR/\d+',       NEAR),     # represents proximity op, i.e. NEAR/3
     (r'AND',            RESERVED), # represents logical AND op
     (r'OR',             RESERVED), # represents logical OR op
     (r'NOT',            RESERVED), # represents logical NOT op
-    (r'[^\s\(\)]+',     WORD),     # matches a single word for search
+    (r'corpus:[^\s\(\)"]+', CORPUS), # corpus filter, i.e. corpus:anna-karenina
+    (r'[^\s\(\)"\*]+\*(?=[\s\(\)]|$)', PREFIX), # word with a trailing wildcard, i.e. вронск*
+    (r'[^\s\(\)"]+',    WORD),     # matches a single word for search
 ]
 
 
+class LexerError(Exception):
+    """
+    Raised when the input contains a character that doesn't start any token
+    pos: position of the offending character in the input str
+    """
+    def __init__(self, input_str, pos):
+        self.input_str = input_str
+        self.pos = pos
+        self.char = input_str[pos]
+        super().__init__('Illegal character {char!r} at position {pos}'.format(char=self.char, pos=pos))
+
+
+@lru_cache(maxsize=16)
+def compile_token_exprs(token_exprs):
+    """
+    Compiles a tuple of (regex, tag) pairs into a single master regex with a named group per expression
+
+    return: tuple (regex, tags) - tags[group_name] is the tag of the expression matched by that group
+    """
+    groups = []
+    tags = {}
+    for n, (pattern, tag) in enumerate(token_exprs):
+        name = 'T{}'.format(n)
+        groups.append('(?P<{name}>{pattern})'.format(name=name, pattern=pattern))
+        tags[name] = tag
+    return re.compile('|'.join(groups)), tags
+
+
+def iter_lex(input_str, token_exprs=token_exprs):
+    """
+    Generator version of lex(), yields tokens as they are scanned
+    """
+    regex, tags = compile_token_exprs(tuple(token_exprs))
+    match = regex.match
+    pos = 0
+    end = len(input_str)
+    while pos < end:
+        m = match(input_str, pos)
+        # no matched tokens found (or an empty match) - illegal expression
+        if not m or m.end() == pos:
+            raise LexerError(input_str, pos)
+        tag = tags[m.lastgroup]
+        # yield a token only if there's a tag associated with it
+        if tag:
+            yield (m.group(), tag)
+        pos = m.end()
+
+
 def lex(input_str, token_exprs=token_exprs):
     """
     Generic lexer that takes a list of regular expressions and their tags.
-    For each expression, it will check whether the input text matches a token at the current position.
-    If a match is found, the matching text is extracted into a token, along with the regular expression's tag.
-    If the regular expression has no tag associated with it (the tag is None), the text is discarded.
+    All expressions are compiled once into a master regex - an alternation of named groups, one per expression,
+    so every token is found with a single match call in one pass over the input.
+    Alternatives are tried in the order of the list, so the order DOES matter:
+    we should put the most specific expressions first.
+    If the matched expression has no tag associated with it (the tag is None), the text is discarded.
     The process is repeated until there are no more chars left to match.
+    Raises LexerError if no expression matches at some position.
 
     Token is a tuple: a value (the string it represents) and a tag (to indicate what kind of token it is).
     The parser will use both to decide how to create the AST.
     """
-    pos = 0
-    tokens = []
-    # scan the input by matched chunks
-    while pos < len(input_str):
-        match = None
-        # try to match all tokens, the order DOES matter
-        # we should put the most specific expressions first
-        for token_expr in token_exprs:
-            pattern, tag = token_expr
-            regex = re.compile(pattern)
-            match = regex.match(input_str, pos)
-            # we found a match
-            if match:
-                text = match.group(0)
-                # add to list of tokens only if there's a tag associated with it
-                if tag:
-                    token = (text, tag)
-                    tokens.append(token)
-                break
-        # no matched tokens found - illegal expression
-        # else - get to the position past the matched chunk of input str
-        if not match:
-            sys.exit('Illegal character: {}'.format(input_str[pos]))
-        else:
-            pos = match.end(0)
-    return tokens
+    return list(iter_lex(input_str, token_exprs))
 
 
 def anna_lexer(input_str):
@@ -0,0 +1,220 @@
+# Search instrumentation: per-stage timings, SQL query and row counts, aggregate metrics and the slow-query log
+#
+# A request collects its metrics with `collect()`, code in the search path marks its stages with `stage(name)`
+# and reports hydrated rows with `count_rows(n)`. Outside of `collect()` both do nothing, so the search path
+# can be used by scripts without any overhead. Aggregates are kept per process.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of histogram buckets, in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+_local = threading.local()
+
+
+class RequestMetrics:
+    """
+    Metrics of a single search request
+
+    stages: OrderedDict mapping stage name to seconds spent in it, in the order stages were entered
+    queries: number of SQL queries executed
+    rows: number of model objects hydrated from the DB
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.queries = 0
+        self.rows = 0
+        self.total = 0.0
+
+    def __repr__(self):
+        return 'RequestMetrics({total:.1f} ms, {queries} queries, {rows} rows)'.format(
+            total=self.total * 1000, queries=self.queries, rows=self.rows)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def as_dict(self):
+        return {
+            'total_ms': round(self.total * 1000, 3),
+            'stages_ms': OrderedDict((name, round(seconds * 1000, 3)) for name, seconds in self.stages.items()),
+            'queries': self.queries,
+            'rows': self.rows,
+        }
+
+
+def current():
+    """
+    Returns RequestMetrics being collected in the current thread, None if there are none
+    """
+    return getattr(_local, 'metrics', None)
+
+
+class CountingCursor:
+    """
+    Wraps a DB cursor, counts statements it executes into RequestMetrics, nothing else is kept
+    """
+    def __init__(self, cursor, metrics):
+        self.cursor = cursor
+        self.metrics = metrics
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.cursor.__exit__(exc_type, exc_value, traceback)
+
+    def execute(self, sql, params=None):
+        self.metrics.queries += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.metrics.queries += 1
+        return self.cursor.executemany(sql, param_list)
+
+
+@contextmanager
+def collect():
+    """
+    Collects RequestMetrics of the enclosed code, SQL queries executed on the default connection are counted
+
+    Cursors of the connection (connections are per thread) are wrapped with CountingCursor while the code runs.
+    """
+    metrics = RequestMetrics()
+    _local.metrics = metrics
+    make_cursor, make_debug_cursor = connection.make_cursor, connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: CountingCursor(make_cursor(cursor), metrics)
+    connection.make_debug_cursor = lambda cursor: CountingCursor(make_debug_cursor(cursor), metrics)
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.total = time.perf_counter() - start
+        del connection.make_cursor
+        del connection.make_debug_cursor
+        _local.metrics = None
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the enclosed code as stage `name` of the current request
+    """
+    metrics = current()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(name, time.perf_counter() - start)
+
+
+def count_rows(n):
+    """
+    Adds `n` hydrated rows to the current request
+    """
+    metrics = current()
+    if metrics is not None:
+        metrics.rows += n
+
+
+class Histogram:
+    """
+    Histogram of durations with fixed buckets (see BUCKETS_MS)
+    """
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.sum_ms = 0.0
+
+    def __repr__(self):
+        return 'Histogram(count={count}, sum={sum_ms:.1f} ms)'.format(count=self.count, sum_ms=self.sum_ms)
+
+    def observe(self, ms):
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum_ms += ms
+
+    def as_dict(self):
+        buckets = OrderedDict()
+        cumulative = 0
+        for bound, n in zip(BUCKETS_MS, self.counts):
+            cumulative += n
+            buckets['+Inf' if bound == float('inf') else str(bound)] = cumulative
+        return {'count': self.count, 'sum_ms': round(self.sum_ms, 3), 'buckets_ms': buckets}
+
+
+class MetricsRegistry:
+    """
+    Aggregate counters and histograms of search requests of the current process
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = OrderedDict((name, 0) for name in ('requests', 'errors', 'slow_queries', 'sql_queries', 'rows'))
+            self.histograms = OrderedDict([('total', Histogram())])
+
+    def observe(self, metrics, error=False, slow=False):
+        """
+        Adds RequestMetrics of a finished request
+        """
+        with self._lock:
+            self.counters['requests'] += 1
+            self.counters['errors'] += int(error)
+            self.counters['slow_queries'] += int(slow)
+            self.counters['sql_queries'] += metrics.queries
+            self.counters['rows'] += metrics.rows
+            self.histograms['total'].observe(metrics.total * 1000)
+            for name, seconds in metrics.stages.items():
+                self.histograms.setdefault(name, Histogram()).observe(seconds * 1000)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': OrderedDict(self.counters),
+                'histograms': OrderedDict((name, h.as_dict()) for name, h in self.histograms.items()),
+            }
+
+
+registry = MetricsRegistry()
+
+
+def record(metrics, query, ast=None, error=None):
+    """
+    Adds metrics of a finished search request to the registry, writes it to the slow-query log
+    if it took at least ANNA_SLOW_QUERY_MS milliseconds
+
+    ast: parsed query, its canonical form is logged; None if the query wasn't parsed
+    error: error message if the search failed
+    """
+    threshold = getattr(settings, 'ANNA_SLOW_QUERY_MS', 500)
+    slow = threshold is not None and metrics.total * 1000 >= threshold
+    registry.observe(metrics, error=error is not None, slow=slow)
+    if slow:
+        entry = OrderedDict([('query', query), ('ast', ast.canonical() if ast else None), ('error', error)])
+        entry.update(metrics.as_dict())
+        logger.warning('slow query: %s', json.dumps(entry, ensure_ascii=False))
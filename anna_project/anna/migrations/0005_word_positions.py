@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 18:31
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import re
+
+from django.db import migrations, models
+
+from anna.codec import encode_positional_postings
+
+
+# tokenizer of the index at the time of the migration, see indexing.paragraph_tokens()
+reg_obj = re.compile(r'\w+\-\w+|\w+')
+
+
+def fill_positions(apps, schema_editor):
+    """
+    Encodes token positions of every word by tokenizing existing paragraphs
+    """
+    Word = apps.get_model('anna', 'Word')
+    Paragraph = apps.get_model('anna', 'Paragraph')
+    word_ids = dict(Word.objects.values_list('word', 'id'))
+    entries = defaultdict(list)
+    for paragraph_id, text in Paragraph.objects.order_by('id').values_list('id', 'text').iterator():
+        positions = defaultdict(list)
+        for pos, word in enumerate(reg_obj.findall(text)):
+            positions[word.lower()].append(pos)
+        for word, word_positions in positions.items():
+            if word in word_ids:
+                entries[word_ids[word]].append((paragraph_id, word_positions))
+    for word_id, word_entries in entries.items():
+        Word.objects.filter(id=word_id).update(positions=encode_positional_postings(word_entries))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anna', '0004_index_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='word',
+            name='positions',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(fill_positions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 19:12
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import re
+
+from django.db import migrations, models
+
+
+# tokenizer of the index at the time of the migration, see indexing.paragraph_tokens()
+reg_obj = re.compile(r'\w+\-\w+|\w+')
+
+
+def fill_length(apps, schema_editor):
+    """
+    Counts tokens of existing paragraphs, paragraphs of the same length are updated by one statement
+    """
+    Paragraph = apps.get_model('anna', 'Paragraph')
+    ids_by_length = defaultdict(list)
+    for paragraph_id, text in Paragraph.objects.values_list('id', 'text').iterator():
+        ids_by_length[len(reg_obj.findall(text))].append(paragraph_id)
+    for length, ids in ids_by_length.items():
+        # chunks keep the number of statement parameters within limits of SQLite
+        for i in range(0, len(ids), 500):
+            Paragraph.objects.filter(id__in=ids[i:i + 500]).update(length=length)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anna', '0005_word_positions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paragraph',
+            name='length',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_length, migrations.RunPython.noop),
+    ]
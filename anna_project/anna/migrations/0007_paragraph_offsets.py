@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 19:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anna', '0006_paragraph_length'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paragraph',
+            name='offsets',
+            field=models.BinaryField(default=b''),
+        ),
+    ]
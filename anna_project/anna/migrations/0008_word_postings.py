@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 21:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from anna.codec import encode_sorted
+
+
+def fill_postings(apps, schema_editor):
+    """
+    Encodes postings of every word from the Word-Paragraph relation table
+    """
+    Word = apps.get_model('anna', 'Word')
+    rows = (Word.paragraphs.through.objects
+            .order_by('word_id', 'paragraph_id')
+            .values_list('word_id', 'paragraph_id')
+            .iterator())
+    cur_word_id, cur_postings = None, []
+    for word_id, paragraph_id in rows:
+        if word_id != cur_word_id:
+            if cur_postings:
+                Word.objects.filter(id=cur_word_id).update(postings=bytes(encode_sorted(cur_postings)), df=len(cur_postings))
+            cur_word_id, cur_postings = word_id, []
+        cur_postings.append(paragraph_id)
+    if cur_postings:
+        Word.objects.filter(id=cur_word_id).update(postings=bytes(encode_sorted(cur_postings)), df=len(cur_postings))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anna', '0007_paragraph_offsets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='word',
+            name='df',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='word',
+            name='postings',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(fill_postings, migrations.RunPython.noop),
+    ]
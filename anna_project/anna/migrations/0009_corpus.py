@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 22:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_corpus(apps, schema_editor):
+    """
+    Puts existing paragraphs and words into the default corpus
+    """
+    Corpus = apps.get_model('anna', 'Corpus')
+    Paragraph = apps.get_model('anna', 'Paragraph')
+    Word = apps.get_model('anna', 'Word')
+    if Paragraph.objects.exists() or Word.objects.exists():
+        corpus = Corpus.objects.create(name='default')
+        Paragraph.objects.update(corpus=corpus)
+        Word.objects.update(corpus=corpus)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anna', '0008_word_postings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Corpus',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.SlugField(allow_unicode=True, max_length=100, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='paragraph',
+            name='corpus',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='anna.Corpus'),
+        ),
+        migrations.AddField(
+            model_name='word',
+            name='corpus',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='anna.Corpus'),
+        ),
+        migrations.RunPython(fill_corpus, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='paragraph',
+            name='corpus',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='anna.Corpus'),
+        ),
+        migrations.AlterField(
+            model_name='word',
+            name='corpus',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='anna.Corpus'),
+        ),
+        migrations.AlterField(
+            model_name='word',
+            name='word',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AlterUniqueTogether(
+            name='word',
+            unique_together=set([('corpus', 'word')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 23:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anna', '0009_corpus'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paragraph',
+            name='retired',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-19 09:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def fill_counters(apps, schema_editor):
+    """
+    Starts id counters after the largest existing ids
+    """
+    IndexGeneration = apps.get_model('anna', 'IndexGeneration')
+    Paragraph = apps.get_model('anna', 'Paragraph')
+    Word = apps.get_model('anna', 'Word')
+    counters = IndexGeneration.objects.filter(pk=1).first() or IndexGeneration(pk=1)
+    counters.next_paragraph_id = (Paragraph.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+    counters.next_word_id = (Word.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+    counters.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anna', '0010_paragraph_retired'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='indexgeneration',
+            name='next_paragraph_id',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='indexgeneration',
+            name='next_word_id',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -1,16 +1,64 @@
 from django.db import models
 
 
+class Corpus(models.Model):
+    """
+    A text (i.e. a novel) of the library, every corpus is indexed as a separate shard of Word and Paragraph rows
+    """
+    # used in `corpus:NAME` query filters
+    name = models.SlugField(max_length=100, unique=True, allow_unicode=True)
+
+    def __str__(self):
+        return self.name
+
+
 class Paragraph(models.Model):
+    corpus = models.ForeignKey(Corpus, on_delete=models.CASCADE)
     text = models.TextField()
+    # number of words (tokens) in the paragraph, used for ranking
+    length = models.PositiveIntegerField(default=0)
+    # char offsets of words (tokens) in the paragraph, see codec.encode_spans()
+    offsets = models.BinaryField(default=b'')
+    # time the paragraph was removed from the index, its row is kept for a while for requests
+    # still using an older index, see indexing.retire_paragraphs()
+    retired = models.DateTimeField(null=True, blank=True, db_index=True)
 
     def __str__(self):
         return "Paragraph " + str(self.id)
 
 
 class Word(models.Model):
-    word = models.CharField(max_length=100, db_index=True, unique=True)
+    """
+    A word of a corpus, words of different corpora are separate rows, so corpora don't share postings
+    """
+    corpus = models.ForeignKey(Corpus, on_delete=models.CASCADE)
+    word = models.CharField(max_length=100, db_index=True)
+    # relation table is filled only in 'table' storage mode, see ANNA_POSTINGS_STORAGE setting
     paragraphs = models.ManyToManyField(Paragraph)
+    # sorted ids of paragraphs containing the word, see codec.encode_sorted()
+    postings = models.BinaryField(default=b'')
+    # document frequency - number of paragraphs containing the word
+    df = models.PositiveIntegerField(default=0)
+    # token positions of the word in every paragraph, see codec.encode_positional_postings()
+    positions = models.BinaryField(default=b'')
+
+    class Meta:
+        unique_together = (('corpus', 'word'),)
 
     def __str__(self):
         return self.word
+
+
+class IndexGeneration(models.Model):
+    """
+    Single row table with a counter that is incremented on every change of Word and Paragraph tables,
+    so processes holding an in-memory index can tell it's stale
+    """
+    generation = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+    # ids of the next Paragraph and Word rows, see indexing.allocate_ids()
+    next_paragraph_id = models.PositiveIntegerField(default=1)
+    next_word_id = models.PositiveIntegerField(default=1)
+
+    def __str__(self):
+        return "Index generation " + str(self.generation)
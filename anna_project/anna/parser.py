@@ -1,11 +1,14 @@
 # here we combine parsers from primitives defined in combinators.py
 # based on http://jayconrod.com/posts/40/a-simple-interpreter-from-scratch-in-python-part-4
 
-from functools import reduce
+from functools import reduce, lru_cache
+
+from django.conf import settings
 
 from .lexer import *
 from .combinators import *
 from .ast import *
+from .metrics import stage
 
 
 # binary operators precedence levels
@@ -14,6 +17,11 @@ word_exp_precedence_levels = [
     ['OR'],
 ]
 
+# operators that combine words and phrases by their positions, bind tighter than any of the above
+positional_precedence_levels = [
+    ['NEAR'],
+]
+
 
 def parse(tokens):
     """
@@ -21,10 +29,30 @@ def parse(tokens):
 
     Gets list of tokens from lexer as input, returns AST (Result obj) or None if there was a parsing error
     """
+    tokens = TokenList(tokens)
     ast = word_expression()(tokens, 0)
     return ast if ast and ast.pos == len(tokens) else None
 
 
+@lru_cache(maxsize=getattr(settings, 'ANNA_PARSE_CACHE_SIZE', 1000))
+def parse_query(query):
+    """
+    Lexes and parses query str, returns AST or None if there was a parsing error
+
+    Results are cached, so repeated queries skip lexing and parsing entirely. ASTs are shared, so they must not be changed.
+    Raises LexerError for illegal characters in the query.
+    """
+    with stage('lex'):
+        tokens = anna_lexer(query)
+    with stage('parse'):
+        parse_result = parse(tokens)
+    return parse_result.value if parse_result else None
+
+
+# parser builders are cached, so the parser object graph is built once per process
+# and Lazy parsers refer back to the same graph instead of building new copies of it
+
+@lru_cache(maxsize=None)
 def word_expression():
     """
     General word expression parser
@@ -63,16 +91,19 @@ def any_operator_in_list(ops):
 
     ops: list of operators with the same precedence level
     """
-    op_parsers = [keyword(op) for op in ops]
+    op_parsers = [operator(op) for op in ops]
     parser = reduce(lambda l, r: l | r, op_parsers)
     return parser
 
 
 def process_binop(op):
     """
-    Function that constructs BinopWordExpression obj.
+    Function that constructs BinopWordExpression obj (or NearWordExpression obj for `NEAR/k`).
     Takes a reserved operator (OR, AND) and returns a function that combines expressions using this op.
     """
+    if op.startswith('NEAR/'):
+        distance = int(op[len('NEAR/'):])
+        return lambda l, r: NearWordExpression(distance, l, r)
     return lambda l, r: BinopWordExpression(op, l, r)
 
 
@@ -82,6 +113,13 @@ def keyword(kw):
     return Reserved(kw, RESERVED)
 
 
+def operator(op):
+    """Matches operator tokens, `NEAR/k` tokens have a tag of their own"""
+    if op == 'NEAR':
+        return Tag(NEAR)
+    return keyword(op)
+
+
 def word_expression_value():
     """
     Primitive word expression parser
@@ -89,6 +127,35 @@ def word_expression_value():
     return Tag(WORD) ^ (lambda i: WordExpression(i))
 
 
+def word_expression_prefix():
+    """
+    Primitive wildcard expression parser
+    """
+    return Tag(PREFIX) ^ (lambda i: PrefixWordExpression(i))
+
+
+def word_expression_phrase():
+    """
+    Primitive phrase expression parser, strips the quotes
+    """
+    return Tag(PHRASE) ^ (lambda i: PhraseExpression(i[1:-1]))
+
+
+def word_expression_corpus():
+    """
+    Corpus filter parser, strips the `corpus:` prefix
+    """
+    return Tag(CORPUS) ^ (lambda i: CorpusExpression(i[len('corpus:'):]))
+
+
+def positional_expression():
+    """
+    Parser for a word, a wildcard or a phrase, optionally combined with others by NEAR/k operators
+    """
+    value_parser = word_expression_phrase() | word_expression_prefix() | word_expression_value()
+    return precedence(value_parser, positional_precedence_levels, process_binop)
+
+
 def process_group(parsed):
     """
     Helper function to process expr group
@@ -116,9 +183,11 @@ def word_expression_group():
     return keyword('(') + Lazy(word_expression) + keyword(')') ^ process_group
 
 
+@lru_cache(maxsize=None)
 def word_expression_term():
     """
-    word_expression_term is any basic self-contained word expression
+    word_expression_term is any basic self-contained word expression or a corpus filter
     expression is flat in terms of precedence
+    Memoized, because it is applied again at the same position whenever an operator parser backtracks
     """
-    return word_expression_not() | word_expression_value() | word_expression_group()
+    return Memo(word_expression_not() | word_expression_corpus() | positional_expression() | word_expression_group())
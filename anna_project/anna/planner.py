@@ -0,0 +1,215 @@
+# Query planner
+# Turns AST into a tree of plan nodes that evaluates the same expression in a cheaper way:
+#   - nested chains of AND / OR are flattened into n-ary nodes
+#   - AND operands are evaluated rarest first, evaluation stops as soon as the intermediate result is empty
+#   - `a AND NOT b` is evaluated as a set difference, without building the complement of `b`
+#   - NOT is pushed inward with De Morgan's laws: `NOT ( a OR b )` becomes `NOT a AND NOT b`,
+#     so negations end up as differences in the enclosing AND
+#
+# Plan nodes can also count matching paragraphs without building the result (see count() methods):
+# a word is counted by its document frequency, an intersection of rare words by merging their postings.
+
+from bisect import bisect_left
+
+from .ast import WordExpression, BinopWordExpression, NotWordExpression
+from .index import popcount
+
+
+# AND of words is counted by merging postings if the rarest word is in fewer paragraphs than this,
+# for more frequent words building bitmaps and intersecting them is faster
+MERGE_COUNT_MAX_DF = 16
+
+
+def intersection_count(postings):
+    """
+    Returns number of ids common to all sorted arrays of `postings`, ids of the shortest array are searched
+    for in the others with bisection, each search starts where the previous one ended
+    """
+    postings = sorted(postings, key=len)
+    starts = [0] * len(postings)
+    n = 0
+    for paragraph_id in postings[0]:
+        for k in range(1, len(postings)):
+            other = postings[k]
+            i = starts[k] = bisect_left(other, paragraph_id, starts[k])
+            if i == len(other):
+                return n
+            if other[i] != paragraph_id:
+                break
+        else:
+            n += 1
+    return n
+
+
+class LeafPlan:
+    """
+    Plan node for a leaf of AST, i.e. WordExpression
+    cost: estimated number of matching paragraphs
+    """
+    def __init__(self, exp, index):
+        self.exp = exp
+        self.cost = exp.cost(index)
+
+    def __repr__(self):
+        return 'LeafPlan({exp}, cost={cost})'.format(exp=self.exp, cost=self.cost)
+
+    def eval(self, index):
+        return self.exp.eval(index)
+
+    def count(self, index):
+        if isinstance(self.exp, WordExpression):
+            # cost of a word is its exact document frequency
+            return self.cost
+        return popcount(self.eval(index))
+
+
+class AndPlan:
+    """
+    Plan node for intersection of `positives` minus union of `negatives`
+
+    Positives are evaluated rarest first, then negatives are subtracted most frequent first.
+    Evaluation stops when the intermediate result becomes empty.
+    """
+    def __init__(self, positives, negatives, index):
+        self.positives = sorted(positives, key=lambda p: p.cost)
+        self.negatives = sorted(negatives, key=lambda p: p.cost, reverse=True)
+        self.cost = self.positives[0].cost if self.positives else len(index.paragraph_ids)
+
+    def __repr__(self):
+        return 'AndPlan({pos}, NOT {neg}, cost={cost})'.format(pos=self.positives, neg=self.negatives, cost=self.cost)
+
+    def eval(self, index):
+        if self.positives:
+            value = self.positives[0].eval(index)
+            for plan in self.positives[1:]:
+                if not value:
+                    return value
+                value &= plan.eval(index)
+        else:
+            value = index.universe
+        for plan in self.negatives:
+            if not value:
+                return value
+            value &= ~plan.eval(index)
+        return value
+
+    def count(self, index):
+        words = [p.exp for p in self.positives if isinstance(p, LeafPlan) and isinstance(p.exp, WordExpression)]
+        if (words and len(words) == len(self.positives) and not self.negatives
+                and self.positives[0].cost < MERGE_COUNT_MAX_DF):
+            return intersection_count([index.postings(w.i.lower()) for w in words])
+        return popcount(self.eval(index))
+
+
+class OrPlan:
+    """
+    Plan node for union of `operands`
+    Evaluation stops when the intermediate result contains all paragraphs.
+    """
+    def __init__(self, operands, index):
+        self.operands = sorted(operands, key=lambda p: p.cost, reverse=True)
+        self.cost = min(sum(p.cost for p in operands), len(index.paragraph_ids))
+
+    def __repr__(self):
+        return 'OrPlan({ops}, cost={cost})'.format(ops=self.operands, cost=self.cost)
+
+    def eval(self, index):
+        value = 0
+        for plan in self.operands:
+            if value == index.universe:
+                break
+            value |= plan.eval(index)
+        return value
+
+    def count(self, index):
+        return popcount(self.eval(index))
+
+
+class NotPlan:
+    """
+    Plan node for complement of `operand`, used only when NOT can't be pushed into an AND
+    """
+    def __init__(self, operand, index):
+        self.operand = operand
+        self.cost = len(index.paragraph_ids) - operand.cost
+
+    def __repr__(self):
+        return 'NotPlan({op}, cost={cost})'.format(op=self.operand, cost=self.cost)
+
+    def eval(self, index):
+        return index.universe & ~self.operand.eval(index)
+
+    def count(self, index):
+        return len(index.paragraph_ids) - self.operand.count(index)
+
+
+def plan(ast, index):
+    """
+    Returns plan tree for AST, plan nodes have eval(index) like AST nodes do
+    """
+    if isinstance(ast, BinopWordExpression):
+        operands = [plan(exp, index) for exp in flatten(ast, ast.op)]
+        if ast.op == 'AND':
+            return and_plan(operands, index)
+        elif ast.op == 'OR':
+            return or_plan(operands, index)
+        else:
+            raise RuntimeError('Unknown operator: ' + ast.op)
+    elif isinstance(ast, NotWordExpression):
+        return not_plan(plan(ast.exp, index), index)
+    else:
+        return LeafPlan(ast, index)
+
+
+def flatten(ast, op):
+    """
+    Returns list of operands of a chain of binary expressions with operator `op`
+    """
+    if isinstance(ast, BinopWordExpression) and ast.op == op:
+        return flatten(ast.left, op) + flatten(ast.right, op)
+    return [ast]
+
+
+def and_plan(operands, index):
+    """
+    Builds AndPlan, negated operands become subtracted ones
+    """
+    positives, negatives = [], []
+    for operand in operands:
+        if isinstance(operand, AndPlan):
+            positives.extend(operand.positives)
+            negatives.extend(operand.negatives)
+        elif isinstance(operand, NotPlan):
+            negatives.append(operand.operand)
+        else:
+            positives.append(operand)
+    return AndPlan(positives, negatives, index)
+
+
+def or_plan(operands, index):
+    """
+    Builds OrPlan, nested OrPlans are merged into it
+    """
+    flat = []
+    for operand in operands:
+        if isinstance(operand, OrPlan):
+            flat.extend(operand.operands)
+        else:
+            flat.append(operand)
+    return OrPlan(flat, index)
+
+
+def not_plan(operand, index):
+    """
+    Builds plan for negation of `operand`, pushing NOT inward when possible
+    """
+    if isinstance(operand, NotPlan):
+        # NOT NOT a = a
+        return operand.operand
+    if isinstance(operand, OrPlan):
+        # NOT ( a OR b ) = NOT a AND NOT b
+        return AndPlan([], operand.operands, index)
+    if isinstance(operand, AndPlan) and not operand.positives:
+        # NOT ( NOT a AND NOT b ) = a OR b
+        return or_plan(operand.negatives, index)
+    return NotPlan(operand, index)
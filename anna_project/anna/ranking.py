@@ -0,0 +1,52 @@
+# Ranking of search results with Okapi BM25
+# The Boolean query still decides which paragraphs match, BM25 only orders them.
+# Term frequencies come from positional postings (number of positions of a word in a paragraph),
+# paragraph lengths are stored at index time (see Paragraph.length).
+
+from math import log
+
+from .ast import WordExpression, PhraseExpression, PrefixWordExpression, NearWordExpression, BinopWordExpression
+
+
+# BM25 parameters: term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+
+
+def query_words(ast, index):
+    """
+    Returns set of words of the query that contribute to paragraph scores, words under NOT don't
+    """
+    if isinstance(ast, WordExpression):
+        return {ast.i.lower()}
+    elif isinstance(ast, PhraseExpression):
+        return set(ast.words)
+    elif isinstance(ast, PrefixWordExpression):
+        return set(ast.words(index))
+    elif isinstance(ast, (BinopWordExpression, NearWordExpression)):
+        return query_words(ast.left, index) | query_words(ast.right, index)
+    return set()
+
+
+def bm25_scores(words, matched, index):
+    """
+    Scores paragraphs term-at-a-time
+
+    words: iterable of query words
+    matched: set of ids of paragraphs matching the query, other paragraphs are not scored
+    return: dict mapping ids of matched paragraphs that contain any of `words` to their scores
+    """
+    n = len(index.paragraph_ids)
+    avg_length = index.avg_length or 1
+    scores = {}
+    for word in words:
+        df = index.df(word)
+        if not df:
+            continue
+        idf = log(1 + (n - df + 0.5) / (df + 0.5))
+        for paragraph_id, positions in index.positions(word).items():
+            if paragraph_id in matched:
+                tf = len(positions)
+                norm = K1 * (1 - B + B * index.length(paragraph_id) / avg_length)
+                scores[paragraph_id] = scores.get(paragraph_id, 0) + idf * tf * (K1 + 1) / (tf + norm)
+    return scores
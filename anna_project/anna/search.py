@@ -0,0 +1,197 @@
+# Search pipeline shared by views: evaluation of parsed queries against the in-memory index
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import heapq
+
+from .cache import result_cache
+from .index import popcount
+from .metrics import stage, count_rows
+from .models import Paragraph
+from .planner import plan
+from .ranking import query_words, bm25_scores
+
+
+# number of paragraphs fetched per query when results are streamed
+STREAM_BATCH_SIZE = 500
+
+
+class SearchResults:
+    """
+    Lazy sequence of paragraphs matching a query, ordered by id
+
+    Works as Paginator's object_list: length comes from the bitmap, slicing extracts only ids of the slice
+    and fetches their paragraphs in a single query, so memory per request depends on the page size only
+    """
+    def __init__(self, bitmap, index):
+        self.bitmap = bitmap
+        self.index = index
+        self._count = None
+
+    def __repr__(self):
+        return 'SearchResults({} paragraphs)'.format(len(self))
+
+    def __len__(self):
+        if self._count is None:
+            self._count = popcount(self.bitmap)
+        return self._count
+
+    def count(self):
+        return len(self)
+
+    def ids(self, start=0, stop=None):
+        """
+        Returns sorted array of ids of matching paragraphs from `start` to `stop`
+        """
+        return self.index.ids(self.bitmap, start, stop)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise ValueError('SearchResults slicing does not support step')
+            start, stop, _ = key.indices(len(self))
+            with stage('fetch'):
+                ids = self.ids(start, stop)
+                paragraphs = Paragraph.objects.in_bulk(list(ids))
+            count_rows(len(paragraphs))
+            # paragraphs could be deleted after the index was built
+            return [paragraphs[i] for i in ids if i in paragraphs]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('SearchResults index out of range')
+        return self[key:key + 1][0]
+
+    def stream(self, after=None, limit=None, batch_size=STREAM_BATCH_SIZE):
+        """
+        Yields matching paragraphs in the order of ids
+
+        after: id of a paragraph, only paragraphs with greater ids are yielded
+        limit: max number of paragraphs to yield, all of them if None
+        Ids are extracted and paragraphs are fetched `batch_size` at a time, so memory doesn't depend on
+        the number of results, and ids before `after` are not extracted at all
+        """
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = batch_size if remaining is None else min(batch_size, remaining)
+            ids = self.index.ids(self.bitmap, 0, size, after=after)
+            if not ids:
+                return
+            paragraphs = Paragraph.objects.in_bulk(list(ids))
+            count_rows(len(paragraphs))
+            for paragraph_id in ids:
+                if paragraph_id in paragraphs:
+                    yield paragraphs[paragraph_id]
+            after = ids[-1]
+            if remaining is not None:
+                remaining -= len(ids)
+
+    def has_after(self, paragraph_id):
+        """
+        Returns True if there are matching paragraphs with ids greater than `paragraph_id`
+        """
+        return len(self.index.ids(self.bitmap, 0, 1, after=paragraph_id)) > 0
+
+
+def encode_cursor(paragraph_id):
+    """
+    Returns opaque cursor token pointing right after paragraph with `paragraph_id` in results ordered by id
+    """
+    return urlsafe_b64encode('p{}'.format(paragraph_id).encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns paragraph id from a token made by encode_cursor(), raises ValueError if the token is invalid
+    """
+    try:
+        value = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+    except ValueError:
+        # includes binascii.Error and UnicodeDecodeError
+        raise ValueError('Invalid cursor')
+    if not value.startswith('p') or not value[1:].isdigit():
+        raise ValueError('Invalid cursor')
+    return int(value[1:])
+
+
+def evaluate(ast, index, cache=result_cache):
+    """
+    Returns bitmap of paragraphs matching the AST
+
+    Results are cached by canonical form of the AST, cache is invalidated when the index generation changes.
+    On cache miss the AST is evaluated through the query planner.
+    cache: ResultCache of results of `index`, every shard has a cache of its own (see shards.py)
+    """
+    with stage('eval'):
+        key = ast.canonical()
+        bitmap = cache.get(key, index.generation)
+        if bitmap is None:
+            bitmap = plan(ast, index).eval(index)
+            cache.put(key, index.generation, bitmap)
+    return bitmap
+
+
+def count(ast, index, cache=result_cache):
+    """
+    Returns number of paragraphs matching the AST, ids of paragraphs are never extracted
+
+    Cached result of the query is counted if there is one, otherwise the plan counts matches (see planner.py),
+    which for words and intersections of rare words doesn't build bitmaps at all. Counts are cached too.
+    """
+    with stage('eval'):
+        key = ast.canonical()
+        bitmap = cache.get(key, index.generation)
+        if bitmap is not None:
+            return popcount(bitmap)
+        count_key = ('COUNT', key)
+        n = cache.get(count_key, index.generation)
+        if n is None:
+            n = plan(ast, index).count(index)
+            cache.put(count_key, index.generation, n)
+    return n
+
+
+class RankedResults(SearchResults):
+    """
+    Lazy sequence of paragraphs matching a query, ordered by BM25 score (see ranking.py), ties are ordered by id
+
+    Only the top `stop` paragraphs for a slice are selected with a bounded heap, matches are never fully sorted.
+    Paragraphs that match without containing any query word (i.e. through NOT) have zero score and come last.
+    """
+    def __init__(self, bitmap, index, words):
+        super().__init__(bitmap, index)
+        self.words = words
+        self._scores = None
+
+    def __repr__(self):
+        return 'RankedResults({} paragraphs)'.format(len(self))
+
+    def scores(self):
+        if self._scores is None:
+            with stage('rank'):
+                self._scores = bm25_scores(self.words, set(self.index.ids(self.bitmap)), self.index)
+        return self._scores
+
+    def ids(self, start=0, stop=None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        if stop <= start:
+            return []
+        scores = self.scores()
+        top = heapq.nlargest(stop, scores.items(), key=lambda item: (item[1], -item[0]))
+        ids = [paragraph_id for paragraph_id, _ in top]
+        if len(ids) < stop:
+            for paragraph_id in self.index.ids(self.bitmap):
+                if paragraph_id not in scores:
+                    ids.append(paragraph_id)
+                    if len(ids) == stop:
+                        break
+        return ids[start:stop]
+
+
+def search(ast, index, ranked=False):
+    """
+    Returns SearchResults for AST, RankedResults if `ranked`
+    """
+    bitmap = evaluate(ast, index)
+    if ranked:
+        return RankedResults(bitmap, index, query_words(ast, index))
+    return SearchResults(bitmap, index)
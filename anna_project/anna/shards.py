@@ -0,0 +1,250 @@
+# Sharded search over a library of corpora
+# Every corpus is a shard: its Word and Paragraph rows are separate from rows of other corpora (see models.py)
+# and its index is built from them alone (see InvertedIndex.from_db()). Shards are loaded and searched by a pool
+# of worker processes, a shard always goes to the same worker (corpus id modulo number of workers),
+# so it's held in memory by one process only.
+#
+# A query is sent to every shard that can match it, `corpus:` filters prune the rest before evaluation
+# (see shard_names()). Every shard returns its number of matches and its first `stop` results, they are merged
+# into the global order - by paragraph id, or by score for ranked results - so pages don't depend on how
+# corpora are distributed among workers. Ranked shards score paragraphs with statistics of the shard
+# (document frequencies, average length), like independent indexes do.
+
+import heapq
+from itertools import islice
+import multiprocessing
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from . import search
+from .ast import CorpusExpression, BinopWordExpression
+from .cache import ResultCache
+from .index import InvertedIndex, IndexManager
+from .indexing import current_generation
+from .metrics import stage, count_rows
+from .models import Corpus, Paragraph
+from .ranking import query_words
+
+
+def shard_names(ast):
+    """
+    Returns set of names of corpora whose paragraphs can match the AST, None if paragraphs of any corpus can
+    """
+    if isinstance(ast, CorpusExpression):
+        return {ast.name}
+    if isinstance(ast, BinopWordExpression):
+        left, right = shard_names(ast.left), shard_names(ast.right)
+        if ast.op == 'AND':
+            if left is None or right is None:
+                return right if left is None else left
+            return left & right
+        if left is None or right is None:
+            return None
+        return left | right
+    # words can be in any corpus, `NOT corpus:a` matches all other corpora
+    return None
+
+
+class Shard:
+    """
+    Index of a corpus and the cache of its results, lives in a worker process
+    """
+    def __init__(self, corpus_id):
+        self.index = InvertedIndex.from_db(corpus_id)
+        self.cache = ResultCache(getattr(settings, 'ANNA_RESULT_CACHE_SIZE', 1000))
+
+    def __repr__(self):
+        return 'Shard({})'.format(self.index)
+
+    @property
+    def generation(self):
+        return self.index.generation
+
+
+# snapshots of shards of the current process (see IndexManager), by corpus id
+_shards = {}
+
+
+def get_shard(corpus_id, generation):
+    """
+    Returns shard of a corpus; if it's older than `generation`, a new one is loaded in the background
+    and the current one is returned meanwhile
+    """
+    manager = _shards.get(corpus_id)
+    if manager is None:
+        manager = _shards[corpus_id] = IndexManager(lambda: Shard(corpus_id))
+    shard = manager.get()
+    # a shard loaded after the generation was read by the caller is newer, not stale
+    if shard.generation < generation:
+        manager.refresh(generation)
+    return shard
+
+
+def count_shard(corpus_id, generation, ast):
+    """
+    Worker function, returns number of paragraphs of a shard matching the AST
+    """
+    shard = get_shard(corpus_id, generation)
+    return search.count(ast, shard.index, shard.cache)
+
+
+def search_shard(corpus_id, generation, ast, stop, ranked):
+    """
+    Worker function, returns tuple (number of paragraphs of a shard matching the AST, first `stop` results)
+
+    Results are paragraph ids, or tuples (-score, id) if `ranked`, so results of shards merge in the order of results
+    """
+    shard = get_shard(corpus_id, generation)
+    bitmap = search.evaluate(ast, shard.index, shard.cache)
+    if ranked:
+        res = search.RankedResults(bitmap, shard.index, query_words(ast, shard.index))
+        scores = res.scores()
+        return len(res), [(-scores.get(paragraph_id, 0.0), paragraph_id) for paragraph_id in res.ids(0, stop)]
+    res = search.SearchResults(bitmap, shard.index)
+    return len(res), list(res.ids(0, stop))
+
+
+class ShardPool:
+    """
+    Searches shards in `workers` worker processes, or in the calling process if `workers` is 0
+
+    Every worker is a pool of one forked process, so it shares settings and loaded modules of the calling process.
+    Workers are forked right away: the pool should be created before the process starts threads, i.e. when
+    the app is loaded (see wsgi.py), not while requests are served.
+    Index generation and the list of corpora are checked at most once in ANNA_INDEX_CHECK_INTERVAL seconds,
+    workers load new snapshots of their shards in the background when they are given a newer generation.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self._generation = None
+        self._corpora = {}
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._pools = []
+        if workers:
+            # forked workers would share DB connections of this process, they are closed first,
+            # so every process opens connections of its own
+            connections.close_all()
+            context = multiprocessing.get_context('fork')
+            self._pools = [context.Pool(1) for _ in range(workers)]
+
+    def __repr__(self):
+        return 'ShardPool({} workers)'.format(self.workers)
+
+    def corpora(self):
+        """
+        Returns tuple (index generation, dict mapping corpus names to ids)
+        """
+        interval = getattr(settings, 'ANNA_INDEX_CHECK_INTERVAL', 5)
+        with self._lock:
+            if self._generation is None or time.time() - self._checked >= interval:
+                generation = current_generation()
+                if generation != self._generation:
+                    self._corpora = dict(Corpus.objects.values_list('name', 'id'))
+                    self._generation = generation
+                self._checked = time.time()
+            return self._generation, self._corpora
+
+    def close(self):
+        """
+        Stops worker processes, the pool can't search anymore
+        """
+        for pool in self._pools:
+            pool.terminate()
+            pool.join()
+        self._pools = []
+
+    def map(self, ast, func, *args):
+        """
+        Calls worker function `func(corpus_id, generation, ast, *args)` for every shard that can match the AST
+
+        return: list of results, in the order of corpus names
+        """
+        generation, corpora = self.corpora()
+        names = shard_names(ast)
+        corpus_ids = [corpus_id for name, corpus_id in sorted(corpora.items()) if names is None or name in names]
+        with stage('shards'):
+            if not self.workers:
+                return [func(corpus_id, generation, ast, *args) for corpus_id in corpus_ids]
+            # a shard always goes to the same worker
+            results = [self._pools[corpus_id % self.workers].apply_async(func, (corpus_id, generation, ast) + args)
+                       for corpus_id in corpus_ids]
+            return [result.get() for result in results]
+
+    def count(self, ast):
+        """
+        Returns number of paragraphs matching the AST in all shards
+        """
+        return sum(self.map(ast, count_shard))
+
+    def search(self, ast, start, stop, ranked=False):
+        """
+        Returns tuple (number of paragraphs matching the AST in all shards,
+        list of ids of matching paragraphs from `start` to `stop` in the global order)
+        """
+        results = self.map(ast, search_shard, stop, ranked)
+        hits = islice(heapq.merge(*(shard_hits for _, shard_hits in results)), start, stop)
+        ids = [hit[1] for hit in hits] if ranked else list(hits)
+        return sum(n for n, _ in results), ids
+
+
+class ShardedResults:
+    """
+    Lazy sequence of paragraphs matching a query in all shards, in the global order
+
+    Works as Paginator's object_list. Count and ids of a slice come from one search of the shards:
+    a page costs one round of shard searches if `prefetch` slice is the one requested.
+
+    prefetch: tuple (start, stop) - slice searched for when the length is asked for first
+    """
+    def __init__(self, pool, ast, prefetch=(0, 0), ranked=False):
+        self.pool = pool
+        self.ast = ast
+        self.prefetch = prefetch
+        self.ranked = ranked
+        self._count = None
+        self._pages = {}
+
+    def __repr__(self):
+        return 'ShardedResults({})'.format(self.ast)
+
+    def __len__(self):
+        if self._count is None:
+            self.ids(*self.prefetch)
+        return self._count
+
+    def count(self):
+        return len(self)
+
+    def ids(self, start=0, stop=None):
+        """
+        Returns list of ids of matching paragraphs from `start` to `stop`
+        """
+        if stop is None:
+            stop = len(self)
+        for (page_start, page_stop), ids in self._pages.items():
+            # paginator cuts the last page at the count, it's still within the searched slice
+            if page_start <= start and stop <= page_stop:
+                return ids[start - page_start:stop - page_start]
+        self._count, self._pages[start, stop] = self.pool.search(self.ast, start, stop, self.ranked)
+        return self._pages[start, stop]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise ValueError('ShardedResults slicing does not support step')
+            start, stop, _ = key.indices(len(self))
+            ids = self.ids(start, max(start, stop))
+            with stage('fetch'):
+                paragraphs = Paragraph.objects.in_bulk(ids)
+            count_rows(len(paragraphs))
+            # paragraphs could be deleted after shards were loaded
+            return [paragraphs[i] for i in ids if i in paragraphs]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('ShardedResults index out of range')
+        return self[key:key + 1][0]
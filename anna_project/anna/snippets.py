@@ -0,0 +1,51 @@
+# Snippets for the results page
+# A snippet is a short window of a paragraph around the first matched query word, with matched words highlighted.
+# Char offsets of words are stored at index time (see Paragraph.offsets), so paragraphs are not tokenized per request.
+
+from django.conf import settings
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .codec import decode_spans
+from .indexing import paragraph_offsets
+
+
+# number of words shown before the first match
+CONTEXT_WORDS = 8
+
+
+def make_snippet(paragraph, words, size=None):
+    """
+    Returns HTML snippet of a paragraph, query words are wrapped in <mark> tags
+
+    paragraph: Paragraph obj
+    words: set of lowercased query words to highlight
+    size: max number of words in the snippet, ANNA_SNIPPET_WORDS by default
+    """
+    if size is None:
+        size = getattr(settings, 'ANNA_SNIPPET_WORDS', 40)
+    text = paragraph.text
+    # paragraphs indexed before offsets were stored are tokenized on the fly
+    spans = decode_spans(bytes(paragraph.offsets)) if paragraph.offsets else paragraph_offsets(text)
+    matches = [n for n, (start, end) in enumerate(spans) if text[start:end].lower() in words]
+
+    # window of `size` words starting a few words before the first match
+    first = 0
+    if len(spans) > size:
+        first = max(0, min((matches[0] if matches else 0) - CONTEXT_WORDS, len(spans) - size))
+    last = min(first + size, len(spans))
+    begin = spans[first][0] if first > 0 else 0
+    end = spans[last - 1][1] if last < len(spans) else len(text)
+
+    parts = ['&hellip; '] if begin > 0 else []
+    pos = begin
+    for n in matches:
+        if first <= n < last:
+            start, stop = spans[n]
+            parts.append(escape(text[pos:start]))
+            parts.append('<mark>{}</mark>'.format(escape(text[start:stop])))
+            pos = stop
+    parts.append(escape(text[pos:end]))
+    if end < len(text.rstrip()):
+        parts.append(' &hellip;')
+    return mark_safe(''.join(parts))
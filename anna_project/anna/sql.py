@@ -0,0 +1,222 @@
+# Compilation of parsed queries into SQL
+# The whole query becomes a single WHERE condition over the Paragraph table: every word is an EXISTS subquery
+# against the Word-Paragraph relation table, AND / OR / NOT map to SQL operators, so the database evaluates
+# the query on its own and no index has to be kept in process memory.
+#
+# Phrases and NEAR need token positions, which are stored in encoded blobs (see codec.py), so they can't be
+# compiled and raise UnsupportedQuery.
+
+from django.db import connection
+
+from .ast import (QueryError, WordExpression, PrefixWordExpression, PhraseExpression, NearWordExpression,
+                  CorpusExpression, BinopWordExpression, NotWordExpression)
+from .metrics import stage, count_rows
+from .models import Corpus, Word, Paragraph
+from .search import STREAM_BATCH_SIZE
+
+
+class UnsupportedQuery(QueryError):
+    """
+    Raised for queries that can't be compiled into SQL
+    """
+    pass
+
+
+def _tables():
+    qn = connection.ops.quote_name
+    return {
+        'corpus': qn(Corpus._meta.db_table),
+        'paragraph': qn(Paragraph._meta.db_table),
+        'word': qn(Word._meta.db_table),
+        'through': qn(Word.paragraphs.through._meta.db_table),
+    }
+
+
+# condition on paragraph `p` that excludes retired paragraphs, see indexing.retire_paragraphs()
+LIVE = 'p.retired IS NULL'
+
+# escape character of LIKE patterns, backslash is not used as it means different things in MySQL and SQLite literals
+LIKE_ESCAPE = '!'
+
+
+def _like_prefix(prefix):
+    """
+    Returns LIKE pattern matching strings that start with `prefix`
+    """
+    for char in (LIKE_ESCAPE, '%', '_'):
+        prefix = prefix.replace(char, LIKE_ESCAPE + char)
+    return prefix + '%'
+
+
+def compile_condition(ast):
+    """
+    Compiles AST into an SQL condition on paragraph `p`
+
+    return: tuple (sql, params)
+    """
+    tables = _tables()
+    exists = ('EXISTS (SELECT 1 FROM {through} t JOIN {word} w ON w.id = t.word_id '
+              'WHERE t.paragraph_id = p.id AND w.word {{}})').format(**tables)
+    in_corpus = 'p.corpus_id IN (SELECT c.id FROM {corpus} c WHERE c.name = %s)'.format(**tables)
+
+    def compile_node(node):
+        if isinstance(node, WordExpression):
+            return exists.format('= %s'), [node.i.lower()]
+        if isinstance(node, PrefixWordExpression):
+            return exists.format("LIKE %s ESCAPE '{}'".format(LIKE_ESCAPE)), [_like_prefix(node.prefix)]
+        if isinstance(node, PhraseExpression) and len(node.words) == 1:
+            return exists.format('= %s'), [node.words[0]]
+        if isinstance(node, (PhraseExpression, NearWordExpression)):
+            raise UnsupportedQuery('Phrases and NEAR are not supported by SQL search')
+        if isinstance(node, CorpusExpression):
+            return in_corpus, [node.name]
+        if isinstance(node, BinopWordExpression):
+            if node.op not in ('AND', 'OR'):
+                raise RuntimeError('Unknown operator: ' + node.op)
+            left_sql, left_params = compile_node(node.left)
+            right_sql, right_params = compile_node(node.right)
+            return '({} {} {})'.format(left_sql, node.op, right_sql), left_params + right_params
+        if isinstance(node, NotWordExpression):
+            sql, params = compile_node(node.exp)
+            return 'NOT {}'.format(sql), params
+        raise UnsupportedQuery('{} is not supported by SQL search'.format(node))
+
+    return compile_node(ast)
+
+
+def compile_page(condition, params, start, stop):
+    """
+    Builds a single statement returning both the number of paragraphs matching a condition (see compile_condition())
+    and the paragraphs from `start` to `stop` in the order of ids
+
+    Rows are (0, count, NULL, NULL) and (1, id, text, offsets) for paragraphs of the page, in any order
+    return: tuple (sql, params)
+    """
+    sql = ('SELECT 0, COUNT(*), NULL, NULL FROM {paragraph} p WHERE {live} AND {condition} '
+           'UNION ALL '
+           'SELECT 1, page.id, page.text, page.offsets FROM ('
+           'SELECT p.id, p.text, p.offsets FROM {paragraph} p WHERE {live} AND {condition} '
+           'ORDER BY p.id LIMIT %s OFFSET %s'
+           ') page').format(condition=condition, live=LIVE, **_tables())
+    return sql, params + params + [stop - start, start]
+
+
+def search_page(condition, params, start, stop):
+    """
+    Returns tuple (number of paragraphs matching a condition, list of Paragraph objects from `start` to `stop`)
+    in a single round trip to the database
+    """
+    sql, params = compile_page(condition, params, start, stop)
+    with stage('sql'):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+    count = 0
+    paragraphs = []
+    for kind, value, text, offsets in rows:
+        if kind == 0:
+            count = value
+        else:
+            paragraphs.append(Paragraph(id=value, text=text, offsets=offsets))
+    paragraphs.sort(key=lambda paragraph: paragraph.id)
+    count_rows(len(paragraphs))
+    return count, paragraphs
+
+
+def search_after(condition, params, after, limit):
+    """
+    Returns list of at most `limit` Paragraph objects matching a condition with ids greater than `after`,
+    in the order of ids; `after` is None to start from the first one
+    """
+    sql = ('SELECT p.id, p.text, p.offsets FROM {paragraph} p WHERE {live} AND {condition} AND p.id > %s '
+           'ORDER BY p.id LIMIT %s').format(condition=condition, live=LIVE, **_tables())
+    with stage('sql'):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + [-1 if after is None else after, limit])
+            rows = cursor.fetchall()
+    count_rows(len(rows))
+    return [Paragraph(id=paragraph_id, text=text, offsets=offsets) for paragraph_id, text, offsets in rows]
+
+
+def count_matches(condition, params):
+    """
+    Returns number of paragraphs matching a condition
+    """
+    sql = 'SELECT COUNT(*) FROM {paragraph} p WHERE {live} AND {condition}'.format(
+        condition=condition, live=LIVE, **_tables())
+    with stage('sql'):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0]
+
+
+class SQLResults:
+    """
+    Lazy sequence of paragraphs matching a condition (see compile_condition()) evaluated by the database, ordered by id
+
+    Works as Paginator's object_list. Count and paragraphs of a slice come from one statement: the count of
+    the first statement is kept, so a page costs one round trip if `prefetch` slice is the one requested.
+
+    prefetch: tuple (start, stop) - slice fetched along with the count when the length is asked for first
+    """
+    def __init__(self, condition, params, prefetch=(0, 0)):
+        self.condition = condition
+        self.params = params
+        self.prefetch = prefetch
+        self._count = None
+        self._pages = {}
+
+    def __repr__(self):
+        return 'SQLResults({})'.format(self.condition)
+
+    def _fetch(self, start, stop):
+        for (page_start, page_stop), paragraphs in self._pages.items():
+            # paginator cuts the last page at the count, it's still within the prefetched slice
+            if page_start == start and stop <= page_stop:
+                return paragraphs[:stop - start]
+        self._count, self._pages[start, stop] = search_page(self.condition, self.params, start, stop)
+        return self._pages[start, stop]
+
+    def __len__(self):
+        if self._count is None:
+            self._fetch(*self.prefetch)
+        return self._count
+
+    def count(self):
+        return len(self)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise ValueError('SQLResults slicing does not support step')
+            start, stop, _ = key.indices(len(self))
+            return self._fetch(start, max(start, stop))
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('SQLResults index out of range')
+        return self[key:key + 1][0]
+
+    def stream(self, after=None, limit=None, batch_size=STREAM_BATCH_SIZE):
+        """
+        Yields matching paragraphs in the order of ids, same as SearchResults.stream()
+
+        Every batch is a statement of its own that continues after the last id of the previous one,
+        so rows before `after` are never read past in the order of ids
+        """
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = batch_size if remaining is None else min(batch_size, remaining)
+            paragraphs = search_after(self.condition, self.params, after, size)
+            yield from paragraphs
+            if len(paragraphs) < size:
+                return
+            after = paragraphs[-1].id
+            if remaining is not None:
+                remaining -= len(paragraphs)
+
+    def has_after(self, paragraph_id):
+        """
+        Returns True if there are matching paragraphs with ids greater than `paragraph_id`
+        """
+        return len(search_after(self.condition, self.params, paragraph_id, 1)) > 0
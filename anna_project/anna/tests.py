@@ -1,3 +1,1021 @@
-from django.test import TestCase
+# Tests of the index, its encodings and the search backends
+# Fixtures are small texts added with indexing.add_paragraphs(), expected results are computed from the texts
+# directly, so the index, the planner and every backend are checked against the same reference.
 
-# Create your tests here.
+import json
+import os
+import shutil
+import tempfile
+import threading
+from array import array
+from itertools import product
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from . import backends, metrics, search, shards, sql
+from .ast import QueryError, merge_positions
+from .cache import ResultCache, result_cache
+from .combinators import Memo, Parser, Result, TokenList
+from .codec import (encode_varint, decode_varints, encode_sorted, decode_sorted, encode_positional_postings,
+                    decode_positional_postings, rebase_positional_postings, encode_spans, decode_spans)
+from .index import IndexManager, InvertedIndex, index_manager
+from .indexfile import MAGIC, IndexFileError, MappedIndex, write_index_file
+from .indexing import (add_paragraphs, update_paragraph, delete_paragraphs, allocate_ids, current_generation,
+                       get_corpus_id, purge_retired, paragraph_positions, paragraph_offsets, paragraph_scan)
+from .lexer import LexerError, anna_lexer
+from .models import Word, Paragraph
+from .parser import parse, parse_query, word_expression
+from .planner import plan
+from .snippets import make_snippet
+from .sql import UnsupportedQuery
+
+
+TEXTS = [
+    'Все счастливые семьи похожи друг на друга, каждая несчастливая семья несчастлива по-своему.',
+    'Всё смешалось в доме Облонских. Жена узнала, что муж был в связи с бывшею в их доме француженкою-гувернанткой.',
+    'Степан Аркадьич Облонский проснулся на сафьянном диване. Степан Аркадьич был доволен.',
+    'Анна. Анна Аркадьевна вошла в гостиную, Степан вышел к ней.',
+    'Левин любил Кити, и Кити любила Левина по-своему.',
+]
+
+OTHER_TEXTS = [
+    'Степан Аркадьич читал газету в доме брата.',
+    'Кити и Анна встретились на балу, Левин не танцевал.',
+]
+
+
+def reference_index(paragraphs):
+    """
+    Returns tuple (dict mapping words to sorted lists of paragraph ids, dict mapping words to lists of
+    (paragraph id, positions)) computed from `paragraphs` - dict mapping paragraph ids to texts
+    """
+    postings, positions = {}, {}
+    for paragraph_id in sorted(paragraphs):
+        for word, word_positions in paragraph_positions(paragraphs[paragraph_id]).items():
+            postings.setdefault(word, []).append(paragraph_id)
+            positions.setdefault(word, []).append((paragraph_id, list(word_positions)))
+    return postings, positions
+
+
+class CodecTests(TestCase):
+
+    def test_varints(self):
+        numbers = [0, 1, 127, 128, 300, 16383, 16384, 2 ** 32 - 1, 2 ** 40]
+        out = bytearray()
+        for n in numbers:
+            encode_varint(n, out)
+        self.assertEqual(decode_varints(out), (numbers, len(out)))
+        self.assertEqual(decode_varints(out, 2), (numbers[:2], 2))
+
+    def test_sorted(self):
+        for numbers in ([], [5], [1, 2, 3, 1000, 100000, 2 ** 31]):
+            self.assertEqual(list(decode_sorted(bytes(encode_sorted(numbers)))), numbers)
+
+    def test_positional_postings(self):
+        entries = [(3, [0, 5, 130]), (4, [2]), (1000, [0, 1, 2, 3])]
+        decoded = decode_positional_postings(encode_positional_postings(entries))
+        self.assertEqual([(p_id, list(positions)) for p_id, positions in decoded], entries)
+        self.assertEqual(decode_positional_postings(b''), [])
+
+    def test_rebase_positional_postings(self):
+        first, second = [(3, [1]), (7, [0, 2])], [(20, [4]), (300, [1, 9])]
+        data = encode_positional_postings(first) + rebase_positional_postings(encode_positional_postings(second), 7)
+        self.assertEqual([(p_id, list(positions)) for p_id, positions in decode_positional_postings(data)],
+                         first + second)
+        self.assertEqual(rebase_positional_postings(b'', 7), b'')
+
+    def test_spans(self):
+        spans = paragraph_offsets(TEXTS[1])
+        self.assertEqual(decode_spans(encode_spans(spans)), spans)
+        self.assertEqual(decode_spans(encode_spans([])), [])
+
+
+class LexerTests(TestCase):
+
+    def test_tokens(self):
+        self.assertEqual(anna_lexer('( "анна аркадьевна" NEAR/3 вронск* ) AND NOT corpus:anna-karenina OR левин'), [
+            ('(', 'RESERVED'), ('"анна аркадьевна"', 'PHRASE'), ('NEAR/3', 'NEAR'), ('вронск*', 'PREFIX'),
+            (')', 'RESERVED'), ('AND', 'RESERVED'), ('NOT', 'RESERVED'), ('corpus:anna-karenina', 'CORPUS'),
+            ('OR', 'RESERVED'), ('левин', 'WORD'),
+        ])
+        # a star inside a word doesn't make it a prefix
+        self.assertEqual(anna_lexer('a*b'), [('a*b', 'WORD')])
+        self.assertEqual(anna_lexer('  '), [])
+
+    def test_illegal_character(self):
+        with self.assertRaises(LexerError) as cm:
+            anna_lexer('анна AND "вронский')
+        self.assertEqual((cm.exception.pos, cm.exception.char), (9, '"'))
+        self.assertEqual(str(cm.exception), "Illegal character '\"' at position 9")
+
+
+class ParserTests(TestCase):
+
+    QUERY = '( анна OR "степан аркадьич" ) AND NOT ( левин NEAR/2 кити OR corpus:anna-karenina ) OR вронск*'
+
+    def test_parse_query_is_cached(self):
+        parse_query.cache_clear()
+        ast = parse_query(self.QUERY)
+        self.assertIs(parse_query(self.QUERY), ast)
+        self.assertEqual((parse_query.cache_info().hits, parse_query.cache_info().misses), (1, 1))
+        self.assertIsNone(parse_query('анна AND'))
+
+    def test_parser_is_built_once(self):
+        self.assertIs(word_expression(), word_expression())
+
+    def test_memoized_parse_matches_plain_parse(self):
+        for query in (self.QUERY, 'анна', 'NOT ( анна AND ( левин OR кити ) )', 'анна OR OR'):
+            with self.subTest(query=query):
+                tokens = anna_lexer(query)
+                memoized, plain = parse(tokens), word_expression()(tokens, 0)
+                if plain and plain.pos == len(tokens):
+                    self.assertEqual(repr(memoized.value), repr(plain.value))
+                else:
+                    self.assertIsNone(memoized)
+
+    def test_memo(self):
+        calls = []
+
+        class Counting(Parser):
+            def __call__(self, tokens, pos):
+                calls.append(pos)
+                return Result(tokens[pos], pos + 1)
+
+        parser = Memo(Counting())
+        tokens = TokenList(['a', 'b'])
+        self.assertIs(parser(tokens, 0), parser(tokens, 0))
+        parser(tokens, 1)
+        self.assertEqual(calls, [0, 1])
+        # plain lists have no memo table
+        parser(['a'], 0)
+        parser(['a'], 0)
+        self.assertEqual(calls, [0, 1, 0, 0])
+
+
+class MergePositionsTests(TestCase):
+
+    def test_phrase(self):
+        left = {1: array('I', [0, 4, 9]), 2: array('I', [3])}
+        right = {1: array('I', [1, 6, 10]), 3: array('I', [4])}
+        self.assertEqual(merge_positions(left, right, 1, 1), {1: array('I', [0, 9])})
+
+    def test_near(self):
+        left = {1: array('I', [5]), 2: array('I', [10])}
+        right = {1: array('I', [2]), 2: array('I', [20])}
+        self.assertEqual(merge_positions(left, right, -3, 3), {1: array('I', [5])})
+        self.assertEqual(merge_positions(left, right, -2, 2), {})
+
+    def test_queries(self):
+        paragraph_ids = add_paragraphs(TEXTS)
+        index = InvertedIndex.from_db()
+        cases = [
+            ('"степан аркадьич"', [paragraph_ids[2]]),
+            ('"аркадьич степан"', []),
+            ('"анна аркадьевна вошла"', [paragraph_ids[3]]),
+            ('степан NEAR/1 аркадьич', [paragraph_ids[2]]),
+            ('аркадьич NEAR/1 степан', [paragraph_ids[2]]),
+            ('степан NEAR/2 вошла', []),
+            ('степан NEAR/3 вошла', [paragraph_ids[3]]),
+            ('"степан аркадьич" NEAR/5 доволен', [paragraph_ids[2]]),
+        ]
+        for query, expected in cases:
+            with self.subTest(query=query):
+                self.assertEqual(list(index.ids(parse_query(query).eval(index))), expected)
+
+
+class WildcardTests(TestCase):
+
+    def setUp(self):
+        self.paragraphs = dict(zip(add_paragraphs(TEXTS), TEXTS))
+        index_manager.swap(InvertedIndex.from_db())
+        self.backends = [backends.IndexBackend(), backends.SQLBackend()]
+        if connection.vendor == 'sqlite':
+            self.backends.append(backends.FTS5Backend())
+
+    def test_prefix(self):
+        index = InvertedIndex.from_db()
+        self.assertEqual(index.words_with_prefix('степ'), ['степан'])
+        self.assertEqual(index.words_with_prefix('аркадь'), ['аркадьевна', 'аркадьич'])
+        expected = sorted(p_id for p_id, text in self.paragraphs.items() if 'Аркадь' in text)
+        for backend in self.backends:
+            with self.subTest(backend=backend.name):
+                self.assertEqual(backend.page(parse_query('аркадь*'), 0, 10), (len(expected), expected))
+
+    def test_too_many_words(self):
+        ast = parse_query('NOT с*')
+        with override_settings(ANNA_WILDCARD_MAX_TERMS=3):
+            for backend in self.backends:
+                with self.subTest(backend=backend.name):
+                    with self.assertRaisesMessage(QueryError, 'с* matches more than 3 words'):
+                        backend.count(ast)
+                    # narrower wildcards are still fine
+                    self.assertEqual(backend.count(parse_query('аркадь*')), 2)
+
+
+class IncrementalIndexingTests(TestCase):
+
+    def assertIndexMatches(self, paragraphs):
+        index = InvertedIndex.from_db()
+        postings, positions = reference_index(paragraphs)
+        self.assertEqual(list(index.paragraph_ids), sorted(paragraphs))
+        self.assertEqual(sorted(index.words), sorted(postings))
+        for word in postings:
+            self.assertEqual(list(index.postings(word)), postings[word], word)
+            self.assertEqual([(p_id, list(p)) for p_id, p in sorted(index.positions(word).items())],
+                             positions[word], word)
+        # stored df and relation rows agree with the postings, words without paragraphs are deleted
+        self.assertEqual(dict(Word.objects.values_list('word', 'df')),
+                         {word: len(ids) for word, ids in postings.items()})
+        relations = Word.paragraphs.through.objects.values_list('word__word', 'paragraph_id')
+        self.assertEqual(sorted(relations), sorted((word, p_id) for word, ids in postings.items() for p_id in ids))
+        for paragraph_id, text in paragraphs.items():
+            self.assertEqual(index.length(paragraph_id), len(paragraph_offsets(text)))
+
+    def test_add_update_delete(self):
+        generation = current_generation()
+        paragraphs = dict(zip(add_paragraphs(TEXTS), TEXTS))
+        self.assertIndexMatches(paragraphs)
+
+        ids = sorted(paragraphs)
+        update_paragraph(ids[2], 'Степан Аркадьич проснулся, и Левин проснулся.')
+        paragraphs[ids[2]] = 'Степан Аркадьич проснулся, и Левин проснулся.'
+        self.assertIndexMatches(paragraphs)
+
+        delete_paragraphs([ids[0], ids[4]])
+        del paragraphs[ids[0]], paragraphs[ids[4]]
+        self.assertIndexMatches(paragraphs)
+
+        paragraphs.update(zip(add_paragraphs(['Новый абзац про Анну.']), ['Новый абзац про Анну.']))
+        self.assertIndexMatches(paragraphs)
+        # every change is a new generation
+        self.assertEqual(current_generation(), generation + 4)
+
+    def test_update_missing_paragraph(self):
+        with self.assertRaises(Paragraph.DoesNotExist):
+            update_paragraph(1, 'Текст')
+
+    def test_ids_are_allocated_in_disjoint_ranges(self):
+        first = allocate_ids(Paragraph, 3)
+        self.assertEqual(allocate_ids(Paragraph, 2), first + 3)
+        paragraph_ids = add_paragraphs(TEXTS[:2])
+        self.assertEqual(paragraph_ids, [first + 5, first + 6])
+        # ids of deleted paragraphs are not reused
+        delete_paragraphs(paragraph_ids)
+        self.assertEqual(add_paragraphs(TEXTS[:1]), [first + 7])
+        # words have counters of their own
+        self.assertEqual(allocate_ids(Word, 1), Word.objects.order_by('-id')[0].id + 1)
+
+
+class RankingTests(TestCase):
+
+    def setUp(self):
+        self.ids = add_paragraphs(['кити кити кити', 'кити левин', 'кити левин левин левин левин левин', 'левин'])
+        self.index = InvertedIndex.from_db()
+
+    def ranked_ids(self, query, start=0, stop=None):
+        return search.search(parse_query(query), self.index, ranked=True).ids(start, stop)
+
+    def test_bm25_order(self):
+        # more occurrences first, shorter paragraphs first for the same number of them
+        self.assertEqual(self.ranked_ids('кити'), self.ids[:3])
+        self.assertEqual(self.ranked_ids('левин'), [self.ids[2], self.ids[3], self.ids[1]])
+
+    def test_paragraphs_without_query_words_come_last(self):
+        # words under NOT don't score, `левин` matches only through NOT
+        self.assertEqual(self.ranked_ids('кити OR NOT кити'), self.ids)
+        self.assertEqual(self.ranked_ids('NOT кити'), self.ids[3:])
+
+    def test_slices(self):
+        ranked = self.ranked_ids('кити OR левин')
+        self.assertEqual(sorted(ranked), self.ids)
+        for start, stop in ((0, 1), (1, 3), (2, 10), (3, 3)):
+            with self.subTest(start=start, stop=stop):
+                self.assertEqual(self.ranked_ids('кити OR левин', start, stop), ranked[start:stop])
+
+
+class SnippetTests(TestCase):
+
+    def paragraph(self, text):
+        return Paragraph(text=text, offsets=encode_spans(paragraph_scan(text)[1]))
+
+    def test_scan(self):
+        text = 'Анна. Анна Аркадьевна, по-моему'
+        positions, spans = paragraph_scan(text)
+        self.assertEqual(positions, {'анна': [0, 1], 'аркадьевна': [2], 'по-моему': [3]})
+        self.assertEqual([text[start:end] for start, end in spans], ['Анна', 'Анна', 'Аркадьевна', 'по-моему'])
+        self.assertEqual(spans, paragraph_offsets(text))
+
+    def test_highlight(self):
+        self.assertEqual(make_snippet(self.paragraph(TEXTS[2]), {'степан'}),
+                         '<mark>Степан</mark> Аркадьич Облонский проснулся на сафьянном диване. '
+                         '<mark>Степан</mark> Аркадьич был доволен.')
+        self.assertEqual(make_snippet(self.paragraph('<Анна> & Вронский'), {'анна'}),
+                         '&lt;<mark>Анна</mark>&gt; &amp; Вронский')
+
+    def test_window(self):
+        # 8 words of context before the first match, 10 words in all
+        self.assertEqual(make_snippet(self.paragraph(TEXTS[1]), {'бывшею'}, size=10),
+                         '&hellip; Жена узнала, что муж был в связи с <mark>бывшею</mark> в &hellip;')
+
+    def test_paragraphs_without_offsets(self):
+        paragraph = self.paragraph(TEXTS[1])
+        snippet = make_snippet(paragraph, {'доме'}, size=5)
+        paragraph.offsets = b''
+        self.assertEqual(make_snippet(paragraph, {'доме'}, size=5), snippet)
+
+    def test_stored_offsets(self):
+        paragraph_ids = add_paragraphs(TEXTS[:2])
+        update_paragraph(paragraph_ids[1], TEXTS[3])
+        for paragraph_id, text in zip(paragraph_ids, (TEXTS[0], TEXTS[3])):
+            paragraph = Paragraph.objects.get(id=paragraph_id)
+            self.assertEqual(decode_spans(bytes(paragraph.offsets)), paragraph_offsets(text))
+            self.assertEqual(paragraph.length, len(paragraph_offsets(text)))
+
+
+class ParallelPopulateTests(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(fd, 'w') as f:
+            # enough lines for several chunks per worker, with empty ones and a last line without a newline
+            f.write('\n'.join(TEXTS * 8 + ['', 'Кити.', '']) + 'Левин')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_same_as_serial(self):
+        # populate.py sits next to manage.py, outside of the app
+        from populate import build_index, build_index_parallel, chunk_offsets
+        with open(self.path) as f:
+            expected = build_index(f)
+        self.assertEqual(len(chunk_offsets(self.path, 8)), 8)
+        for workers in (1, 2, 3):
+            with self.subTest(workers=workers):
+                self.assertEqual(build_index_parallel(self.path, workers), expected)
+
+
+class IndexFileTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'index.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def mapped(self, index):
+        write_index_file(self.path, index)
+        return MappedIndex(self.path)
+
+    def assertSameIndex(self, mapped, index):
+        self.assertEqual(mapped.generation, index.generation)
+        self.assertEqual(list(mapped.paragraph_ids), list(index.paragraph_ids))
+        self.assertEqual(list(mapped.words), list(index.words))
+        self.assertEqual({name: list(ids) for name, ids in mapped.corpora.items()},
+                         {name: list(ids) for name, ids in index.corpora.items()})
+        self.assertEqual(mapped.avg_length, index.avg_length)
+        for paragraph_id in index.paragraph_ids:
+            self.assertEqual(mapped.length(paragraph_id), index.length(paragraph_id))
+        for word in index.words:
+            self.assertEqual(list(mapped.postings(word)), list(index.postings(word)), word)
+            self.assertEqual(mapped.df(word), index.df(word), word)
+            self.assertEqual(mapped.positions(word), index.positions(word), word)
+
+    def test_round_trip(self):
+        add_paragraphs(TEXTS)
+        add_paragraphs(OTHER_TEXTS, get_corpus_id('other'))
+        index = InvertedIndex.from_db()
+        mapped = self.mapped(index)
+        self.assertSameIndex(mapped, index)
+        self.assertNotIn('вронский', mapped)
+        self.assertEqual(list(mapped.postings('вронский')), [])
+        self.assertEqual(mapped.words_with_prefix('аркадь'), index.words_with_prefix('аркадь'))
+        for query in ('степан', 'кити AND NOT левин', '"степан аркадьич"', 'кити NEAR/3 анна', 'аркадь*',
+                      'corpus:other AND степан', 'NOT corpus:default'):
+            with self.subTest(query=query):
+                ast = parse_query(query)
+                self.assertEqual(list(mapped.ids(ast.eval(mapped))), list(index.ids(ast.eval(index))))
+
+    def test_empty_index(self):
+        self.assertSameIndex(self.mapped(InvertedIndex.from_db()), InvertedIndex.from_db())
+
+    def test_replaced_file(self):
+        add_paragraphs(TEXTS[:2])
+        old_index = InvertedIndex.from_db()
+        old = self.mapped(old_index)
+        add_paragraphs(TEXTS[2:])
+        new_index = InvertedIndex.from_db()
+        new = self.mapped(new_index)
+        # the old mapping still reads the file it was opened with
+        self.assertSameIndex(old, old_index)
+        self.assertSameIndex(new, new_index)
+
+    def test_invalid_files(self):
+        write_index_file(self.path, InvertedIndex.from_db())
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        for name, contents in [('other magic', b'ANNAIDX2' + data[len(MAGIC):]), ('truncated', data[:-1]),
+                               ('too short', data[:10]), ('empty', b'\0')]:
+            with self.subTest(name):
+                with open(self.path, 'wb') as f:
+                    f.write(contents)
+                with self.assertRaises(IndexFileError):
+                    MappedIndex(self.path)
+
+
+class StreamApiTests(TestCase):
+
+    BACKENDS = ['anna.backends.IndexBackend', 'anna.backends.SQLBackend']
+    if connection.vendor == 'sqlite':
+        BACKENDS.append('anna.backends.FTS5Backend')
+
+    def setUp(self):
+        # caches and backends of the process outlive the rows of other tests, FTS5 table among them
+        result_cache.clear()
+        backends._backends.clear()
+        self.paragraphs = dict(zip(add_paragraphs(TEXTS + OTHER_TEXTS), TEXTS + OTHER_TEXTS))
+        index_manager.swap(InvertedIndex.from_db())
+
+    def get(self, **params):
+        response = self.client.get('/api/search/', params)
+        if response.streaming:
+            return response.status_code, [json.loads(line) for line in
+                                          b''.join(response.streaming_content).decode('utf-8').splitlines()]
+        return response.status_code, json.loads(response.content.decode('utf-8'))
+
+    def test_stream(self):
+        expected = sorted(p_id for p_id, text in self.paragraphs.items() if 'Кити' in text or 'Степан' in text)
+        for path in self.BACKENDS:
+            with self.subTest(backend=path), override_settings(ANNA_SEARCH_BACKEND=path):
+                status, lines = self.get(query='кити OR степан')
+                self.assertEqual(status, 200)
+                self.assertEqual([line['id'] for line in lines[:-1]], expected)
+                self.assertEqual(lines[0]['text'], self.paragraphs[expected[0]])
+                self.assertEqual(lines[-1], {'cursor': None})
+                self.assertEqual(self.get(query='кити OR степан', count_only=1), (200, {'count': len(expected)}))
+
+    def test_cursor(self):
+        expected = sorted(p_id for p_id, text in self.paragraphs.items() if 'Кити' in text or 'Степан' in text)
+        for path in self.BACKENDS:
+            with self.subTest(backend=path), override_settings(ANNA_SEARCH_BACKEND=path):
+                ids, params = [], {'query': 'кити OR степан', 'limit': 2}
+                while True:
+                    status, lines = self.get(**params)
+                    self.assertEqual(status, 200)
+                    self.assertLessEqual(len(lines), 3)
+                    ids.extend(line['id'] for line in lines[:-1])
+                    if lines[-1]['cursor'] is None:
+                        break
+                    params['cursor'] = lines[-1]['cursor']
+                self.assertEqual(ids, expected)
+
+    def test_batches(self):
+        ast = parse_query('NOT вронский')
+        ids = sorted(self.paragraphs)
+        candidates = [backends.IndexBackend(), backends.SQLBackend()]
+        if connection.vendor == 'sqlite':
+            candidates.append(backends.FTS5Backend())
+        for backend in candidates:
+            with self.subTest(backend=backend.name):
+                results = backend.stream(ast)
+                self.assertEqual([p.id for p in results.stream(batch_size=2)], ids)
+                self.assertEqual([p.id for p in results.stream(after=ids[1], limit=3, batch_size=2)], ids[2:5])
+                self.assertTrue(results.has_after(ids[-2]))
+                self.assertFalse(results.has_after(ids[-1]))
+
+    def test_invalid_requests(self):
+        for params in ({'query': 'кити', 'limit': 0}, {'query': 'кити', 'limit': 'x'},
+                       {'query': 'кити', 'cursor': '!!'}, {'query': 'кити AND'}, {'query': '"кити'}):
+            with self.subTest(params=params):
+                self.assertEqual(self.get(**params)[0], 400)
+
+    def test_backend_without_streaming(self):
+        with override_settings(ANNA_SEARCH_BACKEND='anna.backends.ShardedBackend', ANNA_SHARD_WORKERS=0):
+            status, data = self.get(query='кити')
+        self.assertEqual(status, 501)
+        self.assertEqual(data, {'error': 'Streaming is not supported by sharded search'})
+
+
+class BatchApiTests(TestCase):
+
+    QUERIES = ['степан', 'степан AND доме', 'кити AND', 'степан OR кити', 'степан AND NOT доме', 'NOT кити']
+
+    def setUp(self):
+        # caches, backends and shards of the process outlive the rows of other tests
+        result_cache.clear()
+        backends._backends.clear()
+        shards._shards.clear()
+        add_paragraphs(TEXTS + OTHER_TEXTS)
+        index_manager.swap(InvertedIndex.from_db())
+
+    def post(self, data):
+        response = self.client.post('/api/batch/', json.dumps(data), content_type='application/json')
+        return response.status_code, json.loads(response.content.decode('utf-8'))
+
+    def expected(self, limit=None):
+        index = InvertedIndex.from_db()
+        results = []
+        for query in self.QUERIES:
+            ast = parse_query(query)
+            if ast is None:
+                results.append({'query': query, 'error': 'Parsing error'})
+            else:
+                ids = list(index.ids(ast.eval(index)))
+                results.append({'query': query, 'count': len(ids), 'ids': ids[:limit]})
+        return results
+
+    def test_backends(self):
+        paths = ['anna.backends.IndexBackend', 'anna.backends.SQLBackend', 'anna.backends.ShardedBackend']
+        if connection.vendor == 'sqlite':
+            paths.append('anna.backends.FTS5Backend')
+        for path in paths:
+            for limit in (None, 0, 1):
+                with self.subTest(backend=path, limit=limit), \
+                        override_settings(ANNA_SEARCH_BACKEND=path, ANNA_SHARD_WORKERS=0):
+                    status, data = self.post({'queries': self.QUERIES, 'limit': limit})
+                    self.assertEqual(status, 200)
+                    self.assertEqual(data['results'], self.expected(limit))
+                    if path.endswith('IndexBackend'):
+                        # `степан` and `доме` are evaluated once for all queries
+                        self.assertLess(data['evaluated'], 10)
+                    else:
+                        self.assertIsNone(data['evaluated'])
+
+    def test_query_errors(self):
+        with override_settings(ANNA_WILDCARD_MAX_TERMS=3):
+            status, data = self.post({'queries': ['"кити', 'с*']})
+        self.assertEqual(status, 200)
+        self.assertEqual([set(result) for result in data['results']], [{'query', 'error'}] * 2)
+        with override_settings(ANNA_SEARCH_BACKEND='anna.backends.SQLBackend'):
+            status, data = self.post({'queries': ['"степан аркадьич"', 'степан']})
+        self.assertIn('error', data['results'][0])
+        self.assertEqual(data['results'][1]['count'], 3)
+
+    def test_invalid_requests(self):
+        for data in ({'queries': ['кити'], 'limit': True}, {'queries': ['кити'], 'limit': -1},
+                     {'queries': ['кити'], 'limit': '1'}, {'queries': 'кити'}, {'queries': [1]}, ['кити']):
+            with self.subTest(data=data):
+                self.assertEqual(self.post(data)[0], 400)
+        with override_settings(ANNA_BATCH_MAX_QUERIES=1):
+            self.assertEqual(self.post({'queries': ['кити', 'анна']})[0], 400)
+        response = self.client.post('/api/batch/', 'queries', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        result_cache.clear()
+        parse_query.cache_clear()
+        metrics.registry.reset()
+        add_paragraphs(TEXTS)
+        index_manager.swap(InvertedIndex.from_db())
+
+    def test_collect(self):
+        with metrics.collect() as request_metrics:
+            with metrics.stage('a'):
+                Paragraph.objects.count()
+            with metrics.stage('b'):
+                metrics.count_rows(len(list(Paragraph.objects.all())))
+            with metrics.stage('a'):
+                pass
+        self.assertEqual(list(request_metrics.stages), ['a', 'b'])
+        self.assertEqual((request_metrics.queries, request_metrics.rows), (2, len(TEXTS)))
+        self.assertGreaterEqual(request_metrics.total, sum(request_metrics.stages.values()))
+        # nothing is collected outside of collect()
+        with metrics.stage('c'):
+            metrics.count_rows(1)
+            Paragraph.objects.count()
+        self.assertIsNone(metrics.current())
+        self.assertEqual((request_metrics.queries, request_metrics.rows), (2, len(TEXTS)))
+
+    def test_histogram(self):
+        histogram = metrics.Histogram()
+        for ms in (0.5, 1, 3, 7000):
+            histogram.observe(ms)
+        buckets = histogram.as_dict()['buckets_ms']
+        self.assertEqual((buckets['1'], buckets['2'], buckets['5'], buckets['5000'], buckets['+Inf']), (2, 2, 3, 3, 4))
+        self.assertEqual(histogram.as_dict()['count'], 4)
+
+    def test_requests(self):
+        self.client.get('/results/', {'query': 'степан'})
+        self.client.get('/results/', {'query': 'степан AND'})
+        data = json.loads(self.client.get('/metrics/').content.decode('utf-8'))
+        counters = data['counters']
+        self.assertEqual((counters['requests'], counters['errors'], counters['slow_queries']), (2, 1, 0))
+        # paragraphs of the page are fetched, the index is already loaded
+        self.assertEqual(counters['rows'], 2)
+        self.assertGreater(counters['sql_queries'], 0)
+        self.assertLessEqual({'total', 'lex', 'parse', 'eval', 'fetch', 'snippets', 'render'}, set(data['histograms']))
+        self.assertEqual(data['histograms']['total']['count'], 2)
+        self.assertEqual(data['parse_cache']['misses'], 2)
+        self.assertEqual(data['index']['generation'], current_generation())
+
+    def test_slow_query_log(self):
+        with override_settings(ANNA_SLOW_QUERY_MS=0), self.assertLogs('anna.metrics', 'WARNING') as logs:
+            self.client.get('/results/', {'query': 'Степан AND доме'})
+        self.assertEqual(len(logs.output), 1)
+        entry = json.loads(logs.output[0].split('slow query: ', 1)[1])
+        self.assertEqual(entry['query'], 'Степан AND доме')
+        # canonical form of the query, operands are sorted
+        self.assertEqual(entry['ast'], ['AND', [['WORD', 'доме'], ['WORD', 'степан']]])
+        self.assertIsNone(entry['error'])
+        self.assertEqual(set(entry), {'query', 'ast', 'error', 'total_ms', 'stages_ms', 'queries', 'rows'})
+        self.assertEqual(metrics.registry.snapshot()['counters']['slow_queries'], 1)
+
+
+class CountTests(TestCase):
+
+    QUERIES = ['степан', 'степан AND аркадьич', 'кити OR анна', 'NOT доме', 'степан AND NOT вышел', 'вронский',
+               'corpus:other AND степан']
+
+    def setUp(self):
+        result_cache.clear()
+        backends._backends.clear()
+        shards._shards.clear()
+        add_paragraphs(TEXTS)
+        add_paragraphs(OTHER_TEXTS, get_corpus_id('other'))
+        self.index = InvertedIndex.from_db()
+        index_manager.swap(self.index)
+
+    def test_count(self):
+        cache = ResultCache(100)
+        for query in self.QUERIES:
+            ast = parse_query(query)
+            with self.subTest(query=query):
+                n = len(self.index.ids(ast.eval(self.index)))
+                self.assertEqual(search.count(ast, self.index, cache), n)
+                # counts are cached on their own, ids are never extracted
+                self.assertEqual(cache.get(('COUNT', ast.canonical()), self.index.generation), n)
+                self.assertIsNone(cache.get(ast.canonical(), self.index.generation))
+
+    def test_cached_results_are_counted(self):
+        cache = ResultCache(100)
+        ast = parse_query('кити OR анна')
+        bitmap = search.evaluate(ast, self.index, cache)
+        self.assertEqual(search.count(ast, self.index, cache), len(self.index.ids(bitmap)))
+        self.assertIsNone(cache.get(('COUNT', ast.canonical()), self.index.generation))
+
+    def test_api(self):
+        expected = [{'query': query, 'count': search.count(parse_query(query), self.index, ResultCache(1))}
+                    for query in self.QUERIES]
+        for path in ('anna.backends.IndexBackend', 'anna.backends.SQLBackend', 'anna.backends.ShardedBackend'):
+            with self.subTest(backend=path), override_settings(ANNA_SEARCH_BACKEND=path, ANNA_SHARD_WORKERS=0):
+                response = self.client.get('/api/count/', {'query': self.QUERIES})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(json.loads(response.content.decode('utf-8')), {'counts': expected})
+
+    def test_api_errors(self):
+        response = self.client.get('/api/count/', {'query': ['кити AND', '"кити', 'кити']})
+        counts = json.loads(response.content.decode('utf-8'))['counts']
+        self.assertEqual(counts[0], {'query': 'кити AND', 'error': 'Parsing error'})
+        self.assertEqual(set(counts[1]), {'query', 'error'})
+        self.assertEqual(counts[2], {'query': 'кити', 'count': 2})
+        self.assertEqual(json.loads(self.client.get('/api/count/').content.decode('utf-8')), {'counts': []})
+        with override_settings(ANNA_BATCH_MAX_QUERIES=1):
+            self.assertEqual(self.client.get('/api/count/', {'query': ['кити', 'анна']}).status_code, 400)
+
+
+class SQLCompileTests(TestCase):
+
+    QUERIES = [
+        'степан', 'Степан', 'анна', 'вронский', 'по-своему', 'анн*', 'облонск*', 'a_*', 'a%*',
+        'степан AND аркадьич', 'степан OR кити', 'NOT степан', 'степан AND NOT доме', 'NOT ( анна OR кити )',
+        '( кити OR левин ) AND NOT ( доме OR a_b )', '"степан"',
+    ]
+
+    def setUp(self):
+        # `_` and `%` of wildcards are literal, not LIKE patterns
+        add_paragraphs(TEXTS + ['a_b', 'axb', 'a%b'])
+        self.index = InvertedIndex.from_db()
+
+    def test_queries_match_index(self):
+        for query in self.QUERIES:
+            ast = parse_query(query)
+            expected = list(self.index.ids(ast.eval(self.index)))
+            condition, params = sql.compile_condition(ast)
+            with self.subTest(query=query):
+                self.assertEqual(sql.count_matches(condition, params), len(expected))
+                for start, stop in ((0, 100), (1, 3), (2, 2)):
+                    count, paragraphs = sql.search_page(condition, params, start, stop)
+                    self.assertEqual((count, [p.id for p in paragraphs]), (len(expected), expected[start:stop]))
+
+    def test_results_prefetch_page(self):
+        ast = parse_query('степан OR кити OR доме')
+        expected = list(self.index.ids(ast.eval(self.index)))
+        with metrics.collect() as request_metrics:
+            results = sql.SQLResults(*sql.compile_condition(ast), prefetch=(1, 3))
+            self.assertEqual(len(results), len(expected))
+            self.assertEqual([p.id for p in results[1:3]], expected[1:3])
+        # count and the page come from one statement
+        self.assertEqual(request_metrics.queries, 1)
+        self.assertEqual([p.id for p in results[0:1]], expected[:1])
+
+    def test_positional_queries_are_unsupported(self):
+        for query in ('"степан аркадьич"', 'степан NEAR/2 аркадьич'):
+            with self.subTest(query=query):
+                with self.assertRaises(UnsupportedQuery):
+                    sql.compile_condition(parse_query(query))
+
+
+class BackendAgreementTests(TestCase):
+
+    QUERIES = [
+        'степан', 'Степан', 'анна', 'нет', 'по-своему', 'анна.', 'Анна.', 'анн*', 'облонск*', 'анна.*',
+        'степан AND аркадьич', 'степан OR кити', 'NOT степан', 'степан AND NOT доме', 'NOT ( анна OR кити )',
+        '"степан аркадьич"', '"аркадьич степан"', '"в доме"', '"степан" NEAR/1 аркадьич',
+        'степан NEAR/3 доме', 'степан NEAR/3 вошла', 'вошла NEAR/3 степан', 'степан NEAR/2 вошла',
+        'кити NEAR/1 левин', 'кити NEAR/2 левин', 'аркадь* NEAR/1 анна', 'степан NEAR/0 аркадьич',
+        'анна NEAR/1 анна', 'анн* NEAR/1 анна', 'кити NEAR/3 кити', '"анна аркадьевна" NEAR/2 вошла',
+        '"в доме" NEAR/3 облонских', 'степан NEAR/3 "вышел к"', 'NOT степан NEAR/5 вошла',
+        # `что` follows the phrase, but it's 2 positions from its first word
+        '"жена узнала" NEAR/1 что',
+        'corpus:other', 'corpus:other AND степан', 'NOT corpus:default', 'corpus:default OR corpus:other AND кити',
+        'corpus:nothing OR анна',
+    ]
+
+    def setUp(self):
+        # caches and shards of the process outlive the rows of other tests
+        result_cache.clear()
+        shards._shards.clear()
+        add_paragraphs(TEXTS)
+        add_paragraphs(OTHER_TEXTS, get_corpus_id('other'))
+        index_manager.swap(InvertedIndex.from_db())
+
+    def candidates(self):
+        with override_settings(ANNA_SHARD_WORKERS=0):
+            candidates = [backends.IndexBackend(), backends.SQLBackend(), backends.ShardedBackend()]
+        if connection.vendor == 'sqlite':
+            candidates.append(backends.FTS5Backend())
+        return candidates
+
+    def test_backends_agree(self):
+        reference = backends.IndexBackend()
+        for query in self.QUERIES:
+            ast = parse_query(query)
+            expected = reference.page(ast, 0, 100)
+            for backend in self.candidates():
+                with self.subTest(query=query, backend=backend.name):
+                    try:
+                        self.assertEqual(backend.page(ast, 0, 100), expected)
+                        self.assertEqual(backend.count(ast), expected[0])
+                    except UnsupportedQuery:
+                        # backends refuse queries they can't evaluate exactly, they never answer differently
+                        self.assertNotEqual(backend.name, 'index')
+
+    def test_fts5_near(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('FTS5 works only with SQLite')
+        supported = ['степан NEAR/3 вошла', 'кити NEAR/1 левин', 'аркадь* NEAR/1 анна', '"степан" NEAR/1 аркадьич']
+        unsupported = ['степан NEAR/0 аркадьич', 'анна NEAR/1 анна', 'анн* NEAR/1 анна', '"в доме" NEAR/3 облонских',
+                       '( кити NEAR/1 левин ) NEAR/2 любила']
+        for query in supported:
+            with self.subTest(query=query):
+                self.assertTrue(backends.fts_query(parse_query(query))[1].startswith('NEAR('))
+        self.assertEqual(backends.fts_query(parse_query('кити NEAR/3 левин')), (True, 'NEAR("кити" "левин", 2)'))
+        for query in unsupported:
+            with self.subTest(query=query):
+                with self.assertRaises(UnsupportedQuery):
+                    backends.fts_query(parse_query(query))
+
+
+class ShardTests(TestCase):
+
+    def test_shard_names(self):
+        for query, names in [('кити', None), ('corpus:a', {'a'}), ('corpus:a AND кити', {'a'}),
+                             ('corpus:a OR corpus:b', {'a', 'b'}), ('corpus:a AND corpus:b', set()),
+                             ('corpus:a OR кити', None), ('NOT corpus:a', None)]:
+            with self.subTest(query=query):
+                self.assertEqual(shards.shard_names(parse_query(query)), names)
+
+
+class ShardPoolTests(TransactionTestCase):
+    """
+    Worker processes are forked with a copy of the test database, so rows are added before the pool is created
+    """
+    QUERIES = ['степан', 'кити OR анна', 'NOT кити', 'corpus:other', 'corpus:third AND степан', '"степан аркадьич"']
+
+    def setUp(self):
+        result_cache.clear()
+        shards._shards.clear()
+        add_paragraphs(TEXTS[:3])
+        add_paragraphs(OTHER_TEXTS, get_corpus_id('other'))
+        add_paragraphs(TEXTS[3:] + ['Степан уехал.'], get_corpus_id('third'))
+        self.pool = shards.ShardPool(2)
+        self.addCleanup(self.pool.close)
+
+    def test_workers_match_index(self):
+        index = InvertedIndex.from_db()
+        for query in self.QUERIES:
+            ast = parse_query(query)
+            ids = list(index.ids(ast.eval(index)))
+            with self.subTest(query=query):
+                self.assertEqual(self.pool.count(ast), len(ids))
+                self.assertEqual(self.pool.search(ast, 0, 100), (len(ids), ids))
+                self.assertEqual(self.pool.search(ast, 1, 3), (len(ids), ids[1:3]))
+
+    def test_ranked(self):
+        local = shards.ShardPool(0)
+        ast = parse_query('степан OR кити')
+        self.assertEqual(self.pool.search(ast, 0, 100, ranked=True), local.search(ast, 0, 100, ranked=True))
+
+
+class Snapshot:
+
+    def __init__(self, generation):
+        self.generation = generation
+
+    def __repr__(self):
+        return 'Snapshot({})'.format(self.generation)
+
+
+class IndexManagerTests(TestCase):
+
+    def setUp(self):
+        self.generation = 1
+        self.loads = 0
+        # loads wait for it, so the test sees the manager while a snapshot is being loaded
+        self.release = threading.Event()
+        self.release.set()
+        self.manager = IndexManager(self.load)
+
+    def load(self):
+        self.loads += 1
+        self.release.wait(5)
+        return Snapshot(self.generation)
+
+    def wait_for_load(self):
+        for thread in threading.enumerate():
+            if thread.name == 'anna-index-loader':
+                thread.join(5)
+
+    def test_first_snapshot_is_loaded_once(self):
+        self.assertFalse(self.manager.loaded)
+        # nothing to refresh before the first load
+        self.manager.refresh(2)
+        self.assertEqual(self.loads, 0)
+        snapshot = self.manager.get()
+        self.assertIs(self.manager.get(), snapshot)
+        self.assertTrue(self.manager.loaded)
+        self.assertEqual((self.loads, self.manager.swaps), (1, 0))
+
+    def test_refresh_swaps_in_background(self):
+        old = self.manager.get()
+        self.manager.refresh(1)
+        self.assertEqual(self.loads, 1)
+
+        self.release.clear()
+        self.generation = 2
+        self.manager.refresh(2)
+        # requests are served from the old snapshot meanwhile, only one load at a time
+        self.assertIs(self.manager.get(), old)
+        self.manager.refresh(2)
+        self.release.set()
+        self.wait_for_load()
+        self.assertEqual(self.manager.get().generation, 2)
+        self.assertEqual((self.loads, self.manager.swaps), (2, 1))
+
+    def test_failed_load_keeps_snapshot(self):
+        old = self.manager.get()
+        self.manager.loader = lambda: 1 / 0
+        with self.assertLogs('anna.index', 'ERROR'):
+            self.manager.refresh(2)
+            self.wait_for_load()
+        self.assertIs(self.manager.get(), old)
+        # the next refresh tries again
+        self.manager.loader = self.load
+        self.generation = 2
+        self.manager.refresh(2)
+        self.wait_for_load()
+        self.assertEqual(self.manager.get().generation, 2)
+
+    def test_pinned(self):
+        first = self.manager.get()
+        with self.manager.pinned():
+            self.assertIs(self.manager.get(), first)
+            self.manager.swap(Snapshot(2))
+            self.assertIs(self.manager.get(), first)
+            with self.manager.pinned():
+                self.assertIs(self.manager.get(), first)
+            self.assertIs(self.manager.get(), first)
+            # other threads get the current snapshot
+            other = []
+            thread = threading.Thread(target=lambda: other.append(self.manager.get()))
+            thread.start()
+            thread.join()
+            self.assertEqual(other[0].generation, 2)
+        self.assertEqual(self.manager.get().generation, 2)
+
+    def test_pinning_alone_loads_nothing(self):
+        with self.manager.pinned():
+            pass
+        self.assertFalse(self.manager.loaded)
+        with self.manager.pinned():
+            self.manager.swap(Snapshot(3))
+            self.assertEqual(self.manager.get().generation, 3)
+        self.assertEqual(self.loads, 0)
+
+
+class RetiredParagraphTests(TestCase):
+
+    def setUp(self):
+        result_cache.clear()
+        self.ids = add_paragraphs(TEXTS)
+
+    def test_old_index_still_fetches_retired_paragraphs(self):
+        old = InvertedIndex.from_db()
+        delete_paragraphs(self.ids[2:3])
+        new = InvertedIndex.from_db()
+        ast = parse_query('степан')
+        self.assertEqual([p.id for p in search.search(ast, old)[0:10]], [self.ids[2], self.ids[3]])
+        self.assertEqual([p.id for p in search.search(ast, new)[0:10]], [self.ids[3]])
+        self.assertEqual(Paragraph.objects.filter(retired__isnull=False).count(), 1)
+        with self.assertRaises(Paragraph.DoesNotExist):
+            update_paragraph(self.ids[2], 'Текст')
+
+    def test_backends_ignore_retired_paragraphs(self):
+        delete_paragraphs(self.ids[2:3])
+        index_manager.swap(InvertedIndex.from_db())
+        candidates = [backends.IndexBackend(), backends.SQLBackend()]
+        if connection.vendor == 'sqlite':
+            candidates.append(backends.FTS5Backend())
+        ast = parse_query('степан OR сафьянном')
+        for backend in candidates:
+            with self.subTest(backend=backend.name):
+                self.assertEqual(backend.count(ast), 1)
+                self.assertEqual(backend.page(ast, 0, 10), (1, [self.ids[3]]))
+
+    def test_purge(self):
+        delete_paragraphs(self.ids[:2])
+        purge_retired()
+        self.assertEqual(Paragraph.objects.count(), len(TEXTS))
+        with override_settings(ANNA_RETIRED_TTL=0):
+            purge_retired()
+        self.assertEqual(sorted(Paragraph.objects.values_list('id', flat=True)), self.ids[2:])
+
+
+class ResultCacheTests(TestCase):
+
+    def test_lru_eviction(self):
+        cache = ResultCache(2)
+        cache.put('a', 1, 10)
+        cache.put('b', 1, 20)
+        self.assertEqual(cache.get('a', 1), 10)
+        # `b` is the least recently used one now
+        cache.put('c', 1, 30)
+        self.assertIsNone(cache.get('b', 1))
+        self.assertEqual((cache.get('a', 1), cache.get('c', 1)), (10, 30))
+        self.assertEqual(cache.stats(), {'size': 2, 'maxsize': 2, 'hits': 3, 'misses': 1})
+
+    def test_generations_are_separate(self):
+        cache = ResultCache(10)
+        cache.put('a', 1, 10)
+        self.assertIsNone(cache.get('a', 2))
+        cache.put('a', 2, 20)
+        self.assertEqual((cache.get('a', 1), cache.get('a', 2)), (10, 20))
+
+    def test_equivalent_queries_share_results(self):
+        add_paragraphs(TEXTS)
+        index = InvertedIndex.from_db()
+        cache = ResultCache(10)
+        bitmap = search.evaluate(parse_query('степан AND доме'), index, cache)
+        self.assertEqual(search.evaluate(parse_query('( доме ) AND степан'), index, cache), bitmap)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 1, 1))
+
+    def test_new_generation_is_evaluated_again(self):
+        add_paragraphs(TEXTS)
+        cache = ResultCache(10)
+        ast = parse_query('степан')
+        old = InvertedIndex.from_db()
+        self.assertEqual(search.count(ast, old, cache), 2)
+        add_paragraphs(['Степан Аркадьич уехал.'])
+        new = InvertedIndex.from_db()
+        self.assertEqual(search.count(ast, new, cache), 3)
+        # the old index still gets its own result
+        self.assertEqual(search.count(ast, old, cache), 2)
+
+
+class PlannerTests(TestCase):
+
+    def setUp(self):
+        self.paragraphs = dict(zip(add_paragraphs(TEXTS), TEXTS))
+        self.index = InvertedIndex.from_db()
+
+    def test_plans_match_naive_evaluation(self):
+        words = ['степан', 'кити', 'анна', 'доме', 'нет']
+        tokens = {p_id: set(paragraph_positions(text)) for p_id, text in self.paragraphs.items()}
+        for a, b, c in product(words, repeat=3):
+            for query, match in [
+                ('{} AND {} AND NOT {}', lambda t: a in t and b in t and c not in t),
+                ('{} OR {} AND {}', lambda t: a in t or b in t and c in t),
+                ('NOT ( {} OR {} ) OR {}', lambda t: not (a in t or b in t) or c in t),
+                ('( {} AND NOT {} ) OR NOT {}', lambda t: a in t and b not in t or c not in t),
+            ]:
+                query = query.format(a, b, c)
+                ast = parse_query(query)
+                expected = [p_id for p_id in sorted(tokens) if match(tokens[p_id])]
+                with self.subTest(query=query):
+                    self.assertEqual(list(self.index.ids(ast.eval(self.index))), expected)
+                    self.assertEqual(list(self.index.ids(plan(ast, self.index).eval(self.index))), expected)
+                    self.assertEqual(plan(ast, self.index).count(self.index), len(expected))
@@ -6,4 +6,8 @@ app_name = 'anna'
 urlpatterns = [
     url(r'^$', views.index, name='index'),
     url(r'^results/$', views.searchResults, name='results'),
+    url(r'^api/search/$', views.searchStream, name='search_stream'),
+    url(r'^api/count/$', views.searchCount, name='search_count'),
+    url(r'^api/batch/$', views.searchBatch, name='search_batch'),
+    url(r'^metrics/$', views.searchMetrics, name='metrics'),
 ]
@@ -1,12 +1,30 @@
+import json
+import logging
+
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.shortcuts import render
-from django.http import HttpResponse
-from .models import Paragraph, Word
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from . import metrics
 from .forms import QueryForm
+from .ast import QueryError
+from .backends import get_backend
+from .cache import result_cache
+from .index import index_manager
+from .search import encode_cursor, decode_cursor
+from .snippets import make_snippet
 
 # parser imports
-from .lexer import anna_lexer
-from .parser import parse
+from .lexer import LexerError
+from .parser import parse_query
+
+
+logger = logging.getLogger(__name__)
+
+# number of paragraphs on a results page
+RESULTS_PER_PAGE = 10
 
 
 def index(request):
@@ -21,47 +39,217 @@ def index(request):
 def searchResults(request):
     """
     view for the results page
+
+    Stages of the search are timed, see metrics.py
+    All stages use the same index snapshot, even if a new one is swapped in meanwhile (see index.IndexManager).
     """
     context = {}
     query = request.GET.get('query')
-    print('User query: {q}'.format(q=query))
+    logger.debug('User query: %s', query)
     context['query'] = query
+    # rank results by relevance instead of ordering them by paragraph
+    ranked = bool(request.GET.get('ranked'))
+    context['ranked'] = ranked
 
     form = QueryForm(request.GET)
     context['form'] = form
 
-    if len(query) > 0:
-        # search in db
+    ast = None
+    with index_manager.pinned(), metrics.collect() as request_metrics:
+        if len(query) > 0:
+            # search in db
+            try:
+                paragraphs = None
+
+                # lex and parse the query
+                ast = parse_query(query)
+
+                if not ast:
+                    logger.debug('Parsing error')
+                    context['error'] = 'Parsing error'
+                else:
+                    logger.debug('AST: %s', ast)
+
+                    # evaluate AST with the configured backend, paginator fetches only paragraphs of the requested page,
+                    # backends may fetch them along with the count
+                    backend = get_backend()
+                    page = request.GET.get('page')
+                    page_start = (int(page) - 1) * RESULTS_PER_PAGE if page and page.isdigit() and int(page) > 0 else 0
+                    res = backend.results(ast, prefetch=(page_start, page_start + RESULTS_PER_PAGE), ranked=ranked)
+                    paginator = Paginator(res, RESULTS_PER_PAGE)
+                    context['num_paragraphs'] = paginator.count
+                    try:
+                        paragraphs = paginator.page(page)
+                    except PageNotAnInteger:
+                        # If page is not an integer, deliver first page
+                        paragraphs = paginator.page(1)
+                    except EmptyPage:
+                        # If page is out of range, deliver last page of results
+                        paragraphs = paginator.page(paginator.num_pages)
+
+                    # show snippets around matched words instead of full paragraphs
+                    with metrics.stage('snippets'):
+                        words = backend.query_words(ast)
+                        for paragraph in paragraphs:
+                            paragraph.snippet = make_snippet(paragraph, words)
+                context['paragraphs'] = paragraphs
+            except (LexerError, QueryError) as e:
+                logger.debug('Query error: %s', e)
+                context['error'] = str(e)
+        with metrics.stage('render'):
+            response = render(request, 'anna/results.html', context)
+    if query:
+        metrics.record(request_metrics, query, ast, context.get('error'))
+    return response
+
+
+def searchMetrics(request):
+    """
+    JSON view of aggregate search metrics of the current process, see metrics.py
+    """
+    data = metrics.registry.snapshot()
+    data['result_cache'] = result_cache.stats()
+    data['parse_cache'] = parse_query.cache_info()._asdict()
+    snapshot = index_manager.get() if index_manager.loaded else None
+    data['index'] = {
+        'generation': snapshot.generation if snapshot else None,
+        'swaps': index_manager.swaps,
+    }
+    return JsonResponse(data)
+
+
+def _json_line(obj):
+    return json.dumps(obj, ensure_ascii=False) + '\n'
+
+
+def _stream_results(results, after, limit):
+    """
+    Yields NDJSON lines: one {"id", "text"} object per paragraph, then {"cursor"} -
+    token for the next request, null if there are no more results
+    """
+    last_id = None
+    for paragraph in results.stream(after=after, limit=limit):
+        last_id = paragraph.id
+        yield _json_line({'id': paragraph.id, 'text': paragraph.text})
+    more = limit is not None and last_id is not None and results.has_after(last_id)
+    yield _json_line({'cursor': encode_cursor(last_id) if more else None})
+
+
+@require_GET
+def searchStream(request):
+    """
+    JSON API view, streams paragraphs matching the query as NDJSON, ordered by id
+    Paragraphs come from the configured backend, 501 is returned if it can't stream them.
+
+    GET parameters:
+        query: search query
+        limit: max number of paragraphs to return, all of them if not given
+        cursor: token from the last line of the previous response, results continue after it
+        count_only: if set, only {"count": N} is returned
+    """
+    query = request.GET.get('query', '')
+    limit = request.GET.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            return JsonResponse({'error': 'Invalid limit'}, status=400)
+        limit = int(limit)
+    try:
+        cursor = request.GET.get('cursor')
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    try:
+        ast = parse_query(query)
+    except (LexerError, QueryError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if not ast:
+        return JsonResponse({'error': 'Parsing error'}, status=400)
+
+    backend = get_backend()
+    try:
+        if request.GET.get('count_only'):
+            return JsonResponse({'count': backend.count(ast)})
+        results = backend.stream(ast)
+        # query errors surface during evaluation, before streaming starts
+        lines = _stream_results(results, after, limit)
+    except NotImplementedError as e:
+        return JsonResponse({'error': str(e)}, status=501)
+    except QueryError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return StreamingHttpResponse(lines, content_type='application/x-ndjson; charset=utf-8')
+
+
+@require_GET
+def searchCount(request):
+    """
+    JSON API view, returns numbers of paragraphs matching queries without fetching any of them
+
+    GET parameters:
+        query: search query, can be repeated
+    Response: {"counts": [{"query", "count"} or {"query", "error"}, ...]} in the order of queries
+    """
+    queries = request.GET.getlist('query')
+    max_queries = getattr(settings, 'ANNA_BATCH_MAX_QUERIES', 1000)
+    if len(queries) > max_queries:
+        return JsonResponse({'error': 'At most {} queries per request'.format(max_queries)}, status=400)
+    backend = get_backend()
+    counts = []
+    # all queries are counted against the same index snapshot
+    with index_manager.pinned():
+        for query in queries:
+            try:
+                ast = parse_query(query)
+                if not ast:
+                    raise QueryError('Parsing error')
+                counts.append({'query': query, 'count': backend.count(ast)})
+            except (LexerError, QueryError) as e:
+                counts.append({'query': query, 'error': str(e)})
+    return JsonResponse({'counts': counts})
+
+
+@csrf_exempt
+@require_POST
+def searchBatch(request):
+    """
+    JSON API view, evaluates a batch of queries at once, subexpressions shared by queries are evaluated once
+
+    Request body: {"queries": [query, ...], "limit": N}, `limit` - max number of ids returned per query, all if omitted
+    Response: {"results": [{"query", "count", "ids"} or {"query", "error"}, ...], "evaluated": number of
+    distinct subexpressions evaluated, null for backends that evaluate queries one by one}, results are in
+    the order of queries
+    """
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except ValueError:
+        return JsonResponse({'error': 'Request body must be JSON'}, status=400)
+    queries = data.get('queries') if isinstance(data, dict) else None
+    limit = data.get('limit') if isinstance(data, dict) else None
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        return JsonResponse({'error': 'queries must be a list of strings'}, status=400)
+    max_queries = getattr(settings, 'ANNA_BATCH_MAX_QUERIES', 1000)
+    if len(queries) > max_queries:
+        return JsonResponse({'error': 'At most {} queries per batch'.format(max_queries)}, status=400)
+    # bool is an int too, `true` is not a limit
+    if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int) or limit < 0):
+        return JsonResponse({'error': 'Invalid limit'}, status=400)
+
+    asts = []
+    for query in queries:
         try:
-            paragraphs = None
-
-            # parse the query
-            tokens = anna_lexer(query)
-            print('Query tokens: {t}'.format(t=tokens))
-            parse_result = parse(tokens)
-
-            if not parse_result:
-                print('Parsing error')
-                context['error'] = 'Parsing error'
-            else:
-                # get AST and print to console
-                ast = parse_result.value
-                print('AST: {ast}'.format(ast=ast))
-
-                # get list from evaluated AST for paginator
-                res = [i for i in ast.eval()]
-                context['num_paragraphs'] = len(res)
-                paginator = Paginator(res, 10)
-                page = request.GET.get('page')
-                try:
-                    paragraphs = paginator.page(page)
-                except PageNotAnInteger:
-                    # If page is not an integer, deliver first page
-                    paragraphs = paginator.page(1)
-                except EmptyPage:
-                    # If page is out of range, deliver last page of results
-                    paragraphs = paginator.page(paginator.num_pages)
-            context['paragraphs'] = paragraphs
-        except Word.DoesNotExist:
-            print('Err: obj Word does not exist')
-    return render(request, 'anna/results.html', context)
+            ast = parse_query(query)
+            asts.append(ast if ast else QueryError('Parsing error'))
+        except (LexerError, QueryError) as e:
+            asts.append(e)
+    # all queries are evaluated by the configured backend against the same index snapshot
+    with index_manager.pinned():
+        answers, evaluated = get_backend().batch([ast for ast in asts if not isinstance(ast, Exception)], limit)
+    answers = iter(answers)
+    results = []
+    for query, ast in zip(queries, asts):
+        answer = ast if isinstance(ast, Exception) else next(answers)
+        if isinstance(answer, Exception):
+            results.append({'query': query, 'error': str(answer)})
+        else:
+            results.append({'query': query, 'count': answer[0], 'ids': list(answer[1])})
+    return JsonResponse({'results': results, 'evaluated': evaluated})
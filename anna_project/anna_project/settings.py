@@ -126,3 +126,66 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.9/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Search index
+
+# how often (in seconds) processes check if their in-memory index is stale
+ANNA_INDEX_CHECK_INTERVAL = 5
+
+# max number of query results kept in the LRU cache of each process
+ANNA_RESULT_CACHE_SIZE = 1000
+
+# max number of parsed queries kept in the LRU cache of each process
+ANNA_PARSE_CACHE_SIZE = 1000
+
+# max number of words a single wildcard, i.e. `вронск*`, can expand to
+ANNA_WILDCARD_MAX_TERMS = 1000
+
+# max number of words in a snippet of a paragraph on the results page
+ANNA_SNIPPET_WORDS = 40
+
+# path to the index file written by `populate.py --index-file`, processes mmap it instead of
+# loading the index from the DB; None - always load from the DB
+ANNA_INDEX_FILE = None
+
+# max number of queries in a single request to the batch API
+ANNA_BATCH_MAX_QUERIES = 1000
+
+# search requests taking at least this many milliseconds are written to the slow-query log
+# (logger `anna.metrics`) with the canonical AST and time spent in every stage; None - no log
+ANNA_SLOW_QUERY_MS = 500
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'anna': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
+# search backend used by the results page and the count API (see anna/backends.py):
+# 'anna.backends.IndexBackend' - in-memory index, 'anna.backends.SQLBackend' - one SQL statement per search,
+# 'anna.backends.FTS5Backend' - SQLite FTS5 full-text table, SQLite only,
+# 'anna.backends.ShardedBackend' - an index per corpus, searched by a pool of worker processes
+ANNA_SEARCH_BACKEND = 'anna.backends.IndexBackend'
+
+# how postings are stored in the DB: 'table' - compressed Word.postings and Word-Paragraph relation rows,
+# 'blob' - compressed Word.postings only, several times smaller, but SQLBackend can't be used
+ANNA_POSTINGS_STORAGE = 'table'
+
+# number of worker processes searching shards (an index per corpus) with 'anna.backends.ShardedBackend',
+# 0 - shards are searched in the process handling the request
+ANNA_SHARD_WORKERS = 4
+
+# seconds retired paragraphs are kept after repopulation, so processes still serving the old index
+# can fetch them (see anna/indexing.py), must exceed ANNA_INDEX_CHECK_INTERVAL plus the time to load the index
+ANNA_RETIRED_TTL = 600
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "anna_project.settings")
 
 application = get_wsgi_application()
+
+# the search backend is created before the server starts threads, ShardedBackend forks its workers here
+from anna.backends import get_backend
+get_backend()
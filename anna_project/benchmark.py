@@ -0,0 +1,436 @@
+# End-to-end benchmark of ingestion and query latency
+# Runs against a throwaway SQLite database populated from a text file, the configured database is never touched.
+#
+# Stages:
+#   ingest  - populate() of the whole file, throughput in paragraphs per second
+#   lex     - anna_lexer() of every query of the corpus
+#   lex:master, lex:loop - master regex lexer against the former lexer, which tried every expression in turn at
+#             every position, on the corpus plus long machine-generated queries; tokens of both are checked to be equal
+#   parse   - parse() of lexed tokens
+#   eval    - evaluation of parsed queries against the in-memory index, bypassing the result cache
+#   request - full GET of the results page through the Django test client, with parse and result caches cleared
+#   backend:NAME - count and ids of the first page of results from every search backend (see anna/backends.py),
+#             results of backends are checked against each other
+#
+# Query corpus is generated from words of the index with a fixed seed, so runs on the same file are comparable.
+# Phrases and NEAR queries of the positional category are taken from paragraphs, so most of them have matches.
+# Results are printed and saved as JSON; with --compare, stages whose p50 or p95 got slower than in a saved
+# run by more than --threshold are reported as regressions and the script exits with status 1.
+
+# set django config
+import os
+import sys
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'anna_project.settings')
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import platform
+import random
+import re
+import shutil
+import tempfile
+import time
+
+import django
+from django.conf import settings
+
+# benchmark database lives in a temporary directory removed on exit
+DB_DIR = tempfile.mkdtemp(prefix='anna-benchmark-')
+settings.DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(DB_DIR, 'db.sqlite3')}}
+settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ['testserver']
+django.setup()
+
+from django.core.management import call_command
+from django.test import Client
+
+from populate import populate
+from anna.backends import get_backend
+from anna.cache import result_cache
+from anna.index import get_index
+from anna.indexing import paragraph_tokens
+from anna.models import Paragraph
+from anna.ast import QueryError
+from anna.lexer import LexerError, anna_lexer, token_exprs
+from anna.parser import parse, parse_query
+from anna.planner import plan
+
+
+DEFAULT_INPUT = 'input_text.txt'
+
+# corpus size per query category
+DEFAULT_QUERIES = 50
+
+# every query is measured this many times per stage, except the request stage
+DEFAULT_REPEAT = 5
+
+# number of OR'ed clauses of the long queries of the lexer comparison
+LONG_QUERY_CLAUSES = 300
+
+# default relative slowdown reported as a regression
+DEFAULT_THRESHOLD = 0.2
+
+# search backends compared by default
+BACKENDS = ('anna.backends.IndexBackend', 'anna.backends.SQLBackend', 'anna.backends.FTS5Backend',
+            'anna.backends.ShardedBackend')
+
+
+def percentile(sorted_values, p):
+    """
+    Returns p-th percentile (nearest rank) of a sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(timings, items=None):
+    """
+    Returns dict of latency stats in milliseconds for a list of timings in seconds
+
+    items: number of items processed in all timed runs, throughput is items per second; number of runs if None
+    """
+    values = sorted(timings)
+    total = sum(values)
+    items = len(values) if items is None else items
+    return {
+        'runs': len(values),
+        'throughput': items / total if total else 0.0,
+        'mean_ms': total / len(values) * 1000 if values else 0.0,
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': values[-1] * 1000 if values else 0.0,
+    }
+
+
+def generate_queries(words, n, seed, paragraphs=()):
+    """
+    Generates query corpus
+
+    words: list of words to build queries from
+    n: number of queries per category
+    paragraphs: lists of tokens of paragraphs, phrases and NEAR queries are taken from them so they have matches
+    return: dict mapping category name to a list of queries
+    """
+    rnd = random.Random(seed)
+    paragraphs = [tokens for tokens in paragraphs if len(tokens) >= 3]
+
+    def word():
+        return rnd.choice(words)
+
+    def nested(depth):
+        if depth == 0:
+            return word()
+        op = rnd.choice(['AND', 'OR'])
+        left, right = nested(depth - 1), nested(rnd.randint(0, depth - 1))
+        if rnd.random() < 0.2:
+            left = 'NOT ' + left
+        return '( {} {} {} )'.format(left, op, right)
+
+    def not_heavy():
+        terms = [word()] + ['NOT ' + word() for _ in range(rnd.randint(2, 6))]
+        rnd.shuffle(terms)
+        return ' AND '.join(terms) + ' AND NOT ( {} OR {} )'.format(word(), word())
+
+    def positional():
+        tokens = rnd.choice(paragraphs)
+        i = rnd.randrange(len(tokens) - 2)
+        # other operand is up to 5 tokens after the first one, distances range from 0 to 5 - some miss it
+        j = min(i + rnd.randint(1, 5), len(tokens) - 1)
+        distance = rnd.randint(0, 5)
+        kind = rnd.randrange(4)
+        if kind == 0:
+            return '"{} {}"'.format(tokens[i], tokens[i + 1])
+        if kind == 1:
+            return '{} NEAR/{} {}'.format(tokens[i], distance, tokens[j])
+        if kind == 2:
+            return '"{} {}" NEAR/{} {}'.format(tokens[i], tokens[i + 1], distance, tokens[j])
+        return '{} NEAR/{} {}'.format(tokens[j], distance, tokens[i])
+
+    corpus = {
+        'single': [word() for _ in range(n)],
+        'and_chain': [' AND '.join(word() for _ in range(rnd.randint(5, 20))) for _ in range(n)],
+        'or_chain': [' OR '.join(word() for _ in range(rnd.randint(5, 20))) for _ in range(n)],
+        'nested': [nested(rnd.randint(4, 7)) for _ in range(n)],
+        'not_heavy': [not_heavy() for _ in range(n)],
+    }
+    if paragraphs:
+        corpus['positional'] = [positional() for _ in range(n)]
+    return corpus
+
+
+def loop_lex(input_str, token_exprs=token_exprs):
+    """
+    Former lexer, kept for comparison with the master regex one: every expression is tried in turn at every position
+    """
+    pos = 0
+    tokens = []
+    while pos < len(input_str):
+        for pattern, tag in token_exprs:
+            match = re.compile(pattern).match(input_str, pos)
+            if match:
+                if tag:
+                    tokens.append((match.group(0), tag))
+                break
+        if not match:
+            raise LexerError(input_str, pos)
+        pos = match.end(0)
+    return tokens
+
+
+def long_queries(words, n, seed):
+    """
+    Generates n machine-generated queries of LONG_QUERY_CLAUSES OR'ed clauses mixing every kind of token
+    """
+    rnd = random.Random(seed)
+
+    def clause():
+        kind = rnd.randrange(4)
+        if kind == 0:
+            return '"{} {}"'.format(rnd.choice(words), rnd.choice(words))
+        if kind == 1:
+            return '{} NEAR/{} {}'.format(rnd.choice(words), rnd.randint(1, 5), rnd.choice(words))
+        if kind == 2:
+            return '( {} AND NOT {} )'.format(rnd.choice(words), rnd.choice(words))
+        return rnd.choice(words)[:3] + '*'
+
+    return [' OR '.join(clause() for _ in range(LONG_QUERY_CLAUSES)) for _ in range(n)]
+
+
+def timed(func, *args):
+    """
+    Returns tuple (elapsed seconds, result of func(*args))
+    """
+    start = time.perf_counter()
+    res = func(*args)
+    return time.perf_counter() - start, res
+
+
+def bench_ingest(filepath, runs, workers):
+    """
+    Measures populate() of the whole file `runs` times, throughput is paragraphs per second
+    """
+    with open(filepath) as f:
+        n_paragraphs = sum(1 for _ in f)
+    timings = []
+    for _ in range(runs):
+        # populate() reports to stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed, _ = timed(populate, filepath, 1000, workers)
+        timings.append(elapsed)
+    return summarize(timings, n_paragraphs * runs)
+
+
+def bench_queries(corpus, repeat):
+    """
+    Measures lex, parse and eval stages for every query of the corpus
+
+    return: dict mapping stage to dict {'all': stats, category: stats, ...}
+    """
+    index = get_index()
+    timings = {stage: {} for stage in ('lex', 'parse', 'eval')}
+    for category, queries in corpus.items():
+        for stage in timings:
+            timings[stage][category] = []
+        for query in queries:
+            for _ in range(repeat):
+                elapsed, tokens = timed(anna_lexer, query)
+                timings['lex'][category].append(elapsed)
+                elapsed, ast = timed(parse, tokens)
+                timings['parse'][category].append(elapsed)
+                elapsed, _ = timed(lambda: plan(ast.value, index).eval(index))
+                timings['eval'][category].append(elapsed)
+    return {stage: stage_stats(by_category) for stage, by_category in timings.items()}
+
+
+def bench_lexers(corpus, long, repeat):
+    """
+    Measures the master regex lexer and the former loop lexer on the corpus and on `long` queries
+
+    return: dict {'lex:master': stats, 'lex:loop': stats}
+    """
+    timings = {'lex:master': {}, 'lex:loop': {}}
+    for category, queries in dict(corpus, long=long).items():
+        for stage in timings:
+            timings[stage][category] = []
+        for query in queries:
+            for _ in range(repeat):
+                elapsed, tokens = timed(anna_lexer, query)
+                timings['lex:master'][category].append(elapsed)
+                elapsed, loop_tokens = timed(loop_lex, query)
+                timings['lex:loop'][category].append(elapsed)
+            if tokens != loop_tokens:
+                raise RuntimeError('Lexers return different tokens for {!r}'.format(query))
+    return {stage: stage_stats(by_category) for stage, by_category in timings.items()}
+
+
+def bench_requests(corpus):
+    """
+    Measures full requests of the results page, one per query of the corpus, caches are cleared before each one
+    """
+    client = Client()
+    timings = {}
+    for category, queries in corpus.items():
+        timings[category] = []
+        for query in queries:
+            parse_query.cache_clear()
+            result_cache.clear()
+            elapsed, response = timed(client.get, '/results/', {'query': query})
+            if response.status_code != 200:
+                raise RuntimeError('Request for {!r} failed with status {}'.format(query, response.status_code))
+            timings[category].append(elapsed)
+    return stage_stats(timings)
+
+
+def bench_backends(corpus, paths):
+    """
+    Measures every backend on the corpus: count and ids of the first page of results, caches are cleared before
+    each query; queries a backend doesn't support are skipped
+
+    return: tuple (dict mapping stage name to stats, list of queries backends disagree on)
+    """
+    asts = {category: [parse_query(query) for query in queries] for category, queries in corpus.items()}
+    stats = {}
+    answers = {}
+    for path in paths:
+        backend = get_backend(path)
+        # backends may set up their tables on first use
+        backend.count(next(ast for category_asts in asts.values() for ast in category_asts))
+        timings = {}
+        for category, queries in corpus.items():
+            timings[category] = []
+            for query, ast in zip(queries, asts[category]):
+                result_cache.clear()
+                try:
+                    elapsed, answer = timed(backend.page, ast, 0, 10)
+                except QueryError:
+                    continue
+                timings[category].append(elapsed)
+                answers.setdefault(query, {})[backend.name] = answer
+        stats['backend:' + backend.name] = stage_stats(timings)
+    mismatches = [query for query, by_backend in answers.items() if len(set(map(repr, by_backend.values()))) > 1]
+    return stats, mismatches
+
+
+def stage_stats(by_category):
+    """
+    Returns stats of a stage overall and per category from a dict mapping category to timings
+    """
+    res = {'all': summarize([t for timings in by_category.values() for t in timings])}
+    res.update((category, summarize(timings)) for category, timings in by_category.items())
+    return res
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns list of regressions of `results` against `baseline` results, as human readable strings
+    """
+    regressions = []
+    for stage, current in results.items():
+        previous = baseline.get(stage)
+        if not current or not previous:
+            continue
+        # ingest has flat stats, other stages are split by category
+        if 'all' not in current:
+            current, previous = {'all': current}, {'all': previous}
+        for category, stats in current.items():
+            old = previous.get(category)
+            if not old:
+                continue
+            for key in ('p50_ms', 'p95_ms'):
+                if old[key] and stats[key] > old[key] * (1 + threshold):
+                    regressions.append('{stage}/{category} {key}: {old:.3f} -> {new:.3f} (+{pct:.0f}%)'.format(
+                        stage=stage, category=category, key=key, old=old[key], new=stats[key],
+                        pct=(stats[key] / old[key] - 1) * 100))
+    return regressions
+
+
+def print_results(results):
+    for stage, stats in results.items():
+        rows = stats.items() if 'all' in stats else [('all', stats)]
+        for category, s in rows:
+            print('{stage:13} {category:10} p50 {p50_ms:9.3f} ms  p95 {p95_ms:9.3f} ms  p99 {p99_ms:9.3f} ms  '
+                  '{throughput:12.1f}/s'.format(stage=stage, category=category, **s))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmarks ingestion and query latency on a temporary SQLite database')
+    arg_parser.add_argument('file_path', nargs='?', default=DEFAULT_INPUT,
+                            help='text file to populate the database from (default: %(default)s)')
+    arg_parser.add_argument('--queries', type=int, default=DEFAULT_QUERIES,
+                            help='number of generated queries per category (default: %(default)s)')
+    arg_parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                            help='number of runs of lex, parse and eval per query (default: %(default)s)')
+    arg_parser.add_argument('--ingest-runs', type=int, default=3,
+                            help='number of populate() runs (default: %(default)s)')
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help='number of processes populate() tokenizes with (default: %(default)s)')
+    arg_parser.add_argument('--seed', type=int, default=0, help='seed of the query corpus (default: %(default)s)')
+    arg_parser.add_argument('--backends', nargs='*', default=BACKENDS, metavar='PATH',
+                            help='dotted paths of search backends to compare (default: all of them)')
+    arg_parser.add_argument('--output', help='save results to this JSON file')
+    arg_parser.add_argument('--compare', help='JSON file of a previous run to check for regressions')
+    arg_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                            help='relative slowdown of p50/p95 reported as a regression (default: %(default)s)')
+    args = arg_parser.parse_args()
+    if min(args.queries, args.repeat, args.ingest_runs, args.workers) < 1:
+        arg_parser.error('numbers of queries, runs and workers must be positive')
+
+    try:
+        call_command('migrate', verbosity=0)
+        results = {'ingest': bench_ingest(args.file_path, args.ingest_runs, args.workers)}
+        index = get_index()
+        texts = Paragraph.objects.filter(retired__isnull=True).values_list('text', flat=True).iterator()
+        corpus = generate_queries(index.words, args.queries, args.seed, map(paragraph_tokens, texts))
+        results.update(bench_queries(corpus, args.repeat))
+        results.update(bench_lexers(corpus, long_queries(index.words, args.queries, args.seed), args.repeat))
+        results['request'] = bench_requests(corpus)
+        backend_results, mismatches = bench_backends(corpus, args.backends)
+        results.update(backend_results)
+    except FileNotFoundError as e:
+        print(e)
+        return 2
+    finally:
+        shutil.rmtree(DB_DIR, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'file': os.path.abspath(args.file_path),
+            'paragraphs': len(index.paragraph_ids),
+            'words': len(index),
+            'queries_per_category': args.queries,
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'backend_mismatches': mismatches,
+        },
+        'results': results,
+    }
+    print_results(results)
+    for query in mismatches:
+        print('MISMATCH backends return different results for {!r}'.format(query))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results were saved to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+        print('No regressions against {}'.format(args.compare))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
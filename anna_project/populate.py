@@ -3,72 +3,331 @@ import os
 import sys
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'anna_project.settings')
 
-import re
+import argparse
+import io
 import time
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
 import django
 django.setup()
 
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_unicode_slug
+from django.db import transaction
+
 from anna.models import Word, Paragraph
+from anna.codec import encode_positional_postings, encode_sorted, encode_spans
+from anna.index import InvertedIndex
+from anna.indexfile import write_index_file
+from anna.indexing import paragraph_scan, bump_generation, add_paragraphs, update_paragraph, delete_paragraphs, uses_relation_table, allocate_ids, get_corpus_id, retire_paragraphs, purge_retired, DEFAULT_CORPUS
+
+
+# default number of rows per INSERT statement
+DEFAULT_BATCH_SIZE = 1000
+
+# number of chunks per worker process in parallel mode, more chunks - better load balancing
+CHUNKS_PER_WORKER = 4
+
+
+def build_index(lines):
+    """
+    Tokenizes paragraphs and builds an inverted index for them
+
+    lines: iterable of str, each line is a paragraph
+    return: tuple (texts, lengths, offsets, postings, positions)
+        texts: list of paragraph texts
+        lengths: array of numbers of tokens in paragraphs
+        offsets: list of char offsets of tokens in paragraphs, encoded with codec.encode_spans()
+        postings: OrderedDict mapping a word to a sorted array of numbers of paragraphs (0-based) containing it,
+                  words are in the order of their first occurrence
+        positions: dict mapping a word to a list of arrays of its token positions, one for each of its postings
+    """
+    texts = []
+    lengths = array('I')
+    offsets = []
+    postings = OrderedDict()
+    positions = {}
+    for p_number, line in enumerate(lines):
+        texts.append(line)
+        # token offsets are stored for snippets, so result pages don't have to tokenize paragraphs
+        line_positions, spans = paragraph_scan(line)
+        lengths.append(len(spans))
+        offsets.append(encode_spans(spans))
+        # every word is counted once per paragraph
+        for word, word_positions in line_positions.items():
+            if word in postings:
+                postings[word].append(p_number)
+                positions[word].append(array('I', word_positions))
+            else:
+                postings[word] = array('I', [p_number])
+                positions[word] = [array('I', word_positions)]
+    return texts, lengths, offsets, postings, positions
+
+
+def chunk_offsets(filepath, n_chunks):
+    """
+    Splits a file into at most `n_chunks` paragraph-aligned chunks of roughly equal size
+
+    return: list of tuples (start, end) - byte offsets of chunks, every chunk ends right after a newline or at EOF
+    """
+    size = os.path.getsize(filepath)
+    offsets = []
+    start = 0
+    with open(filepath, 'rb') as f:
+        for i in range(1, n_chunks + 1):
+            if start >= size:
+                break
+            # move to the end of the line containing the approximate chunk boundary
+            f.seek(max(size * i // n_chunks, start))
+            f.readline()
+            end = min(f.tell(), size) if i < n_chunks else size
+            if end > start:
+                offsets.append((start, end))
+                start = end
+    return offsets
+
+
+def index_chunk(filepath, start, end):
+    """
+    Worker function for parallel mode, builds a partial index of a chunk of the file
+
+    Chunk is decoded the same way `open(filepath)` reads the whole file, so the partial indexes
+    combined are exactly the same as the index of the whole file
+
+    return: tuple (texts, lengths, offsets, postings, positions) - partial index of the chunk,
+            paragraph numbers in postings start from 0 for every chunk
+    """
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return build_index(io.TextIOWrapper(io.BytesIO(data)))
+
+
+def merge_indexes(partial_indexes):
+    """
+    Merges partial indexes of consecutive chunks into one
+
+    Words keep the order of their first occurrence and paragraph numbers are shifted by the number of paragraphs
+    in preceding chunks, so the result is identical to `build_index()` of the whole file
+
+    partial_indexes: iterable of (texts, lengths, offsets, postings, positions) tuples in chunk order
+    return: tuple (texts, lengths, offsets, postings, positions), merged
+    """
+    texts = []
+    lengths = array('I')
+    offsets = []
+    postings = OrderedDict()
+    positions = {}
+    for partial_texts, partial_lengths, partial_offsets, partial_postings, partial_positions in partial_indexes:
+        offset = len(lengths)
+        texts.extend(partial_texts)
+        lengths.extend(partial_lengths)
+        offsets.extend(partial_offsets)
+        for word, p_numbers in partial_postings.items():
+            shifted = array('I', (p_number + offset for p_number in p_numbers))
+            if word in postings:
+                postings[word].extend(shifted)
+                positions[word].extend(partial_positions[word])
+            else:
+                postings[word] = shifted
+                positions[word] = partial_positions[word]
+    return texts, lengths, offsets, postings, positions
+
+
+def build_index_parallel(filepath, workers):
+    """
+    Builds an inverted index of a text file, tokenizing paragraph-aligned chunks in `workers` processes
+
+    return: tuple (texts, lengths, offsets, postings, positions), same as the one returned by `build_index()`
+            for the whole file
+    """
+    offsets = chunk_offsets(filepath, workers * CHUNKS_PER_WORKER)
+    starts = [start for start, _ in offsets]
+    ends = [end for _, end in offsets]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map() yields results in the order of chunks, which keeps the merge deterministic
+        partial_indexes = executor.map(index_chunk, [filepath] * len(offsets), starts, ends)
+        return merge_indexes(partial_indexes)
+
+
+def bulk_insert(model, objs, batch_size):
+    """
+    Inserts objects from `objs` iterable into `model` table, `batch_size` rows per INSERT statement
+    """
+    objs = iter(objs)
+    batch = list(islice(objs, batch_size))
+    while batch:
+        model.objects.bulk_create(batch)
+        batch = list(islice(objs, batch_size))
 
 
-def populate(filepath):
+def populate(filepath, batch_size=DEFAULT_BATCH_SIZE, workers=1, corpus=DEFAULT_CORPUS):
     """
-    Populates Paragraph and Word databases from a text file located at `filepath`
+    Populates Paragraph and Word databases of a corpus from a text file located at `filepath`
+
+    The whole file is tokenized first, then all rows of the corpus are replaced in a single transaction,
+    so the tables are never seen half-populated. Other corpora are not touched, paragraphs of the corpus
+    get consecutive ids after all existing paragraphs. Old paragraphs of the corpus are retired instead of
+    being deleted, so requests served by app processes from the old index can still fetch them
+    (see indexing.retire_paragraphs()).
 
     filepath: str representing a path to a text file
+    batch_size: int, number of rows per INSERT statement
+    workers: int, number of processes to tokenize the file with, 1 means no extra processes
+    corpus: str, name of the corpus, it's created if it doesn't exist
     return: None
     """
     start = time.time()
-    # store all words
-    all_words = {}
-    p_counter = 0
 
     # start reading from file
+    if workers > 1:
+        # texts come back from the workers as well, so the file is read and tokenized once
+        texts, lengths, offsets, postings, positions = build_index_parallel(filepath, workers)
+    else:
+        with open(filepath) as f:
+            texts, lengths, offsets, postings, positions = build_index(f)
+
+    through = Word.paragraphs.through
+    with transaction.atomic():
+        corpus_id = get_corpus_id(corpus)
+        purge_retired()
+        # clear rows of the corpus
+        through.objects.filter(word__corpus_id=corpus_id).delete()
+        Word.objects.filter(corpus_id=corpus_id).delete()
+        retire_paragraphs(Paragraph.objects.filter(corpus_id=corpus_id))
+
+        # ids are assigned here, so we don't have to read them back after bulk inserts
+        p_first, w_first = allocate_ids(Paragraph, len(texts)), allocate_ids(Word, len(postings))
+        paragraphs = (Paragraph(id=p_first + p_number, corpus_id=corpus_id, text=text, length=length,
+                                offsets=text_offsets)
+                      for p_number, (text, length, text_offsets) in enumerate(zip(texts, lengths, offsets)))
+        words = (Word(id=w_first + w_number, corpus_id=corpus_id, word=word, df=len(p_numbers),
+                      postings=bytes(encode_sorted(p_first + p_number for p_number in p_numbers)),
+                      positions=encode_positional_postings(zip((p_first + p_number for p_number in p_numbers),
+                                                               positions[word])))
+                 for w_number, (word, p_numbers) in enumerate(postings.items()))
+        # relation rows are needed only for SQL search, see ANNA_POSTINGS_STORAGE setting
+        relations = (through(word_id=w_first + w_number, paragraph_id=p_first + p_number)
+                     for w_number, p_numbers in enumerate(postings.values())
+                     for p_number in p_numbers)
+
+        bulk_insert(Paragraph, paragraphs, batch_size)
+        bulk_insert(Word, words, batch_size)
+        if uses_relation_table():
+            bulk_insert(through, relations, batch_size)
+        bump_generation()
+
+    elapsed = time.time() - start
+    print('{} words were added to the Word table\n{} paragraphs were added to the Paragraph table'.format(len(postings), len(texts)))
+    print('Corpus: {}'.format(corpus))
+    print('Running time: {}'.format(elapsed))
+    return
+
+
+def populate_incremental(filepath, corpus=DEFAULT_CORPUS):
+    """
+    Brings Paragraph and Word databases of a corpus in line with a text file located at `filepath`
+    without reloading them
+
+    Paragraphs whose text is still in the file are left untouched. The rest of them are paired with new lines
+    of the file and updated, the remaining ones are deleted, the remaining lines are added as new paragraphs.
+    Only postings of words in affected paragraphs are touched. New paragraphs get ids after all existing ones,
+    so they are ordered after existing paragraphs in search results.
+
+    filepath: str representing a path to a text file
+    corpus: str, name of the corpus, it's created if it doesn't exist
+    return: None
+    """
+    start = time.time()
     with open(filepath) as f:
+        texts = f.readlines()
+
+    corpus_id = get_corpus_id(corpus)
+    # ids of existing paragraphs by their text, texts may repeat
+    existing = defaultdict(deque)
+    rows = Paragraph.objects.filter(corpus_id=corpus_id, retired__isnull=True).order_by('id').values_list('id', 'text')
+    for p_id, text in rows.iterator():
+        existing[text].append(p_id)
+
+    new_texts = []
+    for text in texts:
+        if existing.get(text):
+            existing[text].popleft()
+        else:
+            new_texts.append(text)
+    stale_ids = sorted(p_id for p_ids in existing.values() for p_id in p_ids)
+
+    updated = list(zip(stale_ids, new_texts))
+    deleted = stale_ids[len(updated):]
+    added = new_texts[len(updated):]
+    with transaction.atomic():
+        for p_id, text in updated:
+            update_paragraph(p_id, text)
+        delete_paragraphs(deleted)
+        add_paragraphs(added, corpus_id)
 
-        # clear all tables
-        Word.objects.all().delete()
-        Paragraph.objects.all().delete()
-
-        # regex to get words from the string
-        reg_obj = re.compile(r'\w+\-\w+|\w+')
-
-        for line in f:
-            # create paragraph
-            cur_paragraph = Paragraph.objects.create(text=line)
-            p_counter += 1
-
-            # get words from the line
-            words = (w.lower() for w in reg_obj.findall(line))
-
-            # add words to DB
-            for word in words:
-                if word in all_words:
-                    all_words[word].paragraphs.add(cur_paragraph)
-                else:
-                    obj = Word.objects.create(word=word)
-                    obj.paragraphs.add(cur_paragraph)
-                    all_words[word] = obj
     elapsed = time.time() - start
-    print('{} words were added to the Word table\n{} paragraphs were added to the Paragraph table'.format(len(all_words), p_counter))
+    print('{} paragraphs were updated, {} deleted, {} added'.format(len(updated), len(deleted), len(added)))
+    print('Running time: {}'.format(elapsed))
+    return
+
+
+def write_index(filepath):
+    """
+    Writes the index of current contents of the tables to an index file located at `filepath`,
+    search processes map it when ANNA_INDEX_FILE points to it
+
+    return: None
+    """
+    start = time.time()
+    index = InvertedIndex.from_db()
+    write_index_file(filepath, index)
+    elapsed = time.time() - start
+    print('Index file {} was written: {} terms, generation {}'.format(filepath, len(index), index.generation))
     print('Running time: {}'.format(elapsed))
     return
 
 
 def main():
-    if len(sys.argv) != 2:
-        print('usage: python3 populate.py file_path')
-        return 1
-    else:
-        try:
-            print('Starting populate.py...')
-            populate(sys.argv[1])
-        except FileNotFoundError as e:
-            print(e)
-            return 2
+    arg_parser = argparse.ArgumentParser(description='Populates Paragraph and Word databases from a text file')
+    arg_parser.add_argument('file_path', help='path to a text file, one paragraph per line')
+    arg_parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help='number of rows per INSERT statement (default: %(default)s)')
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help='number of processes to tokenize the file with (default: %(default)s)')
+    arg_parser.add_argument('--corpus', default=DEFAULT_CORPUS,
+                            help='name of the corpus the file is loaded into, other corpora are kept (default: %(default)s)')
+    arg_parser.add_argument('--incremental', action='store_true',
+                            help='update only changed paragraphs instead of reloading all tables')
+    arg_parser.add_argument('--index-file',
+                            help='also write a binary index file for search processes to mmap (see ANNA_INDEX_FILE)')
+    args = arg_parser.parse_args()
+    if args.batch_size < 1:
+        arg_parser.error('batch size must be positive')
+    if args.workers < 1:
+        arg_parser.error('number of workers must be positive')
+    try:
+        # corpus names are used in `corpus:NAME` query filters
+        validate_unicode_slug(args.corpus)
+    except ValidationError:
+        arg_parser.error('corpus name must consist of letters, numbers, underscores or hyphens')
+
+    try:
+        print('Starting populate.py...')
+        if args.incremental:
+            populate_incremental(args.file_path, corpus=args.corpus)
         else:
-            return 0
+            populate(args.file_path, batch_size=args.batch_size, workers=args.workers, corpus=args.corpus)
+        if args.index_file:
+            write_index(args.index_file)
+    except FileNotFoundError as e:
+        print(e)
+        return 2
+    else:
+        return 0
 
 
 if __name__ == '__main__':